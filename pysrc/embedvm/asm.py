@@ -1,4 +1,5 @@
 import ast
+import re
 from . import bytecode
 from util import flipped, joining, adding
 
@@ -7,14 +8,161 @@ class UnresolvedReference(object):
         self.id = id
 
     def resolve(self, labels):
-        for l in labels:
-            if l.id == self.id:
-                self.__class__ = bytecode.Label.LabelRef
-                self.ref = l
-                del self.id
-                break
+        """Resolve to the label with this id in labels ({id: label})"""
+        if self.id not in labels:
+            raise Exception("Unresolved label %s"%self.id)
+        self.resolve_to(labels[self.id])
+
+    def resolve_to(self, label):
+        self.__class__ = bytecode.Label.LabelRef
+        self.ref = label
+        del self.id
+
+def read_command(value, unrefs):
+    """Create a command from its repr, parsed to an ast.Call. LabelRefs are
+    replaced with UnresolvedReferences, which are appended to unrefs."""
+    assert value.kwargs is None and value.starargs is None
+
+    commandclass = getattr(bytecode, value.func.id)
+    assert issubclass(commandclass, bytecode.ByteCodeCommand)
+
+    keywords = dict((k.arg, k.value) for k in value.keywords) if value.keywords else {}
+
+    for (k, v) in keywords.items():
+        if isinstance(v, ast.Call) and isinstance(v.func, ast.Name) and v.func.id == 'LabelRef':
+            ref = UnresolvedReference(ast.literal_eval(v.args[0]))
+            unrefs.append(ref)
+            keywords[k] = ref
         else:
-            raise Exception("Unresolved label")
+            keywords[k] = ast.literal_eval(v)
+
+    return commandclass(**keywords)
+
+# one item per line as written by to_asm: a command (possibly assigned to a
+# name, which is ignored) or a list of data bytes, and maybe a comment
+_LINE = re.compile(r"\s*(?:\w+\s*=\s*)?(?:(\w+)\((.*)\)|\[(.*)\])\s*(?:#.*)?$")
+_ARGUMENT = re.compile(r"""\s*(\w+)\s*=\s*(?:LabelRef\(\s*(?:'([^'\\]*)'|"([^"\\]*)")\s*\)|('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|[-\w]+))\s*(?:,|$)""")
+_CONSTANTS = {'None': None, 'True': True, 'False': False}
+_command_classes = {}
+
+def _literal(token):
+    if token[0] in "'\"" and "\\" not in token:
+        return token[1:-1]
+    if token in _CONSTANTS:
+        return _CONSTANTS[token]
+    try:
+        return int(token)
+    except ValueError:
+        return ast.literal_eval(token)
+
+def _command_class(name):
+    if name not in _command_classes:
+        commandclass = getattr(bytecode, name, None)
+        if not (isinstance(commandclass, type) and issubclass(commandclass, bytecode.ByteCodeCommand)):
+            raise Exception("Unknown command %s"%name)
+        _command_classes[name] = commandclass
+    return _command_classes[name]
+
+def parse_command(line, unrefs):
+    """Create a command from its repr (a line of to_asm output) like
+    read_command, without going through the ast for the usual forms"""
+    item = _parse_line(line, unrefs)
+    if not isinstance(item, bytecode.ByteCodeCommand):
+        raise Exception("Not a command: %r"%line)
+    return item
+
+def _parse_line(line, unrefs):
+    """Return the command or the list of data bytes on a line, or None if
+    there is nothing on it; fall back to the ast for unusual forms"""
+    match = _LINE.match(line)
+    if match is None:
+        return _parse_statement(line, unrefs)
+    name, arguments, data = match.groups()
+
+    if name is None:
+        try:
+            return [int(v) for v in data.split(",")] if data.strip() else []
+        except ValueError:
+            return _parse_statement(line, unrefs)
+
+    keywords = {}
+    refs = []
+    pos = 0
+    while pos < len(arguments):
+        argument = _ARGUMENT.match(arguments, pos)
+        if argument is None:
+            return _parse_statement(line, unrefs)
+        key, ref, ref2, value = argument.groups()
+        if value is None:
+            ref = UnresolvedReference(ref if ref is not None else ref2)
+            refs.append(ref)
+            keywords[key] = ref
+        else:
+            keywords[key] = _literal(value)
+        pos = argument.end()
+    unrefs.extend(refs)
+    return _command_class(name)(**keywords)
+
+def _parse_statement(text, unrefs):
+    nodes = ast.parse(text.strip()).body
+    if not nodes:
+        return None
+    (node, ) = nodes
+    if isinstance(node.value, ast.Call):
+        return read_command(node.value, unrefs)
+    return ast.literal_eval(node.value)
+
+def _open_brackets(text):
+    """Number of brackets left open in text, not counting those in strings
+    and comments"""
+    depth = 0
+    quote = None
+    escaped = False
+    comment = False
+    for char in text:
+        if comment:
+            comment = char != "\n"
+        elif quote is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == "#":
+            comment = True
+        elif char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+    return depth
+
+def parse_asm(lines, unrefs):
+    """Yield the commands and lists of data bytes in assembly as written by
+    ASM.to_asm, from an iterable of lines (eg. a file). LabelRefs are
+    replaced with UnresolvedReferences, which are appended to unrefs.
+
+    Statements may span lines as long as their brackets are open."""
+    pending = ""
+    for line in lines:
+        if pending:
+            line = pending + line
+            pending = ""
+        stripped = line.strip()
+        if not stripped or stripped[0] == "#":
+            continue
+        if _open_brackets(line) > 0:
+            pending = line + "\n"
+            continue
+        item = _parse_line(line, unrefs)
+        if item is not None:
+            yield item
+    if pending:
+        raise Exception("Unexpected end of assembly in %r"%pending.strip())
+
+DATA_PER_LINE = 16 # bytes per line of a data block in assembly
 
 class DataBlock(object):
     def read_ast(self, data):
@@ -22,8 +170,14 @@ class DataBlock(object):
 
     length = property(lambda self: len(self.data))
 
-    def to_asm(self):
-        return repr(self.to_binary(0))
+    def asm_lines(self):
+        """Yield the data as lists of up to DATA_PER_LINE bytes, one per
+        line (consecutive lists are read back as consecutive blocks)"""
+        data = self.to_binary(0)
+        for start in range(0, len(data), DATA_PER_LINE) or [0]:
+            yield repr(data[start:start + DATA_PER_LINE])
+
+    to_asm = joining(asm_lines)
 
     def to_binary(self, startpos):
         return self.data
@@ -34,12 +188,13 @@ class CodeBlock(object):
 class FreeCodeBlock(CodeBlock):
     def __init__(self):
         self.code = [] # bytecode objects
+        self.lines = {} # bytecode object -> source line
 
-    @joining
-    def to_asm(self):
+    def asm_lines(self):
         for c in self.code:
-            code = repr(c)
-            yield code
+            yield repr(c)
+
+    to_asm = joining(asm_lines)
 
     def append(self, command):
         self.code.append(command)
@@ -66,6 +221,12 @@ class FreeCodeBlock(CodeBlock):
 
             update_positions()
 
+        return self.fixed_block(positions)
+
+    def fixed_block(self, positions):
+        """Return the commands placed at positions (one per command, with
+        their lengths and relative addresses final) as a
+        FixedPositionCodeBlock"""
         fixed = FixedPositionCodeBlock()
         for (pos, c) in zip(positions, self.code):
             if isinstance(c, bytecode.Label):
@@ -74,6 +235,8 @@ class FreeCodeBlock(CodeBlock):
                 continue
             assert pos not in fixed.code
             fixed.code[pos] = c
+            if c in self.lines:
+                fixed.lines[pos] = self.lines[c]
 
         return fixed
 
@@ -81,16 +244,18 @@ class FixedPositionCodeBlock(CodeBlock):
     def __init__(self):
         self.code = {} # position -> bytecode
         self.sym = {} # export label -> (position, type)
+        self.lines = {} # position -> source line
 
     @property
     def length(self):
         maxindex = max(self.code)
         return maxindex + self.code[maxindex].length
 
-    @joining
-    def to_asm(self):
-        for (lineno, c) in sorted(self.code.items()):
-            yield "%-30r# %04x"%(c, lineno)
+    def asm_lines(self):
+        for lineno in sorted(self.code):
+            yield "%-30r# %04x"%(self.code[lineno], lineno)
+
+    to_asm = joining(asm_lines)
 
     def unfixed_code(self):
         labels = {} # position -> label object
@@ -107,6 +272,8 @@ class FixedPositionCodeBlock(CodeBlock):
             if lineno in labels:
                 newcode.code.append(labels[lineno])
             newcode.code.append(command)
+            if lineno in self.lines:
+                newcode.lines[command] = self.lines[lineno]
 
         return newcode
 
@@ -159,13 +326,30 @@ class ASM(object):
                 next += command.length
             self.blocks.append(cb)
 
-    @joining
-    def to_asm(self):
+    def asm_lines(self):
         for b in self.blocks:
-            yield b.to_asm()
+            for line in b.asm_lines():
+                yield line
+
+    to_asm = joining(asm_lines)
+
+    def write_asm(self, f, batch=256):
+        """Write the assembly to the file object f as it is generated, batch
+        lines at a time, ending each line with a newline"""
+        lines = []
+        for line in self.asm_lines():
+            lines.append(line)
+            if len(lines) == batch:
+                f.write("\n".join(lines) + "\n")
+                lines = []
+        if lines:
+            f.write("\n".join(lines) + "\n")
 
     def read_asm(self, data):
-        nodes = ast.parse(data).body
+        """Read assembly as written by to_asm from a string or an iterable
+        of lines (eg. a file)"""
+        if isinstance(data, basestring):
+            data = data.splitlines()
         pos = 0
 
         def finish_codebuffer():
@@ -187,46 +371,26 @@ class ASM(object):
             codebuffer[:] = []
             while unrefs:
                 unrefs.pop().resolve(labels)
-            labels[:] = []
+            labels.clear()
 
         codebuffer = [] # (pos, code)
-        labels = []
+        labels = {} # id -> label in codebuffer
         unrefs = []
-        for node in nodes:
-            (target, ) = getattr(node, 'targets', [None])
-            if target is not None:
-                target = target.id
-            value = node.value
-
-            if not isinstance(value, ast.Call):
+        for item in parse_asm(data, unrefs):
+            if not isinstance(item, bytecode.ByteCodeCommand):
                 finish_codebuffer()
                 # assume it's data
                 assert pos is not None, "Can not have global data segment after free code"
                 datablock = DataBlock()
-                datablock.read_ast(value)
+                datablock.data = item
                 self.blocks.append(datablock)
                 pos += datablock.length
 
-            else: # it's a call -- this is code.
-                assert value.kwargs is None and value.starargs is None
-
-                commandclass = getattr(bytecode, value.func.id)
-                assert issubclass(commandclass, bytecode.ByteCodeCommand)
-
-                keywords = dict((k.arg, k.value) for k in value.keywords) if value.keywords else {}
-
-                for (k, v) in keywords.items():
-                    if isinstance(v, ast.Call) and isinstance(v.func, ast.Name) and v.func.id == 'LabelRef':
-                        ref = UnresolvedReference(ast.literal_eval(v.args[0]))
-                        unrefs.append(ref)
-                        keywords[k] = ref
-                    else:
-                        keywords[k] = ast.literal_eval(v)
-
-                command = commandclass(**keywords)
+            else: # it's a command -- this is code.
+                command = item
 
                 if isinstance(command, bytecode.Label):
-                    labels.append(command)
+                    labels.setdefault(command.id, command)
 
                 codebuffer.append((pos, command))
 
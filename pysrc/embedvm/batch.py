@@ -0,0 +1,163 @@
+import distutils.sysconfig
+import multiprocessing
+import os
+import shlex
+import signal
+import socket
+import sys
+import traceback
+from StringIO import StringIO
+
+from . import bytecode
+from . import remote
+from .tools import TOOLS
+
+def read_manifest(text):
+    """Return the command lines (lists of arguments, the tool name first) of
+    a manifest: one shell-quoted command per line, # starts a comment.
+
+    The commands run concurrently, so none may use the outputs of another."""
+    commands = []
+    for line in text.splitlines():
+        argv = shlex.split(line, comments=True)
+        if argv:
+            commands.append(argv)
+    return commands
+
+# modules from here are not reloaded between commands
+_LIBRARIES = [os.path.realpath(distutils.sysconfig.get_python_lib(standard_lib=True)), os.path.realpath(distutils.sysconfig.get_python_lib())]
+
+def _forget_program_modules():
+    """Remove the modules that compiled programs imported (like their user
+    function modules) from sys.modules, keeping embedvm and the libraries,
+    so that the next command imports the current version of their files"""
+    for (name, module) in sys.modules.items():
+        filename = getattr(module, '__file__', None)
+        if filename is None or name == '__main__' or name.split('.')[0] == 'embedvm':
+            continue
+        filename = os.path.realpath(filename)
+        if not any(filename.startswith(library + os.sep) for library in _LIBRARIES):
+            del sys.modules[name]
+
+def run_tool(argv, cwd=None):
+    """Run a command line of one of the TOOLS in this process, in the
+    directory cwd, and return (exit status, stdout, stderr). Modules that
+    earlier commands imported from outside embedvm and the Python
+    libraries are imported again."""
+    name = os.path.basename(argv[0]) if argv else None
+    if name not in TOOLS:
+        return 1, "", "Unknown tool %r (known: %s)\n"%(name, ", ".join(sorted(TOOLS)))
+
+    saved = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout, sys.stderr = out, err = StringIO(), StringIO()
+    # labels are numbered like in a fresh process, so the outputs are the
+    # same as when the tool runs by itself
+    bytecode.Label.reset_counter()
+    _forget_program_modules()
+    status = 0
+    try:
+        if cwd is not None:
+            os.chdir(cwd)
+        TOOLS[name](argv[1:])
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            err.write("%s\n"%e.code)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = saved[:2]
+        os.chdir(saved[2])
+    return status, out.getvalue(), err.getvalue()
+
+def _run_tool(args):
+    return run_tool(*args)
+
+def run_batch(commands, jobs=None, cwd=None):
+    """Run command lines with run_tool in a pool of jobs processes (default:
+    one per core; with 1, in this process), print their outputs in the
+    order of the commands, and return the number of commands that failed"""
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    tasks = [(argv, cwd) for argv in commands]
+    if jobs == 1 or len(tasks) <= 1:
+        results = (run_tool(*t) for t in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        results = pool.imap(_run_tool, tasks)
+
+    failed = 0
+    try:
+        for (argv, (status, out, err)) in zip(commands, results):
+            sys.stdout.write(out)
+            sys.stdout.flush()
+            sys.stderr.write(err)
+            if status:
+                sys.stderr.write("%s: exit status %d\n"%(" ".join(argv), status))
+                failed += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
+
+class _Shutdown(Exception):
+    pass
+
+def _raise_shutdown(signum, frame):
+    raise _Shutdown()
+
+def serve(path, jobs=None):
+    """Run commands sent to the Unix socket at path (see remote.run) in a
+    pool of jobs processes, which keep the compiler modules loaded and its
+    caches warm, until a shutdown request or SIGTERM"""
+    if os.path.exists(path):
+        try:
+            remote.request(path, {})
+        except socket.error:
+            os.unlink(path) # left over from a server that was killed
+        else:
+            raise Exception("A server is already listening on %s"%path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    pool = multiprocessing.Pool(jobs)
+    signal.signal(signal.SIGTERM, _raise_shutdown)
+    try:
+        while True:
+            connection, address = listener.accept()
+            try:
+                message = remote.receive(connection)
+                argv = [a.encode('utf-8') for a in message.get('argv', ())]
+                cwd = message.get('cwd')
+            except (ValueError, AttributeError, socket.error) as e:
+                _reply(connection, (1, "", "Bad request: %s\n"%e))
+                continue
+            if message.get('shutdown'):
+                _reply(connection, (0, "", ""))
+                break
+            if not argv:
+                _reply(connection, (0, "", "")) # a ping
+                continue
+            pool.apply_async(run_tool, (argv, cwd and cwd.encode('utf-8')), callback=lambda result, connection=connection: _reply(connection, result))
+    except _Shutdown:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        listener.close()
+        os.unlink(path)
+        pool.close()
+        pool.join()
+
+def _reply(connection, (status, out, err)):
+    try:
+        remote.send(connection, {'status': status, 'stdout': out, 'stderr': err})
+    except socket.error:
+        pass # the client went away
+    finally:
+        connection.close()
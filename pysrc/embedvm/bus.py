@@ -0,0 +1,126 @@
+from .util import signext
+
+PAGE_SIZE = 256
+
+class MemoryFault(Exception):
+    """The VM wrote to a write protected page"""
+
+class Device(object):
+    """Base class for memory mapped devices. Subclasses override read8 and
+    write8 (addresses are absolute); by default a device reads as 0 and
+    ignores writes."""
+    def read8(self, address):
+        return 0
+
+    def write8(self, address, value):
+        pass
+
+class Register(Device):
+    """A device of callbacks: ``read()`` and ``write(value)`` get the
+    offset from the first address the device is mapped to as first
+    argument"""
+    def __init__(self, base, read=None, write=None):
+        self.base = base
+        self.read = read
+        self.write = write
+
+    def read8(self, address):
+        return self.read(address - self.base) & 0xff if self.read is not None else 0
+
+    def write8(self, address, value):
+        if self.write is not None:
+            self.write(address - self.base, value)
+
+class _Protected(object):
+    def write8(self, address, value):
+        raise MemoryFault("Write to protected address %04x"%address)
+
+class MemoryBus(object):
+    """The memory of a vm.VM, made of 256-byte pages that are either RAM (a
+    plain bytearray that the VM accesses directly) or belong to a
+    :class:`Device`, and can be write protected.
+
+    Pass the bus as memory when creating the VM. Instructions are always
+    fetched from RAM, and VM.load writes to RAM regardless of the page
+    mapping and protection."""
+
+    def __init__(self, ram=None):
+        self.ram = ram if ram is not None else bytearray(0x10000)
+        # None for RAM, otherwise the object that handles accesses
+        self.read_pages = [None] * (0x10000 // PAGE_SIZE)
+        self.write_pages = [None] * (0x10000 // PAGE_SIZE)
+        self._protected = _Protected()
+
+    @staticmethod
+    def _pages(start, end):
+        if start % PAGE_SIZE or end % PAGE_SIZE:
+            raise Exception("Memory can only be mapped in whole pages of %d bytes"%PAGE_SIZE)
+        return range(start // PAGE_SIZE, end // PAGE_SIZE)
+
+    def map(self, start, end, device):
+        """Let device handle the addresses from start to end (exclusive)"""
+        for page in self._pages(start, end):
+            self.read_pages[page] = self.write_pages[page] = device
+
+    def unmap(self, start, end):
+        """Make the addresses from start to end RAM again"""
+        for page in self._pages(start, end):
+            self.read_pages[page] = self.write_pages[page] = None
+
+    def protect(self, start, end):
+        """Write protect the pages that contain addresses from start to end
+        (exclusive), e.g. the code of a program"""
+        for page in range(start // PAGE_SIZE, -(-end // PAGE_SIZE)):
+            self.write_pages[page] = self._protected
+
+    def read8(self, address):
+        device = self.read_pages[address >> 8]
+        if device is None:
+            return self.ram[address]
+        return device.read8(address)
+
+    def write8(self, address, value):
+        device = self.write_pages[address >> 8]
+        if device is None:
+            self.ram[address] = value
+        else:
+            device.write8(address, value)
+
+    def install(self, vm):
+        """Replace the memory accessors of vm by ones that go through the
+        bus; the VM calls this when it is created with a bus as memory"""
+        ram = self.ram
+        read_pages = self.read_pages
+        write_pages = self.write_pages
+        read8 = self.read8
+        write8 = self.write8
+
+        def vm_read8(address):
+            address &= 0xffff
+            if read_pages[address >> 8] is None:
+                return ram[address]
+            return read8(address)
+
+        def vm_read16(address):
+            address &= 0xffff
+            if read_pages[address >> 8] is None and address & 0xff != 0xff:
+                return signext((ram[address] << 8) | ram[address + 1], 0xffff)
+            return signext((read8(address) << 8) | read8((address + 1) & 0xffff), 0xffff)
+
+        def vm_write8(address, value):
+            address &= 0xffff
+            if write_pages[address >> 8] is None:
+                ram[address] = value & 0xff
+            else:
+                write8(address, value & 0xff)
+
+        def vm_write16(address, value):
+            address &= 0xffff
+            if write_pages[address >> 8] is None and address & 0xff != 0xff:
+                ram[address] = (value >> 8) & 0xff
+                ram[address + 1] = value & 0xff
+            else:
+                write8(address, (value >> 8) & 0xff)
+                write8((address + 1) & 0xffff, value & 0xff)
+
+        vm.read8, vm.read16, vm.write8, vm.write16 = vm_read8, vm_read16, vm_write8, vm_write16
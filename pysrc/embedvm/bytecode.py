@@ -11,6 +11,11 @@ class ByteCodeCommand(object):
     length = property(lambda self: self.nargs + 1)
     commandmask = 0xff
 
+    # stack effect and control flow, see verify.py
+    pops = 0 # values the command takes from the stack
+    pushes = 0 # values the command puts on the stack
+    falls_through = True # whether the next command can be executed after this one
+
     @classmethod
     def from_bin(cls, data, offset):
         assert cls.check_match(data[offset])
@@ -87,20 +92,24 @@ class SFACommand(ByteCodeCommand):
 class PushLocal(SFACommand):
     command = 0x00
     commandmask = 0xc0
+    pushes = 1
 
 class PopLocal(SFACommand):
     command = 0x40
     commandmask = 0xc0
+    pops = 1
 
 class UnaryOperator(ByteCodeCommand):
-    pass
+    pops = 1
+    pushes = 1
 
 class BitwiseNot(UnaryOperator): command = 0x8c
 class ArithmeticInvert(UnaryOperator): command = 0x8d
 class LogicNot(UnaryOperator): command = 0x8e
 
 class BinaryOperator(ByteCodeCommand):
-    pass
+    pops = 2
+    pushes = 1
 
 class Add(BinaryOperator): command = 0x80
 class Sub(BinaryOperator): command = 0x81
@@ -116,6 +125,8 @@ class LogicAnd(BinaryOperator): command = 0x8a
 class LogicOr(BinaryOperator): command = 0x8b
 
 class PushConstant(ByteCodeCommand):
+    pushes = 1
+
     def generalize(self, own_position):
         return PushConstantV(value=self.value)
 
@@ -123,6 +134,7 @@ class PushConstantV(VariableLengthCommand):
     def __init__(self, value):
         self.value = value
     nargs = 2 # maximum
+    pushes = 1
 
     def _get_real_command(self):
         if self.nargs == 2:
@@ -213,14 +225,29 @@ class Push16(PushData):
         self._check()
         return [self.command, ((self.value & 0xffff) >> 8)%256, (self.value & 0xff)%256]
 
-class Return(ByteCodeCommand): command = 0x9b
-
-class Return0(Return): command = 0x9c
-
-class DropValue(ByteCodeCommand): command = 0x9d
-
-class CallAddress(ByteCodeCommand): command = 0x9e
-class JumpToAddress(ByteCodeCommand): command = 0x9f
+class Return(ByteCodeCommand):
+    command = 0x9b
+    pops = 1
+    falls_through = False
+
+class Return0(Return):
+    command = 0x9c
+    pops = 0
+
+class DropValue(ByteCodeCommand):
+    command = 0x9d
+    pops = 1
+
+# a call directly followed by a DropValue returns behind the DropValue
+# without pushing a value, which has the same stack effect as executing it
+class CallAddress(ByteCodeCommand):
+    command = 0x9e
+    pops = 1
+    pushes = 1
+class JumpToAddress(ByteCodeCommand):
+    command = 0x9f
+    pops = 1
+    falls_through = False
 
 class VariableAddressCommand(VariableLengthCommand):
     def __init__(self, address):
@@ -233,6 +260,10 @@ class VariableAddressCommand(VariableLengthCommand):
         else:
             self.nargs = 2
 
+    def target(self, own_position):
+        """Address the command jumps to or calls (once fixed)"""
+        return (own_position + self.reladdr) & 0xffff
+
     def _get_real_command(self):
         if self.nargs == 1:
             return self.shortcommand(reladdr=self.reladdr)
@@ -246,6 +277,10 @@ class RelativeAddressCommand(ByteCodeCommand):
     def generalize(self, own_position):
         return self.generalized(address=own_position + self.reladdr)
 
+    def target(self, own_position):
+        """Address the command jumps to or calls"""
+        return (own_position + self.reladdr) & 0xffff
+
 class RelativeAddressCommand1(RelativeAddressCommand):
     nargs = 1
     def set_from_data(self, data, offset):
@@ -273,7 +308,7 @@ class RelativeAddressCommand2(RelativeAddressCommand):
 class JumpCommand(object):
     pass
 class UnconditionalJumpCommand(JumpCommand):
-    pass
+    falls_through = False
 class JumpV(UnconditionalJumpCommand, VariableAddressCommand):
     pass
 class JumpRel1(UnconditionalJumpCommand, RelativeAddressCommand1):
@@ -284,7 +319,7 @@ class JumpRel2(UnconditionalJumpCommand, RelativeAddressCommand2):
     generalized = JumpV
 JumpV.shortcommand, JumpV.longcommand = JumpRel1, JumpRel2
 class CallCommand(object):
-    pass
+    pushes = 1 # the return value, see CallAddress
 class CallV(CallCommand, VariableAddressCommand):
     pass
 class CallRel1(CallCommand, RelativeAddressCommand1):
@@ -295,7 +330,7 @@ class CallRel2(CallCommand, RelativeAddressCommand2):
     generalized = CallV
 CallV.shortcommand, CallV.longcommand = CallRel1, CallRel2
 class JumpIfCommand(JumpCommand):
-    pass
+    pops = 1
 class JumpVIf(JumpIfCommand, VariableAddressCommand):
     pass
 class JumpRel1If(JumpIfCommand, RelativeAddressCommand1):
@@ -306,7 +341,7 @@ class JumpRel2If(JumpIfCommand, RelativeAddressCommand2):
     generalized = JumpVIf
 JumpVIf.shortcommand, JumpVIf.longcommand = JumpRel1If, JumpRel2If
 class JumpIfNotCommand(JumpCommand):
-    pass
+    pops = 1
 class JumpVIfNot(JumpIfNotCommand, VariableAddressCommand):
     pass
 class JumpRel1IfNot(JumpIfNotCommand, RelativeAddressCommand1):
@@ -326,12 +361,16 @@ class CompareGT(BinaryOperator): command = 0xad
 
 class StackPointer(ByteCodeCommand):
     command = 0xae
+    pushes = 1
 class StackFramePointer(ByteCodeCommand):
     command = 0xaf
+    pushes = 1
 
 class CallUserFunction(ByteCodeCommand):
     command = 0xb0
     commandmask = 0xf0
+    pops = 1 # plus as many arguments as the popped value says
+    pushes = 1
 
     def __init__(self, funcid):
         self.funcid = funcid
@@ -392,8 +431,11 @@ class GlobalAccess(ByteCodeCommand):
         elif self.nargs == 2:
             return [self.command | self.NARGSPOP2M[self.nargs, self.popoffset], self.address>>8, self.address%256]
 
-class GlobalLoad(GlobalAccess): pass
-class GlobalStore(GlobalAccess): pass
+class GlobalLoad(GlobalAccess):
+    pops = property(lambda self: int(self.popoffset))
+    pushes = 1
+class GlobalStore(GlobalAccess):
+    pops = property(lambda self: 1 + int(self.popoffset))
 class GlobalU8(GlobalAccess): pass
 class GlobalS8(GlobalAccess): pass
 class Global16(GlobalAccess): pass
@@ -424,8 +466,14 @@ class StackAccess(ByteCodeCommand):
         self._check()
         return [self.command | (self.k & 0x07) << 3]
 
-class Bury(StackAccess): command = 0xc5
-class Dig(StackAccess): command = 0xc6
+class Bury(StackAccess):
+    command = 0xc5
+    pops = property(lambda self: self.k + 1)
+    pushes = property(lambda self: self.k + 2)
+class Dig(StackAccess):
+    command = 0xc6
+    pops = property(lambda self: self.k + 2)
+    pushes = property(lambda self: self.k + 2)
 
 class StackShoveling(ByteCodeCommand):
     commandmask = 0xf8
@@ -445,9 +493,12 @@ class StackShoveling(ByteCodeCommand):
 
 class PushZeros(StackShoveling):
     command = 0xf0
+    pushes = property(lambda self: self.n + 1)
 
 class PopMany(StackShoveling):
     command = 0xf8
+    pops = property(lambda self: self.n + 2)
+    pushes = 1
 
 class Label(ByteCodeCommand):
     """Like a byte code, but results in null-length bytecode and can be used
@@ -466,6 +517,18 @@ class Label(ByteCodeCommand):
         if export is not None:
             self.export = export
 
+    @staticmethod
+    def counter():
+        """Number of labels created so far (the last generated id is
+        "label<counter>")"""
+        return Label.__instancecounter
+
+    @staticmethod
+    def reset_counter(n=0):
+        """Continue numbering labels after n, e.g. with 0 to get the same
+        ids as in a fresh process"""
+        Label.__instancecounter = n
+
     def to_bin(self):
         return []
 
@@ -0,0 +1,173 @@
+import ast
+import hashlib
+import marshal
+import os
+import tempfile
+
+FORMAT_VERSION = 1
+
+def _source_file(module):
+    filename = getattr(module, '__file__', None)
+    if filename is None:
+        return None
+    if filename.endswith(('.pyc', '.pyo')) and os.path.exists(filename[:-1]):
+        filename = filename[:-1]
+    return filename
+
+def _hash_file(h, filename):
+    h.update(filename + "\0")
+    with open(filename, 'rb') as f:
+        h.update(f.read())
+
+_compiler_version = None
+
+def compiler_version():
+    """Hash of the sources of the embedvm package, so that cached results
+    are not used by a different compiler (computed once per process, as a
+    process keeps running the compiler it started with)"""
+    global _compiler_version
+    if _compiler_version is None:
+        h = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                _hash_file(h, os.path.join(directory, name))
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+def imported_modules(source):
+    """Names of the modules a program imports from (the modules that provide
+    its Importables)"""
+    return sorted(set(node.module for node in ast.parse(source).body if isinstance(node, ast.ImportFrom)))
+
+def hash_environment(h, modules):
+    """Add the compiler and the sources of the named modules (those a
+    program imports from) to the hash h"""
+    h.update("%d\0%s\0"%(FORMAT_VERSION, compiler_version()))
+    for name in modules:
+        module = __import__(name, fromlist=['__name__'])
+        filename = _source_file(module)
+        if filename is not None:
+            _hash_file(h, filename)
+        else:
+            h.update(name + "\0")
+
+def cache_key(source, options=()):
+    """Key for the compilation of source: a hash of the source, the
+    compiler, the sources of the modules the program imports from, and the
+    compiler options ((name, value) pairs that influence the outputs)"""
+    h = hashlib.sha1()
+    hash_environment(h, imported_modules(source))
+    h.update(repr(sorted(options)) + "\0")
+    h.update(source)
+    return h.hexdigest()
+
+class CompileCache(object):
+    """A directory of compilation results (dicts of output name to string),
+    one file per result, named after its key (see :func:`cache_key`).
+
+    When the files take more than max_size bytes, the least recently used
+    ones (by modification time, which is updated on every hit) are removed.
+    Hits, misses and evictions are counted in a ``stats`` file in the
+    directory."""
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _write_atomically(self, path, data):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def get(self, key):
+        """Return the outputs stored under key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                outputs = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            self._count('misses')
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass # evicted by a concurrent build in the meantime
+        self._count('hits')
+        return outputs
+
+    def put(self, key, outputs):
+        self._write_atomically(self._path(key), marshal.dumps(outputs))
+        self.evict()
+
+    def entries(self):
+        """Return (modification time, size, path) of all cached results"""
+        result = []
+        for sub in os.listdir(self.directory):
+            subdirectory = os.path.join(self.directory, sub)
+            if not os.path.isdir(subdirectory):
+                continue
+            for name in os.listdir(subdirectory):
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(subdirectory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for (mtime, size, path) in entries)
+        evicted = 0
+        while entries and total > self.max_size:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+            evicted += 1
+        if evicted:
+            self._count('evictions', evicted)
+
+    ############ statistics ############
+
+    def stats(self):
+        """Return {'hits': n, 'misses': n, 'evictions': n}"""
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        try:
+            with open(os.path.join(self.directory, 'stats'), 'rb') as f:
+                stats.update(marshal.load(f))
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        return stats
+
+    def _count(self, name, n=1):
+        # not locked: concurrent builds may lose a count, never corrupt the file
+        stats = self.stats()
+        stats[name] += n
+        self._write_atomically(os.path.join(self.directory, 'stats'), marshal.dumps(stats))
+
+    def report(self):
+        stats = self.stats()
+        entries = self.entries()
+        lookups = stats['hits'] + stats['misses']
+        return "%d hits, %d misses (%s hit rate), %d evictions; %d entries, %d of %d bytes"%(
+                stats['hits'], stats['misses'], "%.1f%%"%(100.0 * stats['hits'] / lookups) if lookups else "no",
+                stats['evictions'], len(entries), sum(size for (mtime, size, path) in entries), self.max_size)
@@ -0,0 +1,316 @@
+import collections
+
+from . import bytecode
+
+class CostModel(object):
+    """Execution time of bytecode commands on a target, in cycles.
+
+    ``costs`` maps names of bytecode command classes to cycles; the most
+    specific class of a command (following its MRO) that is given decides.
+    Every argument byte of a command costs ``argument_byte`` on top, 16-bit
+    global memory accesses ``global16`` and user function calls ``userfunc``
+    (which does not include the time the user function itself takes)."""
+
+    def __init__(self, costs, argument_byte=0, global16=0, userfunc=0, frequency=16000000, name=None):
+        self.costs = dict(costs)
+        self.argument_byte = argument_byte
+        self.global16 = global16
+        self.userfunc = userfunc
+        self.frequency = frequency
+        self.name = name
+
+    def derive(self, costs={}, **kwargs):
+        """Return a copy of the model with some costs changed"""
+        new_costs = dict(self.costs)
+        new_costs.update(costs)
+        args = dict(argument_byte=self.argument_byte, global16=self.global16, userfunc=self.userfunc, frequency=self.frequency, name=self.name)
+        args.update(kwargs)
+        return type(self)(new_costs, **args)
+
+    def command_cost(self, command):
+        for cls in type(command).__mro__:
+            if cls.__name__ in self.costs:
+                cost = self.costs[cls.__name__]
+                break
+        else:
+            raise Exception("No cost given for %s"%type(command).__name__)
+        cost += self.argument_byte * (command.length - 1)
+        if isinstance(command, bytecode.Global16):
+            cost += self.global16
+        if isinstance(command, bytecode.CallUserFunction):
+            cost += self.userfunc
+        return cost
+
+    def table(self):
+        """Return the cost of every opcode as a list indexed by opcode, as
+        used by simulation.Simulation. Reserved opcodes cost 0."""
+        result = []
+        for op in range(256):
+            try:
+                command = bytecode.interpret([op, 0, 0], 0)
+            except (bytecode.UnknownCommand, AssertionError):
+                result.append(0)
+                continue
+            result.append(self.command_cost(command))
+        return result
+
+    def seconds(self, cycles):
+        return float(cycles) / self.frequency
+
+# Rough figures for vmsrc/embedvm.c compiled with avr-gcc -Os, where every
+# memory access goes through the host's callbacks; they average to the
+# README's 75 instructions per millisecond at 16MHz on typical code.
+ATMEGA168 = CostModel({
+        'ByteCodeCommand': 150,
+        'PushLocal': 190,
+        'PopLocal': 190,
+        'UnaryOperator': 180,
+        'BinaryOperator': 250,
+        'Mul': 290,
+        'Div': 540,
+        'Mod': 540,
+        'ShiftLeft': 300,
+        'ShiftRight': 300,
+        'PushConstant': 140,
+        'Return': 330,
+        'Return0': 300,
+        'DropValue': 120,
+        'CallAddress': 320,
+        'JumpToAddress': 170,
+        'CallCommand': 320,
+        'UnconditionalJumpCommand': 160,
+        'JumpIfCommand': 220,
+        'JumpIfNotCommand': 220,
+        'StackPointer': 140,
+        'StackFramePointer': 140,
+        'CallUserFunction': 240,
+        'GlobalAccess': 200,
+        'StackAccess': 340,
+        'PushZeros': 170,
+        'PopMany': 210,
+        },
+        argument_byte=30, global16=50, userfunc=60, frequency=16000000, name='atmega168')
+
+# every command takes the same time, like simulation.Simulation's default
+UNIFORM = CostModel({'ByteCodeCommand': 213}, name='uniform')
+
+TARGETS = dict((m.name, m) for m in (ATMEGA168, UNIFORM))
+
+def dynamic_costs(profiler, model):
+    """Sum up the cost of the instructions counted by a profiler.Profiler,
+    by function"""
+    table = model.table()
+    memory = profiler.vm.memory
+    result = collections.defaultdict(int)
+    for (address, count) in profiler.by_address().items():
+        result[profiler.function(address)] += count * table[memory[address]]
+    return dict(result)
+
+class LoopEstimate(object):
+    """Best and worst case cycles of one iteration of a loop (inner loops
+    not repeated), and the bound on its iterations if one was given"""
+    def __init__(self, header, best, worst, bound=None):
+        self.header = header
+        self.best = best
+        self.worst = worst
+        self.bound = bound
+
+class FunctionEstimate(object):
+    """Best and worst case cycles for a call of a function, with the
+    estimates of called functions included. The best case runs no loop
+    body; the worst case runs every loop as often as its bound allows, and
+    is None if it can't be bounded (eg. a loop without a bound, or a call
+    of such a function); ``unknown`` tells why."""
+    def __init__(self, entry):
+        self.entry = entry
+        self.best = self.worst = None
+        self.loops = []
+        self.calls = set()
+        self.unknown = set()
+
+class Estimator(object):
+    """Static execution time estimation of the code in a memory image,
+    following the control flow graph of every function.
+
+    Loops can only be bounded with the maximum number of iterations from
+    loop_bounds ({header address: iterations}) or, for all other loops,
+    max_iterations."""
+
+    def __init__(self, memory, model=ATMEGA168, symbols=None, loop_bounds=None, max_iterations=None):
+        self.memory = memory
+        self.model = model
+        self.symbols = symbols
+        self.loop_bounds = dict(loop_bounds or {})
+        self.max_iterations = max_iterations
+        self.estimates = {} # entry address -> FunctionEstimate
+        self._in_progress = set()
+
+    def name(self, address):
+        name = self.symbols.function_at(address) if self.symbols is not None else None
+        if name is None or self.symbols[name] != address:
+            return "%04x"%address
+        return name
+
+    def _successors(self, pos, command, estimate):
+        """Return the addresses that can be executed after command, and the
+        called function if any"""
+        next = pos + command.length
+        if isinstance(command, bytecode.Return):
+            return [], None
+        if isinstance(command, bytecode.RelativeAddressCommand):
+            target = (pos + command.reladdr) & 0xffff
+            if isinstance(command, bytecode.UnconditionalJumpCommand):
+                return [target], None
+            elif isinstance(command, bytecode.CallCommand):
+                # see VM._call: a DropValue after a call is skipped
+                if self.memory[next] == bytecode.DropValue.command:
+                    next += 1
+                return [next], target
+            return [next, target], None
+        if isinstance(command, bytecode.JumpToAddress):
+            estimate.unknown.add("computed jump at %04x"%pos)
+            return [], None
+        if isinstance(command, bytecode.CallAddress):
+            estimate.unknown.add("computed call at %04x"%pos)
+        return [next], None
+
+    def estimate(self, entry):
+        if entry in self.estimates:
+            return self.estimates[entry]
+        if entry in self._in_progress:
+            return None
+
+        self._in_progress.add(entry)
+        estimate = FunctionEstimate(entry)
+        memory = self.memory
+
+        # decode and build the control flow graph, one node per command
+        cost = {}
+        successors = {}
+        pending = [entry]
+        while pending:
+            pos = pending.pop()
+            if pos in cost:
+                continue
+            command = bytecode.interpret(memory, pos)
+            succ, callee = self._successors(pos, command, estimate)
+            cost[pos] = (self.model.command_cost(command),) * 2
+            if callee is not None:
+                estimate.calls.add(callee)
+                called = self.estimate(callee)
+                if called is None:
+                    estimate.unknown.add("recursion into %s"%self.name(callee))
+                    # lower bound: the call itself
+                    cost[pos] = (cost[pos][0], None)
+                else:
+                    estimate.unknown.update(called.unknown)
+                    cost[pos] = (cost[pos][0] + called.best, None if called.worst is None else cost[pos][1] + called.worst)
+            successors[pos] = succ
+            pending.extend(succ)
+
+        # depth first search for the back edges and a topological order
+        order = []
+        back_edges = set()
+        state = {entry: 1} # 1: on the stack, 2: done
+        stack = [(entry, iter(successors[entry]))]
+        while stack:
+            (node, children) = stack[-1]
+            for child in children:
+                if state.get(child) == 1:
+                    back_edges.add((node, child))
+                elif child not in state:
+                    state[child] = 1
+                    stack.append((child, iter(successors[child])))
+                    break
+            else:
+                stack.pop()
+                state[node] = 2
+                order.append(node)
+        order.reverse()
+        forward = dict((n, [s for s in successors[n] if (n, s) not in back_edges]) for n in successors)
+
+        estimate.best, estimate.worst = self._paths(order, forward, cost, entry, [n for n in order if not successors[n]])
+
+        # loops: all nodes that reach a back edge's tail without passing the header
+        predecessors = collections.defaultdict(list)
+        for (n, succ) in successors.items():
+            for s in succ:
+                predecessors[s].append(n)
+        tails = collections.defaultdict(set)
+        for (tail, header) in back_edges:
+            tails[header].add(tail)
+        bodies = {}
+        for (header, header_tails) in sorted(tails.items()):
+            body = set([header])
+            pending = list(header_tails)
+            while pending:
+                n = pending.pop()
+                if n not in body:
+                    body.add(n)
+                    pending.extend(predecessors[n])
+            bodies[header] = body
+            inner = dict((n, [s for s in forward[n] if s in body]) for n in body)
+            best, worst = self._paths([n for n in order if n in body], inner, cost, header, header_tails)
+            bound = self.loop_bounds.get(header, self.max_iterations)
+            estimate.loops.append(LoopEstimate(header, best, worst, bound))
+
+        # the paths above run no loop body: add every iteration of the
+        # loops, inner ones once per iteration of the enclosing loop
+        def directly_inside(headers):
+            return [h for h in headers if not any(h in bodies[o] for o in headers if o != h)]
+        repeated = {}
+        for loop in sorted(estimate.loops, key=lambda l: len(bodies[l.header])):
+            if loop.bound is None:
+                estimate.unknown.add("loop at %04x without a bound"%loop.header)
+            nested = [repeated[h] for h in directly_inside([h for h in bodies[loop.header] if h in bodies and h != loop.header])]
+            if loop.bound is None or loop.worst is None or None in nested:
+                repeated[loop.header] = None
+            else:
+                repeated[loop.header] = loop.bound * (loop.worst + sum(nested))
+        outer = [repeated[h] for h in directly_inside(list(bodies))]
+        if estimate.worst is not None:
+            estimate.worst = None if None in outer else estimate.worst + sum(outer)
+
+        self._in_progress.discard(entry)
+        self.estimates[entry] = estimate
+        return estimate
+
+    @staticmethod
+    def _paths(order, forward, cost, start, ends):
+        """Shortest and longest path from start to any of ends through the
+        acyclic graph forward, nodes in topological order"""
+        best = {start: cost[start][0]}
+        worst = {start: cost[start][1]}
+        for n in order:
+            if n not in best:
+                continue
+            for s in forward[n]:
+                b = best[n] + cost[s][0]
+                w = None if worst[n] is None or cost[s][1] is None else worst[n] + cost[s][1]
+                if s not in best:
+                    best[s], worst[s] = b, w
+                else:
+                    best[s] = min(best[s], b)
+                    worst[s] = None if worst[s] is None or w is None else max(worst[s], w)
+        reached = [e for e in ends if e in best]
+        if not reached:
+            return None, None
+        worsts = [worst[e] for e in reached]
+        return min(best[e] for e in reached), (None if None in worsts else max(worsts))
+
+    def report(self, entries=None):
+        """Return a table of the estimates for the given entry addresses
+        (default: all code symbols) as a string"""
+        if entries is None:
+            entries = [address for (address, name) in self.symbols.functions()]
+        fmt = lambda cycles: "%10s %9s"%("unbounded", "") if cycles is None else "%10d %7.3fms"%(cycles, 1000 * self.model.seconds(cycles))
+        lines = ["%-24s %20s %20s"%("function / loop", "best", "worst")]
+        for entry in entries:
+            e = self.estimate(entry)
+            lines.append("%-24s %s %s"%(self.name(entry), fmt(e.best), fmt(e.worst)))
+            for loop in e.loops:
+                label = "  loop at %04x"%loop.header + ("" if loop.bound is None else " x%d"%loop.bound)
+                lines.append("%-24s %s %s"%(label, fmt(loop.best), fmt(loop.worst)))
+            for reason in sorted(e.unknown):
+                lines.append("  (%s)"%reason)
+        return "\n".join(lines)
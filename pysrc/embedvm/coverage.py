@@ -0,0 +1,237 @@
+from . import asm
+from . import bytecode
+from .fastvm import FastVM
+
+MAGIC = "EVMC"
+VERSION = 1
+BITMAP_SIZE = 0x10000 // 8
+
+def _conditional(command):
+    return isinstance(command, (bytecode.JumpIfCommand, bytecode.JumpIfNotCommand))
+
+def static_code(data, entry_points):
+    """Return {position: command} of the code reachable from entry_points in
+    a memory image, the instructions coverage is measured against"""
+    program = asm.ASM()
+    program.read_binary(list(bytearray(data)), list(entry_points))
+    code = {}
+    for b in program.blocks:
+        if isinstance(b, asm.FixedPositionCodeBlock):
+            code.update(b.code)
+    return code
+
+class Coverage(object):
+    """Records which instructions of a VM were executed, and which
+    directions of its conditional jumps were taken (jumped to the target)
+    or not taken (fell through), as bitmaps with one bit per address.
+
+    Bitmaps of several runs of the same image can be combined with
+    :meth:`merge`. For a vm.VM, coverage wraps the handlers in ``vm.ops``
+    like profiler.Profiler. For a fastvm.FastVM, it puts a probe in front of
+    every translated command that removes itself once there is nothing left
+    to record for the command, so a covered program runs at full speed."""
+
+    def __init__(self, vm=None):
+        self.vm = vm
+        self.executed = bytearray(BITMAP_SIZE)
+        self.taken = bytearray(BITMAP_SIZE)
+        self.not_taken = bytearray(BITMAP_SIZE)
+        self._original = None
+
+    def install(self):
+        vm = self.vm
+        if isinstance(vm, FastVM):
+            self._original = {} # position -> (probe, translation)
+            translate = vm._translate
+            def probing_translate(pos, command):
+                return self._probe(pos, command, translate(pos, command))
+            vm._translate = probing_translate
+            for (pos, execute) in enumerate(vm.code):
+                if execute is not None:
+                    try:
+                        command = bytecode.interpret(vm.memory, pos)
+                    except bytecode.UnknownCommand:
+                        command = None
+                    vm.code[pos] = self._probe(pos, command, execute)
+            return
+
+        self._original = list(vm.ops)
+        executed, taken, not_taken = self.executed, self.taken, self.not_taken
+
+        def marking(original):
+            def wrapped(op):
+                ip = vm.ip
+                executed[ip >> 3] |= 1 << (ip & 7)
+                original(op)
+            return wrapped
+
+        def branching(original, length):
+            def wrapped(op):
+                ip = vm.ip
+                byte, bit = ip >> 3, 1 << (ip & 7)
+                executed[byte] |= bit
+                original(op)
+                if vm.ip == ip + length:
+                    not_taken[byte] |= bit
+                else:
+                    taken[byte] |= bit
+            return wrapped
+
+        for op in range(256):
+            if 0xa4 <= op <= 0xa7:
+                vm.ops[op] = branching(vm.ops[op], 2 if op & 1 == 0 else 3)
+            else:
+                vm.ops[op] = marking(vm.ops[op])
+
+    def _probe(self, pos, command, execute):
+        code = self.vm.code
+        executed, taken, not_taken = self.executed, self.taken, self.not_taken
+        byte, bit = pos >> 3, 1 << (pos & 7)
+
+        if not _conditional(command):
+            def probe():
+                executed[byte] |= bit
+                code[pos] = execute
+                return execute()
+        else:
+            next = pos + command.length
+            def probe():
+                executed[byte] |= bit
+                target = execute()
+                if target == next:
+                    not_taken[byte] |= bit
+                else:
+                    taken[byte] |= bit
+                if taken[byte] & not_taken[byte] & bit:
+                    code[pos] = execute
+                return target
+        self._original[pos] = (probe, execute)
+        return probe
+
+    def uninstall(self):
+        vm = self.vm
+        if isinstance(vm, FastVM):
+            del vm._translate
+            for (pos, (probe, execute)) in self._original.items():
+                if vm.code[pos] is probe:
+                    vm.code[pos] = execute
+        else:
+            vm.ops[:] = self._original
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+    ############ bitmaps ############
+
+    @staticmethod
+    def _test(bits, address):
+        return bool(bits[address >> 3] & (1 << (address & 7)))
+
+    def was_executed(self, address):
+        return self._test(self.executed, address)
+
+    def merge(self, other):
+        """Add the coverage recorded by another Coverage (e.g. of a parallel
+        run of the same image)"""
+        for (mine, theirs) in ((self.executed, other.executed), (self.taken, other.taken), (self.not_taken, other.not_taken)):
+            for i in xrange(BITMAP_SIZE):
+                mine[i] |= theirs[i]
+
+    def to_binary(self):
+        return MAGIC + chr(VERSION) + str(self.executed) + str(self.taken) + str(self.not_taken)
+
+    @classmethod
+    def from_binary(cls, data):
+        if data[:4] != MAGIC or ord(data[4]) != VERSION or len(data) != 5 + 3 * BITMAP_SIZE:
+            raise Exception("Not a coverage file")
+        coverage = cls()
+        bitmaps = [bytearray(data[5 + i * BITMAP_SIZE:5 + (i + 1) * BITMAP_SIZE]) for i in range(3)]
+        coverage.executed, coverage.taken, coverage.not_taken = bitmaps
+        return coverage
+
+    def write(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_binary())
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.from_binary(f.read())
+
+    ############ reports ############
+
+    def _summarize(self, code, key):
+        """Return {key(position): [executed, instructions, directions taken,
+        directions]} over the commands in code"""
+        result = {}
+        for (pos, command) in code.items():
+            counts = result.setdefault(key(pos), [0, 0, 0, 0])
+            counts[1] += 1
+            if self.was_executed(pos):
+                counts[0] += 1
+            if _conditional(command):
+                counts[3] += 2
+                counts[2] += self._test(self.taken, pos) + self._test(self.not_taken, pos)
+        return result
+
+    def by_function(self, code, symbols=None):
+        """Return {function name: [executed, instructions, branch directions
+        covered, branch directions]} for the commands in code (see
+        :func:`static_code`); without symbols, everything is counted under
+        None"""
+        return self._summarize(code, symbols.function_at if symbols is not None else lambda pos: None)
+
+    def by_line(self, code, lines):
+        """Like by_function, per source line of a lines.LineTable"""
+        return self._summarize(code, lines.lookup)
+
+    def missed_branches(self, code):
+        """Return (position, direction) for every conditional jump that was
+        executed but only ever went one way; direction is "taken" or "not
+        taken", whichever never happened"""
+        result = []
+        for (pos, command) in sorted(code.items()):
+            if _conditional(command) and self.was_executed(pos):
+                if not self._test(self.taken, pos):
+                    result.append((pos, "taken"))
+                elif not self._test(self.not_taken, pos):
+                    result.append((pos, "not taken"))
+        return result
+
+    def report(self, code, symbols=None, lines=None):
+        """Return coverage tables per function and line and the list of
+        partially covered branches as a string"""
+        percent = lambda part, whole: "%5.1f%%"%(100.0 * part / whole) if whole else "     -"
+        row = lambda (executed, total, directions, branches), label: "%5d/%-5d %s  %3d/%-3d %s  %s"%(
+                executed, total, percent(executed, total), directions, branches, percent(directions, branches), label)
+        header = "%-11s %6s  %-7s %6s  %s"%("insns", "", "branch", "", "%s")
+
+        lines_out = [header%"function"]
+        for (name, counts) in sorted(self.by_function(code, symbols).items()):
+            lines_out.append(row(counts, name or "(unknown)"))
+        total = [sum(c) for c in zip(*self._summarize(code, lambda pos: None).values())] or [0, 0, 0, 0]
+        lines_out.append(row(total, "total"))
+
+        if lines is not None:
+            lines_out.append("")
+            lines_out.append(header%"line")
+            for (line, counts) in sorted(self.by_line(code, lines).items()):
+                if line is not None:
+                    lines_out.append(row(counts, "%s:%d"%(lines.filename, line)))
+
+        missed = self.missed_branches(code)
+        if missed:
+            lines_out.append("")
+            lines_out.append("partially covered branches:")
+            for (pos, direction) in missed:
+                where = [("%04x"%pos)]
+                if symbols is not None and symbols.function_at(pos):
+                    where.append("in %s"%symbols.function_at(pos))
+                if lines is not None and lines.lookup(pos):
+                    where.append("at %s:%d"%(lines.filename, lines.lookup(pos)))
+                lines_out.append("  %s: never %s"%(" ".join(where), direction))
+        return "\n".join(lines_out)
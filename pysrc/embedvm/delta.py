@@ -0,0 +1,62 @@
+import struct
+import zlib
+
+MAGIC = "EVMD"
+VERSION = 1
+
+_INFO = ">IIIII" # lengths and checksums of the old and new image, number of runs
+# an unchanged stretch shorter than a run header is cheaper to send along
+_HEADER = struct.Struct(">HH") # offset and length of a run
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def make_delta(old, new):
+    """Return a delta that turns the image old into new (both strings):
+    the runs of bytes that differ, each as offset, length and the new
+    bytes, after a header with the image lengths and checksums"""
+    differs = lambda i: i >= len(old) or old[i] != new[i]
+    runs = []
+    length = len(new)
+    pos = 0
+    while pos < length:
+        if not differs(pos):
+            pos += 1
+            continue
+        start = end = pos # end: after the last differing byte of the run
+        while pos < length and pos - start < 0xffff:
+            if differs(pos):
+                end = pos + 1
+            elif pos - end >= _HEADER.size:
+                break
+            pos += 1
+        runs.append((start, new[start:end]))
+        pos = end
+
+    parts = [MAGIC, chr(VERSION), struct.pack(_INFO, len(old), length, _crc(old), _crc(new), len(runs))]
+    for (offset, data) in runs:
+        parts.append(_HEADER.pack(offset, len(data)))
+        parts.append(data)
+    return "".join(parts)
+
+def apply_delta(old, delta):
+    """Return the image that delta (see make_delta) makes of old; raise an
+    Exception if delta was made for a different image"""
+    if delta[:4] != MAGIC or ord(delta[4]) != VERSION:
+        raise Exception("Not an image delta")
+    old_length, new_length, old_crc, new_crc, count = struct.unpack_from(_INFO, delta, 5)
+    if len(old) != old_length or _crc(old) != old_crc:
+        raise Exception("The delta was made for a different image")
+
+    new = bytearray(old[:new_length])
+    new.extend("\0" * (new_length - len(new)))
+    pos = 5 + struct.calcsize(_INFO)
+    for i in range(count):
+        offset, length = _HEADER.unpack_from(delta, pos)
+        pos += _HEADER.size
+        new[offset:offset + length] = delta[pos:pos + length]
+        pos += length
+    new = str(new)
+    if _crc(new) != new_crc:
+        raise Exception("The delta is corrupt")
+    return new
@@ -0,0 +1,175 @@
+import collections
+import heapq
+import itertools
+import select
+import sys
+import time
+import types
+
+class Return(Exception):
+    """Raise this from a user function generator to return a value to the VM
+    (generators can't return values in Python 2)."""
+    def __init__(self, value=0):
+        super(Return, self).__init__(value)
+        self.value = value
+
+class Sleep(object):
+    """Yield this from a user function generator to wait for some seconds
+    without blocking other VMs"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Readable(object):
+    """Yield this from a user function generator to wait until the file (or
+    socket or file descriptor) can be read from"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+class Writable(object):
+    """Like Readable, but for writing"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+class EventLoop(object):
+    """Drives many VMs (see vm.VM) in a single thread.
+
+    User functions registered with the VMs may be generator functions (the
+    Python 2 way of writing coroutines). A VM that calls such a user function
+    gets suspended while the generator waits for what it yields (a
+    :class:`Sleep`, :class:`Readable`, :class:`Writable` or another generator
+    whose result is sent back in), and other VMs keep running in the
+    meantime. The value the VM sees as the result of the user function is
+    passed by raising :class:`Return`::
+
+        @UserfuncWrapper(3)
+        def read_sensor(channel):
+            yield Sleep(0.1)
+            raise Return(sensor_value(channel))
+
+    VMs that don't wait get to run for ``slice`` instructions before the next
+    one is served."""
+
+    def __init__(self, slice=1000, clock=time.time):
+        self.slice = slice
+        self.clock = clock
+        self.ready = collections.deque() # vms
+        self.sleeping = [] # heap of (wake up time, sequence number, vm)
+        self.readers = {} # fd -> list of waiting vms
+        self.writers = {} # fd -> list of waiting vms
+        self.coroutines = {} # vm -> stack of generators
+        self._sequence = itertools.count()
+
+    def add(self, vm):
+        """Schedule a VM that has been prepared to run (e.g. by
+        VM.interrupt)"""
+        self.ready.append(vm)
+
+    def __len__(self):
+        return len(self.ready) + len(self.sleeping) + sum(len(vms) for vms in self.readers.values() + self.writers.values())
+
+    def run(self):
+        """Run until all VMs are finished"""
+        while len(self):
+            self.run_once()
+
+    def run_once(self):
+        """Serve every VM that is ready once, then wait for the next sleeping
+        VM or file to become ready"""
+        for i in range(len(self.ready)):
+            self._serve(self.ready.popleft())
+
+        self._wait(0 if self.ready else None)
+
+    def _serve(self, vm):
+        if vm in self.coroutines:
+            self._advance(vm)
+            return
+
+        self._run_slice(vm)
+        if vm.waiting is not None:
+            self.coroutines[vm] = [vm.waiting]
+            self._advance(vm)
+        elif not vm.finished:
+            self.ready.append(vm)
+
+    def _run_slice(self, vm):
+        vm.run(self.slice)
+
+    def _advance(self, vm):
+        """Continue the generators vm is waiting for until one of them waits
+        for something or the user function is done"""
+        stack = self.coroutines[vm]
+        value = exception = None
+        while True:
+            try:
+                if exception is not None:
+                    exc, exception = exception, None
+                    waitfor = stack[-1].throw(*exc)
+                else:
+                    waitfor = stack[-1].send(value)
+            except Return as r:
+                result = r.value
+            except StopIteration:
+                result = 0
+            except Exception:
+                stack.pop()
+                if not stack:
+                    del self.coroutines[vm]
+                    raise
+                exception = sys.exc_info()
+                continue
+            else:
+                if isinstance(waitfor, types.GeneratorType):
+                    stack.append(waitfor)
+                    value = None
+                    continue
+                self._suspend(vm, waitfor)
+                return
+
+            stack.pop()
+            if stack:
+                value = result
+                continue
+
+            del self.coroutines[vm]
+            vm.resume(result)
+            if not vm.finished:
+                self.ready.append(vm)
+            return
+
+    def _suspend(self, vm, waitfor):
+        if isinstance(waitfor, Sleep):
+            heapq.heappush(self.sleeping, (self.clock() + waitfor.seconds, next(self._sequence), vm))
+        elif isinstance(waitfor, Readable):
+            self.readers.setdefault(self._fileno(waitfor.fileobj), []).append(vm)
+        elif isinstance(waitfor, Writable):
+            self.writers.setdefault(self._fileno(waitfor.fileobj), []).append(vm)
+        elif waitfor is None:
+            # plain yield: just let the others run
+            self.ready.append(vm)
+        else:
+            raise Exception("User function yielded %r, which the event loop can't wait for"%(waitfor,))
+
+    @staticmethod
+    def _fileno(fileobj):
+        return fileobj if isinstance(fileobj, int) else fileobj.fileno()
+
+    def _wait(self, timeout):
+        if self.sleeping:
+            until_wakeup = max(0, self.sleeping[0][0] - self.clock())
+            timeout = until_wakeup if timeout is None else min(timeout, until_wakeup)
+
+        if self.readers or self.writers:
+            readable, writable, _ = select.select(list(self.readers), list(self.writers), [], timeout)
+            # all VMs waiting for a file get to try it (the ones that find
+            # nothing left wait again)
+            for fd in readable:
+                self.ready.extend(self.readers.pop(fd))
+            for fd in writable:
+                self.ready.extend(self.writers.pop(fd))
+        elif timeout:
+            time.sleep(timeout)
+
+        now = self.clock()
+        while self.sleeping and self.sleeping[0][0] <= now:
+            self.ready.append(heapq.heappop(self.sleeping)[2])
@@ -0,0 +1,311 @@
+from . import bytecode
+from .vm import VM
+
+class UnverifiedCode(Exception):
+    """A FastVM was about to execute code the verifier did not see"""
+
+# binary operators whose result only depends on the unsigned values
+_unsigned_binary = {
+        0x80: lambda a, b: a + b,
+        0x81: lambda a, b: a - b,
+        0x82: lambda a, b: a * b,
+        0x85: lambda a, b: a << (b & 31),
+        0x87: lambda a, b: a & b,
+        0x88: lambda a, b: a | b,
+        0x89: lambda a, b: a ^ b,
+        0x8a: lambda a, b: int(bool(a and b)),
+        0x8b: lambda a, b: int(bool(a or b)),
+        0xaa: lambda a, b: int(a == b),
+        0xab: lambda a, b: int(a != b),
+        }
+
+class FastVM(VM):
+    """A VM that translates every command into a Python closure with its
+    operands and jump targets resolved, once, and then only calls those.
+
+    Given a verify.Verifier (or after :meth:`predecode`), only the
+    verified commands are executed, and without the checks the generic
+    handlers do: stack accesses don't wrap around the address space, and
+    reaching an address that was not verified raises UnverifiedCode.
+    Without a verifier, commands are translated when first executed.
+
+    With a bus.MemoryBus as memory, all commands run through the generic
+    handlers, so that every memory access (including stack and frame
+    accesses) goes through the bus; only decoding is saved then.
+
+    Code is assumed not to change while it runs; after modifying code in
+    memory, call :meth:`invalidate`. Instrumentation that replaces handlers
+    in ``ops`` only sees :meth:`step`, not :meth:`run`."""
+
+    def __init__(self, memory=None, verifier=None):
+        super(FastVM, self).__init__(memory)
+        self.code = [None] * 0x10000 # address -> closure returning the next address
+        self.verified = None
+        if verifier is not None:
+            self.predecode(verifier)
+
+    def predecode(self, verifier):
+        """Translate all commands a verify.Verifier has checked, and refuse
+        to execute anything else"""
+        if self.verified is None:
+            self.verified = set()
+        for (pos, command) in verifier.instructions.items():
+            self.verified.add(pos)
+            self.code[pos] = self._translate(pos, bytecode.interpret(self.memory, pos))
+
+    def invalidate(self, start=0, end=0x10000):
+        """Forget the translation of commands in the address range start to
+        end (exclusive), e.g. because the code there was replaced"""
+        # commands are up to 3 bytes long: drop those before start that
+        # reach into the range, but not the ones ending before it (frames
+        # may still return there)
+        for pos in range(max(0, start - 2), start):
+            try:
+                length = bytecode.interpret(self.memory, pos).length
+            except bytecode.UnknownCommand:
+                length = 1
+            if pos + length > start:
+                start = pos
+                break
+        self.code[start:end] = [None] * (end - start)
+        if self.verified is not None:
+            self.verified.difference_update(range(start, end))
+
+    def _decode(self, pos):
+        if self.verified is not None and pos not in self.verified:
+            raise UnverifiedCode("Address %04x was not verified"%pos)
+        try:
+            command = bytecode.interpret(self.memory, pos)
+        except bytecode.UnknownCommand:
+            return self._generic(pos, self.memory[pos])
+        return self._translate(pos, command)
+
+    def run(self, steps=None):
+        if self.ip == 0xffff or self.waiting is not None or self.stopped:
+            return 0
+        code = self.code
+        ip = self.ip
+        count = 0
+        try:
+            while True:
+                try:
+                    if steps is None:
+                        while ip != 0xffff:
+                            ip = code[ip]()
+                            count += 1
+                    else:
+                        while ip != 0xffff and count < steps:
+                            ip = code[ip]()
+                            count += 1
+                    break
+                except TypeError:
+                    if code[ip] is not None:
+                        raise
+                    code[ip] = self._decode(ip)
+        finally:
+            # commands that suspend or stop the VM set ip themselves
+            if self.waiting is None and not self.stopped:
+                self.ip = ip
+        return count
+
+    ############ translation ############
+
+    def _generic(self, pos, op):
+        """Run a command with the VM's generic handler; suspending or
+        stopping ends run()"""
+        vm = self
+        handler = self.ops[op]
+        def execute():
+            vm.ip = pos
+            handler(op)
+            if vm.waiting is not None or vm.stopped:
+                return 0xffff
+            return vm.ip
+        return execute
+
+    def _translate(self, pos, command):
+        vm = self
+        memory = self.memory
+        op = memory[pos]
+        next = pos + command.length
+
+        if self.bus is not None:
+            # the translations below access memory directly
+            return self._generic(pos, op)
+
+        if isinstance(command, bytecode.PushLocal):
+            offset = -2 * command.sfa + (2 if command.sfa < 0 else -2)
+            def execute():
+                a = (vm.sfp + offset) & 0xffff
+                sp = (vm.sp - 2) & 0xffff
+                memory[sp] = memory[a]
+                memory[sp + 1] = memory[a + 1]
+                vm.sp = sp
+                return next
+        elif isinstance(command, bytecode.PopLocal):
+            offset = -2 * command.sfa + (2 if command.sfa < 0 else -2)
+            def execute():
+                sp = vm.sp
+                a = (vm.sfp + offset) & 0xffff
+                memory[a] = memory[sp]
+                memory[a + 1] = memory[sp + 1]
+                vm.sp = (sp + 2) & 0xffff
+                return next
+        elif isinstance(command, bytecode.BinaryOperator):
+            if op in _unsigned_binary:
+                function = _unsigned_binary[op]
+                def execute():
+                    sp = vm.sp
+                    r = function((memory[sp + 2] << 8) | memory[sp + 3], (memory[sp] << 8) | memory[sp + 1])
+                    memory[sp + 2] = (r >> 8) & 0xff
+                    memory[sp + 3] = r & 0xff
+                    vm.sp = (sp + 2) & 0xffff
+                    return next
+            else:
+                function = VM._binary[op]
+                def execute():
+                    sp = vm.sp
+                    a = (memory[sp + 2] << 8) | memory[sp + 3]
+                    b = (memory[sp] << 8) | memory[sp + 1]
+                    r = function(a - ((a & 0x8000) << 1), b - ((b & 0x8000) << 1))
+                    memory[sp + 2] = (r >> 8) & 0xff
+                    memory[sp + 3] = r & 0xff
+                    vm.sp = (sp + 2) & 0xffff
+                    return next
+        elif isinstance(command, bytecode.UnaryOperator):
+            function = {0x8c: lambda a: ~a, 0x8d: lambda a: -a, 0x8e: lambda a: int(not a)}[op]
+            def execute():
+                sp = vm.sp
+                r = function((memory[sp] << 8) | memory[sp + 1])
+                memory[sp] = (r >> 8) & 0xff
+                memory[sp + 1] = r & 0xff
+                return next
+        elif isinstance(command, bytecode.PushConstant):
+            high, low = (command.value >> 8) & 0xff, command.value & 0xff
+            def execute():
+                sp = (vm.sp - 2) & 0xffff
+                memory[sp] = high
+                memory[sp + 1] = low
+                vm.sp = sp
+                return next
+        elif isinstance(command, bytecode.Return):
+            with_value = op == 0x9b
+            def execute():
+                if with_value:
+                    sp = vm.sp
+                    high, low = memory[sp], memory[sp + 1]
+                sp = vm.sfp
+                ip = (memory[sp] << 8) | memory[sp + 1]
+                sfp = (memory[sp + 2] << 8) | memory[(sp + 3) & 0xffff]
+                sp = (sp + 4) & 0xffff
+                if sfp & 1:
+                    vm.sfp = sfp & ~1
+                else:
+                    vm.sfp = sfp
+                    sp = (sp - 2) & 0xffff
+                    if with_value:
+                        memory[sp], memory[sp + 1] = high, low
+                    else:
+                        memory[sp] = memory[sp + 1] = 0
+                vm.sp = sp
+                return ip
+        elif isinstance(command, bytecode.DropValue):
+            def execute():
+                vm.sp = (vm.sp + 2) & 0xffff
+                return next
+        elif isinstance(command, bytecode.CallCommand):
+            target = command.target(pos)
+            # see VM._call
+            if memory[next] == 0x9d:
+                frame, return_address = 1, next + 1
+            else:
+                frame, return_address = 0, next
+            high, low = return_address >> 8, return_address & 0xff
+            def execute():
+                sp = (vm.sp - 4) & 0xffff
+                sfp = vm.sfp | frame
+                memory[sp + 2] = sfp >> 8
+                memory[sp + 3] = sfp & 0xff
+                memory[sp] = high
+                memory[sp + 1] = low
+                vm.sp = vm.sfp = sp
+                return target
+        elif isinstance(command, bytecode.UnconditionalJumpCommand) and isinstance(command, bytecode.RelativeAddressCommand):
+            target = command.target(pos)
+            def execute():
+                return target
+        elif isinstance(command, (bytecode.JumpIfCommand, bytecode.JumpIfNotCommand)):
+            taken, not_taken = command.target(pos), next
+            if isinstance(command, bytecode.JumpIfNotCommand):
+                taken, not_taken = not_taken, taken
+            def execute():
+                sp = vm.sp
+                vm.sp = (sp + 2) & 0xffff
+                return taken if memory[sp] or memory[sp + 1] else not_taken
+        elif isinstance(command, bytecode.GlobalAccess):
+            execute = self._translate_global(pos, command, op, next)
+        elif isinstance(command, bytecode.PushZeros):
+            count = 2 * (command.n + 1)
+            zeros = [0] * count
+            def execute():
+                sp = (vm.sp - count) & 0xffff
+                memory[sp:sp + count] = zeros
+                vm.sp = sp
+                return next
+        elif isinstance(command, bytecode.PopMany):
+            drop = 2 * (command.n + 1)
+            def execute():
+                sp = vm.sp
+                memory[sp + drop] = memory[sp]
+                memory[sp + drop + 1] = memory[sp + 1]
+                vm.sp = (sp + drop) & 0xffff
+                return next
+        elif isinstance(command, bytecode.Bury) and command.k == 0:
+            def execute():
+                sp = vm.sp
+                vm.sp = sp = (sp - 2) & 0xffff
+                memory[sp] = memory[sp + 2]
+                memory[sp + 1] = memory[sp + 3]
+                return next
+        else:
+            return self._generic(pos, op)
+        return execute
+
+    def _translate_global(self, pos, command, op, next):
+        vm = self
+        memory = self.memory
+        kind = (op >> 3) & 0x07
+        # the offset is only scaled if there is a fixed address too (see VM._op_global)
+        shift = 1 if kind in (4, 5) and command.nargs else 0
+        store = isinstance(command, bytecode.GlobalStore)
+        wide = kind in (4, 5)
+        signed = kind == 2
+        fixed = command.address if command.address is not None else 0
+        popoffset = command.popoffset
+
+        def execute():
+            sp = vm.sp
+            if popoffset:
+                address = ((((memory[sp] << 8) | memory[sp + 1]) << shift) + fixed) & 0xffff
+                sp += 2
+            else:
+                address = fixed
+            if store:
+                if wide:
+                    memory[address] = memory[sp]
+                    memory[(address + 1) & 0xffff] = memory[sp + 1]
+                else:
+                    memory[address] = memory[sp + 1]
+                vm.sp = (sp + 2) & 0xffff
+            else:
+                sp = (sp - 2) & 0xffff
+                if wide:
+                    memory[sp] = memory[address]
+                    memory[sp + 1] = memory[(address + 1) & 0xffff]
+                else:
+                    value = memory[address]
+                    memory[sp] = 0xff if signed and value & 0x80 else 0
+                    memory[sp + 1] = value
+                vm.sp = sp
+            return next
+        return execute
@@ -0,0 +1,126 @@
+import array
+
+def program_variables(program):
+    """Return {name: (address, size)} for the globals of a compiled
+    python.PythonProgram (the named views of its Globals)"""
+    result = {}
+    for b in program.blocks:
+        if hasattr(b, 'named'):
+            result.update(b.variables())
+    return result
+
+class MemoryHeatmap(object):
+    """Counts the global memory accesses (the GlobalLoad*/GlobalStore*
+    commands) of a VM per address, separately for 8-bit and 16-bit reads
+    and writes. ``long_address`` counts the accesses whose command had to
+    encode a 16-bit address, which a variable below address 256 would
+    avoid.
+
+    ``variables`` ({name: (address, size)}, see :func:`program_variables`
+    and symbols.SymbolTable.variables) names the addresses in the reports.
+    Like profiler.Profiler, the heatmap wraps the handlers in ``vm.ops``."""
+
+    page_size = 256
+
+    def __init__(self, vm, variables=None):
+        self.vm = vm
+        self.variables = variables or {}
+
+        new = lambda: array.array('L', [0]) * 0x10000
+        self.reads8, self.reads16, self.writes8, self.writes16 = new(), new(), new(), new()
+        self.long_address = new()
+        self._original = None
+
+    def install(self):
+        vm = self.vm
+        self._original = list(vm.ops)
+        memory = vm.memory
+
+        def counting(original, op):
+            kind = (op >> 3) & 0x07
+            mode = op & 0x07
+            shift = 1 if kind in (4, 5) else 0
+            counts = {0: self.reads8, 1: self.writes8, 2: self.reads8, 3: self.writes8, 4: self.reads16, 5: self.writes16}[kind]
+            long_address = self.long_address if mode in (1, 4) else None
+            # the address as _op_global computes it, before anything is popped
+            if mode == 0:
+                address = lambda ip, sp: memory[ip + 1]
+            elif mode == 1:
+                address = lambda ip, sp: (memory[ip + 1] << 8) | memory[ip + 2]
+            elif mode == 2:
+                address = lambda ip, sp: (memory[sp] << 8) | memory[(sp + 1) & 0xffff]
+            elif mode == 3:
+                address = lambda ip, sp: ((((memory[sp] << 8) | memory[(sp + 1) & 0xffff]) << shift) + memory[ip + 1]) & 0xffff
+            else:
+                address = lambda ip, sp: ((((memory[sp] << 8) | memory[(sp + 1) & 0xffff]) << shift) + ((memory[ip + 1] << 8) | memory[ip + 2])) & 0xffff
+
+            def wrapped(op):
+                a = address(vm.ip, vm.sp)
+                counts[a] += 1
+                if long_address is not None:
+                    long_address[a] += 1
+                original(op)
+            return wrapped
+
+        for op in range(0xc0, 0xf0):
+            if op & 0x07 <= 4:
+                vm.ops[op] = counting(vm.ops[op], op)
+
+    def uninstall(self):
+        self.vm.ops[:] = self._original
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+    def _sum(self, start, end):
+        return tuple(sum(counts[start:end]) for counts in (self.reads8, self.reads16, self.writes8, self.writes16, self.long_address))
+
+    def by_variable(self):
+        """Return {name: (reads8, reads16, writes8, writes16, long_address)}
+        summed over the bytes of every variable; accesses to other addresses
+        are listed as None"""
+        result = {}
+        named = array.array('B', [0]) * 0x10000
+        for (name, (address, size)) in self.variables.items():
+            result[name] = self._sum(address, address + size)
+            named[address:address + size] = array.array('B', [1]) * size
+        other = [0] * 5
+        for counts_index, counts in enumerate((self.reads8, self.reads16, self.writes8, self.writes16, self.long_address)):
+            other[counts_index] = sum(c for (c, n) in zip(counts, named) if c and not n)
+        if any(other):
+            result[None] = tuple(other)
+        return result
+
+    def by_page(self):
+        """Return {page number: (reads8, reads16, writes8, writes16,
+        long_address)} for all pages that were accessed"""
+        result = {}
+        for page in range(0x10000 // self.page_size):
+            counts = self._sum(page * self.page_size, (page + 1) * self.page_size)
+            if any(counts):
+                result[page] = counts
+        return result
+
+    def report(self):
+        """Return per-variable and per-page tables as a string"""
+        header = "%8s %8s %8s %8s %8s  %s"%("read8", "read16", "write8", "write16", "addr16", "%s")
+        row = lambda counts, label: "%8d %8d %8d %8d %8d  %s"%(counts + (label,))
+        total = lambda counts: -sum(counts[:4])
+
+        lines = [header%"variable"]
+        for (name, counts) in sorted(self.by_variable().items(), key=lambda (k, v): (total(v), k)):
+            if name is None:
+                label = "(unnamed)"
+            else:
+                address, size = self.variables[name]
+                label = "%s at %04x, %d bytes%s"%(name, address, size, "" if address + size <= 256 else " (beyond 8-bit addresses)")
+            lines.append(row(counts, label))
+        lines.append("")
+        lines.append(header%"page")
+        for (page, counts) in sorted(self.by_page().items()):
+            lines.append(row(counts, "%04x-%04x"%(page * self.page_size, (page + 1) * self.page_size - 1)))
+        return "\n".join(lines)
@@ -0,0 +1,146 @@
+from . import bytecode
+from .fastvm import FastVM
+from .python import PythonProgram, _relax, _place
+from .symbols import SymbolTable
+from .util import wrap16
+from .verify import verify_binary
+
+STACK_MARGIN = 0x100 # bytes kept free below the stack by default
+
+def active_addresses(vm):
+    """Return the instruction pointer and the return addresses of all
+    frames on the stack of a VM, innermost first"""
+    addresses = [vm.ip]
+    sfp = vm.sfp
+    seen = set()
+    while sfp not in seen:
+        seen.add(sfp)
+        ip = vm.read16(sfp) & 0xffff
+        if ip == 0xffff:
+            break
+        addresses.append(ip)
+        sfp = vm.read16(sfp + 2) & 0xfffe
+    return addresses
+
+def compile_function(source, name, symbols):
+    """Compile the function name of a program for the image with symbols (a
+    symbols.SymbolTable): the global variables have to be where they are
+    in the image, and calls to other functions go to their addresses in the
+    image (functions that are not defined in source are taken from there
+    too, and have to be called with all arguments).
+
+    Return the unfixed code of the function and {label: address} of the
+    functions it calls."""
+    program = PythonProgram(allow_externs=True, layout=symbols)
+    program.read_python(source)
+    if name not in program.funcs:
+        raise Exception("%s is not defined"%name)
+
+    for (variable, (address, type)) in program.get_symbols().items():
+        if type != 'data':
+            continue
+        if variable not in symbols.by_name:
+            raise Exception("Global %s is not in the image"%variable)
+        if symbols[variable] != address:
+            raise Exception("Global %s is at %04x in the image, but would be at %04x"%(variable, symbols[variable], address))
+
+    functions = dict((f.entry_label, other) for (other, f) in program.funcs.items())
+    functions.update((e.entry_label, other) for (other, e) in program.externs.items())
+    code = program.funcs[name].code.code
+    targets = {}
+    for command in code:
+        address = getattr(command, 'address', None)
+        if isinstance(address, bytecode.Label.LabelRef) and address.ref in functions:
+            other = functions[address.ref]
+            if other == name:
+                continue # placed with the code
+            if other not in symbols.by_name:
+                raise Exception("%s calls %s, which is not in the image"%(name, other))
+            targets[address.ref] = symbols[other]
+    return code, targets
+
+class HotPatcher(object):
+    """Replaces functions of the image in a VM with recompiled versions
+    while it runs (between steps), keeping the state of the VM.
+
+    A new version is written over the old one if it fits there and no frame
+    is executing the old one; otherwise it goes into the free memory from
+    free_start (usually the end of the image) up to free_end (by default,
+    STACK_MARGIN bytes below the stack), and the old entry jumps there.
+    Frames inside the old version return into it unchanged.
+
+    For a fastvm.FastVM, the translations of the changed code are dropped,
+    and if it only runs verified code, the new code is verified first."""
+
+    def __init__(self, vm, symbols, free_start, free_end=None):
+        self.vm = vm
+        self.symbols = symbols
+        self.free_start = free_start
+        self.free_end = free_end
+        self.patches = [] # (name, address, length, in place)
+        # new code is verified as reached from the original functions, as
+        # the number of arguments of a function is only known from its callers
+        self._entry_points = [address for (address, type) in symbols.by_name.values() if type == 'code']
+
+    def _slot_end(self, address):
+        following = [a for (a, name) in self.symbols.in_range(address + 1, 0x10000)] + [0x10000]
+        if self.free_start > address:
+            following.append(self.free_start)
+        return min(following)
+
+    def patch(self, source, name):
+        """Replace the function name with its definition in source (see
+        compile_function); return the address of the new code"""
+        vm = self.vm
+        code, targets = compile_function(source, name, self.symbols)
+        old = self.symbols.by_name.get(name, (None, None))[0]
+
+        in_place = False
+        if old is not None:
+            end = self._slot_end(old)
+            if not any(old <= a < end for a in active_addresses(vm)):
+                in_place = old + _relax(code, old, targets) <= end
+        if in_place:
+            address = old
+        else:
+            address = self.free_start
+            length = _relax(code, address, targets)
+            limit = self.free_end if self.free_end is not None else (vm.sp or 0x10000) - STACK_MARGIN
+            if address + length > limit:
+                raise Exception("No room for the new code of %s (%d bytes at %04x)"%(name, length, address))
+        _place(code, address, targets)
+        new = sum((c.to_bin() for c in code), [])
+
+        writes = [(address, new)]
+        if old is not None and not in_place:
+            reladdr = wrap16(address - old)
+            jump = bytecode.JumpRel1(reladdr=reladdr) if -128 <= reladdr < 128 else bytecode.JumpRel2(reladdr=reladdr)
+            if old + jump.length > self._slot_end(old):
+                raise Exception("%s is too short to jump from"%name)
+            if any(old < a < old + jump.length for a in active_addresses(vm)):
+                raise Exception("A frame is executing the first instruction of %s"%name)
+            writes.append((old, jump.to_bin()))
+
+        verifier = None
+        if isinstance(vm, FastVM) and vm.verified is not None:
+            image = bytearray(vm.memory)
+            for (start, data) in writes:
+                image[start:start + len(data)] = bytearray(data)
+            verifier = verify_binary(image, self._entry_points)
+
+        for (start, data) in writes:
+            vm.memory[start:start + len(data)] = bytearray(data)
+            if isinstance(vm, FastVM):
+                vm.invalidate(start, start + len(data))
+        if verifier is not None:
+            vm.predecode(verifier)
+
+        end = self.symbols.end
+        if not in_place:
+            self.free_start = address + len(new)
+            end = max(end, self.free_start)
+        symbols = dict(self.symbols.by_name)
+        symbols[name] = (address, 'code')
+        self.symbols = SymbolTable.from_dict(symbols, end)
+        self.patches.append((name, address, len(new), in_place))
+        return address
@@ -0,0 +1,85 @@
+import ast
+import hashlib
+import marshal
+
+from .cache import hash_environment
+
+VERSION = 1
+
+def _signature(node):
+    """What calls to the function defined by node depend on"""
+    return (len(node.args.args), [ast.dump(d) for d in node.args.defaults])
+
+def context_digest(tree, options=()):
+    """Digest of what the code of all functions of a program depends on: the
+    compiler, the top level statements other than function definitions
+    (and the ``if __name__ == "__main__"`` block, which is not compiled),
+    the modules they import from and the compiler options"""
+    statements = [s for s in tree.body if not isinstance(s, (ast.FunctionDef, ast.If))]
+    h = hashlib.sha1()
+    hash_environment(h, sorted(set(s.module for s in statements if isinstance(s, ast.ImportFrom))))
+    h.update(repr(sorted(options)) + "\0")
+    for s in statements:
+        h.update(ast.dump(s) + "\0")
+    return h.hexdigest()
+
+def function_fingerprints(tree):
+    """Return {name: digest} of the functions defined in tree. A digest
+    covers the definition, its line numbers relative to the def statement,
+    and the signatures of the functions it refers to by name, so it stays
+    the same when other functions move or change their bodies."""
+    functions = dict((s.name, s) for s in tree.body if isinstance(s, ast.FunctionDef))
+    signatures = dict((name, _signature(node)) for (name, node) in functions.items())
+    fingerprints = {}
+    for (name, node) in functions.items():
+        nodes = list(ast.walk(node))
+        names = sorted(set(n.id for n in nodes if isinstance(n, ast.Name)))
+        h = hashlib.sha1()
+        h.update(ast.dump(node) + "\0")
+        h.update(repr([n.lineno - node.lineno for n in nodes if hasattr(n, 'lineno')]) + "\0")
+        h.update(repr([(n, signatures.get(n)) for n in names]))
+        fingerprints[name] = h.hexdigest()
+    return fingerprints
+
+class BuildState(object):
+    """What an incremental build (see python.PythonProgram.read_python)
+    keeps of the previous build of a program: the code of every function
+    before it was fixed, and where fix_all placed the functions."""
+
+    def __init__(self):
+        self.context = None # see context_digest
+        self.functions = {} # name -> (fingerprint, code stream, labels created)
+        self.layout = None # (start of the code, [(name, position, length, nargs of its variable length commands)])
+
+    def reusable(self, context, fingerprints):
+        """Return {name: (code stream, labels created)} of the functions
+        whose code can be taken from the previous build"""
+        if context != self.context:
+            return {}
+        return dict((name, self.functions[name][1:]) for (name, fingerprint) in fingerprints.items()
+                if name in self.functions and self.functions[name][0] == fingerprint)
+
+    def to_binary(self):
+        return marshal.dumps((VERSION, self.context, self.functions, self.layout))
+
+    @classmethod
+    def from_binary(cls, data):
+        state = cls()
+        version, state.context, state.functions, state.layout = marshal.loads(data)
+        if version != VERSION:
+            raise ValueError("Unknown build state version %r"%version)
+        return state
+
+    def write(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_binary())
+
+    @classmethod
+    def read(cls, filename):
+        """Read a state file; a missing or unreadable one gives an empty
+        state (everything is rebuilt)"""
+        try:
+            with open(filename, 'rb') as f:
+                return cls.from_binary(f.read())
+        except (IOError, EOFError, ValueError, TypeError):
+            return cls()
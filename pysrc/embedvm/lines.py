@@ -0,0 +1,118 @@
+import array
+import bisect
+
+MAGIC = "EVML"
+VERSION = 1
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+class LineTable(object):
+    """Maps code addresses to the source lines they were compiled from.
+
+    The table is a sorted list of addresses at which a new line starts;
+    every address up to the next entry belongs to the same line. Line 0
+    marks addresses that don't belong to any line (data, gaps between code
+    blocks), lookups return None for them.
+
+    In files (see :meth:`to_binary`), the entries are stored as pairs of
+    varints: the address difference to the previous entry and the zigzag
+    encoded line difference."""
+
+    def __init__(self, entries=(), filename=""):
+        self.filename = filename
+        self.addresses = array.array('l')
+        self.lines = array.array('l')
+        for (address, line) in sorted(entries):
+            if self.lines and self.lines[-1] == line:
+                continue
+            if self.addresses and self.addresses[-1] == address:
+                self.lines[-1] = line
+                continue
+            self.addresses.append(address)
+            self.lines.append(line)
+
+    @classmethod
+    def from_ranges(cls, ranges, filename=""):
+        """Build a table from (start, end, line) ranges, which must not
+        overlap"""
+        entries = {}
+        for (start, end, line) in sorted(ranges):
+            entries.setdefault(end, 0)
+            entries[start] = line
+        return cls(entries.items(), filename)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def lookup(self, address, _bisect=bisect.bisect_right):
+        """Source line of the code at address, or None"""
+        index = _bisect(self.addresses, address) - 1
+        return (self.lines[index] or None) if index >= 0 else None
+
+    def addresses_of(self, line):
+        """Return the (start, end) address ranges that belong to line"""
+        result = []
+        for (i, l) in enumerate(self.lines):
+            if l == line and i + 1 < len(self.addresses):
+                result.append((self.addresses[i], self.addresses[i + 1]))
+        return result
+
+    def __iter__(self):
+        return iter(zip(self.addresses, self.lines))
+
+    def to_binary(self):
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        filename = self.filename.encode('utf8')
+        _write_varint(out, len(filename))
+        out.extend(filename)
+        _write_varint(out, len(self.addresses))
+        last_address = last_line = 0
+        for (address, line) in self:
+            delta = line - last_line
+            _write_varint(out, address - last_address)
+            _write_varint(out, (delta << 1) if delta >= 0 else ((-delta << 1) - 1))
+            last_address, last_line = address, line
+        return str(out)
+
+    @classmethod
+    def from_binary(cls, data):
+        data = bytearray(data)
+        if data[:4] != MAGIC or data[4] != VERSION:
+            raise Exception("Not a line table file")
+        length, pos = _read_varint(data, 5)
+        filename = str(data[pos:pos+length]).decode('utf8')
+        count, pos = _read_varint(data, pos + length)
+        table = cls(filename=filename)
+        address = line = 0
+        for i in xrange(count):
+            delta, pos = _read_varint(data, pos)
+            address += delta
+            delta, pos = _read_varint(data, pos)
+            line += (delta >> 1) if not delta & 1 else -((delta + 1) >> 1)
+            table.addresses.append(address)
+            table.lines.append(line)
+        return table
+
+    def write(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_binary())
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.from_binary(f.read())
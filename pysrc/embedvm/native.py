@@ -0,0 +1,171 @@
+import ast
+import hashlib
+import imp
+import marshal
+import os.path
+import sys
+
+from .runtime import Globals
+from .util import signext, wrap16 as wrap
+
+def c_div(a, b):
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        q = -q
+    return wrap(q)
+
+def c_mod(a, b):
+    return wrap(a - b * c_div(a, b))
+
+def c_shl(a, b):
+    # the shift count is masked like the host running the VM does
+    return wrap(a << (b & 31))
+
+def c_shr(a, b):
+    return wrap(a >> (b & 31))
+
+helpers = {
+        '_evm_wrap': wrap,
+        '_evm_div': c_div,
+        '_evm_mod': c_mod,
+        '_evm_shl': c_shl,
+        '_evm_shr': c_shr,
+        }
+
+class WrappingGlobals(Globals):
+    """Globals that truncate stored values instead of insisting that they fit,
+    and index arrays without checks (negative indices reach before the
+    array), which is what happens in the VM."""
+    def _element_address(self, view, index):
+        return (view.address + view.sizeofelement * index) & 0xffff
+    def set16(self, address, value):
+        super(WrappingGlobals, self).set16(address, signext(value, 0xffff))
+    def set8s(self, address, value):
+        super(WrappingGlobals, self).set8s(address, signext(value, 0xff))
+    def setarray16(self, address, values):
+        super(WrappingGlobals, self).setarray16(address, [signext(v, 0xffff) for v in values])
+    def setarray8s(self, address, values):
+        super(WrappingGlobals, self).setarray8s(address, [signext(v, 0xff) for v in values])
+
+class CSemanticsTransformer(ast.NodeTransformer):
+    """Rewrite the functions of a program accepted by PythonProgram so that
+    they calculate like the VM does: all values are 16 bit integers that wrap
+    around on overflow, and division, modulo and shifts behave like in C.
+
+    Top level statements are left alone (they only set up globals and run the
+    main function), except that embedvm.runtime.Globals is replaced with
+    WrappingGlobals."""
+
+    binop_helpers = {
+            ast.Div: '_evm_div',
+            ast.Mod: '_evm_mod',
+            ast.LShift: '_evm_shl',
+            ast.RShift: '_evm_shr',
+            }
+    wrapped_binops = (ast.Add, ast.Sub, ast.Mult)
+
+    def _helper_call(self, name, args, node):
+        return ast.copy_location(ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[], starargs=None, kwargs=None), node)
+
+    def visit_ImportFrom(self, node):
+        if node.module != 'embedvm.runtime' or 'Globals' not in [n.name for n in node.names]:
+            return node
+        others = [n for n in node.names if n.name != 'Globals']
+        (globals_alias, ) = [n for n in node.names if n.name == 'Globals']
+        replacement = ast.copy_location(ast.ImportFrom(module='embedvm.native', names=[ast.alias(name='WrappingGlobals', asname=globals_alias.asname or 'Globals')], level=0), node)
+        if not others:
+            return replacement
+        node.names = others
+        return [node, replacement]
+
+    def visit_FunctionDef(self, node):
+        node.body = [self._transform_function_statement(s) for s in node.body]
+        return node
+
+    def _transform_function_statement(self, s):
+        if isinstance(s, ast.Expr) and isinstance(s.value, ast.Call):
+            # the return value is dropped anyway, and might not even be a number
+            s.value.args = [self._transform_expression(a) for a in s.value.args]
+            return s
+        if isinstance(s, ast.For):
+            # leave the range call alone, it is handled specially by the compiler too
+            s.iter.args = [self._transform_expression(a) for a in s.iter.args]
+            s.body = [self._transform_function_statement(b) for b in s.body]
+            s.orelse = [self._transform_function_statement(b) for b in s.orelse]
+            return s
+        for (field, value) in ast.iter_fields(s):
+            if isinstance(value, list):
+                setattr(s, field, [self._transform_function_statement(x) if isinstance(x, ast.stmt) else self._transform_expression(x) for x in value])
+            elif isinstance(value, ast.expr):
+                setattr(s, field, self._transform_expression(value))
+        return s
+
+    def _transform_expression(self, e):
+        return ExpressionTransformer(self).visit(e)
+
+class ExpressionTransformer(ast.NodeTransformer):
+    def __init__(self, parent):
+        self.parent = parent
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if type(node.op) in self.parent.binop_helpers:
+            return self.parent._helper_call(self.parent.binop_helpers[type(node.op)], [node.left, node.right], node)
+        if isinstance(node.op, self.parent.wrapped_binops):
+            return self.parent._helper_call('_evm_wrap', [node], node)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.USub):
+            return self.parent._helper_call('_evm_wrap', [node], node)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        return self.parent._helper_call('_evm_wrap', [node], node)
+
+    def visit_Num(self, node):
+        if isinstance(node.n, (int, long)) and not -0x8000 <= node.n <= 0x7fff:
+            return ast.copy_location(ast.Num(n=wrap(node.n)), node)
+        return node
+
+_code_cache = {} # source hash -> code object
+
+def compile_native(source, filename='<evm>', cache_dir=None):
+    """Compile the source of an EVM Python program to a code object with C
+    semantics (see CSemanticsTransformer). The result is cached in memory and,
+    if cache_dir is given, on disk."""
+    key = hashlib.sha1(imp.get_magic() + filename + '\0' + source).hexdigest()
+    if key in _code_cache:
+        return _code_cache[key]
+
+    cachefile = os.path.join(cache_dir, key + '.evmc') if cache_dir is not None else None
+    if cachefile is not None and os.path.exists(cachefile):
+        with open(cachefile, 'rb') as f:
+            code = marshal.load(f)
+    else:
+        tree = CSemanticsTransformer().visit(ast.parse(source, filename))
+        ast.fix_missing_locations(tree)
+        code = compile(tree, filename, 'exec')
+        if cachefile is not None:
+            with open(cachefile + '.tmp', 'wb') as f:
+                marshal.dump(code, f)
+            os.rename(cachefile + '.tmp', cachefile)
+
+    _code_cache[key] = code
+    return code
+
+def run_native(filename, cache_dir=None, name='__main__'):
+    """Execute an EVM Python program on the host with C semantics. Returns the
+    namespace of the executed module."""
+    source = open(filename).read()
+    code = compile_native(source, filename, cache_dir)
+    namespace = {'__name__': name, '__file__': filename}
+    namespace.update(helpers)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(filename)))
+    try:
+        exec code in namespace
+    finally:
+        sys.path.pop(0)
+    return namespace
@@ -0,0 +1,156 @@
+import ast
+
+from . import asm
+from . import bytecode
+
+FORMAT = "embedvm object"
+VERSION = 1
+
+class ObjectFile(object):
+    """A separately compiled module: its code as unplaced commands (with
+    labels, like a FreeCodeBlock), the initial contents of its global
+    variables, and the functions it exports (its labels with an export name)
+    and imports (the python.ExternalFunctions it calls).
+
+    The code accesses global variables at addresses relative to the start
+    of the module's data, which is what python.PythonProgram produces; the
+    linker relocates them."""
+
+    def __init__(self, module):
+        self.module = module
+        self.code = []
+        self.data = bytearray()
+        self.data_symbols = {} # name -> offset in data
+        self.fixed_data = False # whether variables were placed at explicit addresses
+        self.imports = {} # name -> UnresolvedReferences in code
+
+    exports = property(lambda self: dict((c.export, c) for c in self.code if isinstance(c, bytecode.Label) and c.export))
+
+    @classmethod
+    def from_program(cls, program, module):
+        """Create the object of a PythonProgram that has read its source
+        (with allow_externs) but was not fixed"""
+        o = cls(module)
+        for b in program.blocks:
+            if isinstance(b, asm.FixedPositionCodeBlock):
+                raise Exception("Object files can only be created from unfixed programs")
+            elif isinstance(b, asm.FreeCodeBlock):
+                o.code.extend(b.code)
+            else:
+                o.data.extend(b.to_binary(len(o.data)))
+                for (name, (position, type)) in getattr(b, 'sym', {}).items():
+                    o.data_symbols[name] = position
+                if any(getattr(view, 'specified_pos', None) is not None for view in getattr(b, 'named', {}).values()):
+                    o.fixed_data = True
+        for name in program.externs:
+            o.imports[name] = []
+        return o
+
+    def to_text(self):
+        """Serialize as a Python literal, with one command repr per line"""
+        lines = ["{'format': %r,"%FORMAT,
+                " 'version': %r,"%VERSION,
+                " 'module': %r,"%self.module,
+                " 'imports': %r,"%sorted(self.imports),
+                " 'data': %r,"%list(self.data),
+                " 'data_symbols': %r,"%self.data_symbols,
+                " 'fixed_data': %r,"%self.fixed_data,
+                " 'code': ["]
+        lines.extend("  %r,"%repr(c) for c in self.code)
+        lines.append(" ]}")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def from_text(cls, text):
+        d = ast.literal_eval(text)
+        if d.get('format') != FORMAT or d.get('version') != VERSION:
+            raise Exception("Not an embedvm object file")
+        o = cls(d['module'])
+        o.data = bytearray(d['data'])
+        o.data_symbols = d['data_symbols']
+        o.fixed_data = d['fixed_data']
+
+        unrefs = []
+        for line in d['code']:
+            o.code.append(asm.parse_command(line, unrefs))
+
+        labels = dict((c.id, c) for c in o.code if isinstance(c, bytecode.Label))
+        externs = dict(("extern:%s"%name, name) for name in d['imports'])
+        o.imports = dict((name, []) for name in d['imports'])
+        for ref in unrefs:
+            if ref.id in labels:
+                ref.resolve_to(labels[ref.id])
+            elif ref.id in externs:
+                o.imports[externs[ref.id]].append(ref)
+            else:
+                raise Exception("Unresolved label %s in module %s"%(ref.id, o.module))
+        return o
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.to_text())
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as f:
+            return cls.from_text(f.read())
+
+class LinkedProgram(asm.ASM):
+    def get_symbols(self):
+        sym = {}
+        for b in self.blocks:
+            if hasattr(b, 'sym'):
+                sym.update(b.sym)
+        return sym
+
+def link(objects):
+    """Combine ObjectFiles (read from files, they are modified in the
+    process) into a program whose code is fixed like a compiled
+    PythonProgram.
+
+    The global variables of the modules are placed one after the other in
+    the given order, and the addresses in the code that accesses them are
+    moved accordingly, using the short form of the command where the new
+    address allows. The code of all modules forms a single block, so that
+    calls across modules get the short encoding whenever it fits, just
+    like calls within a module."""
+    exports = {} # name -> (label, module)
+    data_names = {} # name -> module
+    for o in objects:
+        for (name, label) in o.exports.items():
+            if name in exports:
+                raise Exception("Function %s is defined in both %s and %s"%(name, exports[name][1], o.module))
+            exports[name] = (label, o.module)
+        for name in o.data_symbols:
+            if name in data_names or name in exports:
+                raise Exception("Global %s of %s is also defined in %s"%(name, o.module, data_names.get(name) or exports[name][1]))
+            data_names[name] = o.module
+
+    program = LinkedProgram()
+    code = asm.FreeCodeBlock()
+    base = 0
+    for o in objects:
+        for (name, refs) in sorted(o.imports.items()):
+            if name not in exports:
+                raise Exception("Undefined function %s (called in %s)"%(name, o.module))
+            for ref in refs:
+                ref.resolve_to(exports[name][0])
+
+        if o.data:
+            if o.fixed_data and base != 0:
+                raise Exception("%s has variables at fixed addresses and has to be linked first"%o.module)
+            block = asm.DataBlock()
+            block.data = list(o.data)
+            block.sym = dict((name, (base + offset, "data")) for (name, offset) in o.data_symbols.items())
+            program.blocks.append(block)
+
+        for command in o.code:
+            if base and isinstance(command, bytecode.GlobalAccess) and command.address is not None:
+                command.address += base
+                command.nargs = 1 if command.address < 256 else 2
+            code.append(command)
+        base += len(o.data)
+
+    program.blocks.append(code)
+    program.fix_all()
+    return program
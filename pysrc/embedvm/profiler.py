@@ -0,0 +1,225 @@
+import array
+import collections
+
+from . import bytecode
+
+def command_name(op):
+    """Name of the bytecode command class an opcode belongs to"""
+    try:
+        return type(bytecode.interpret([op, 0, 0], 0)).__name__
+    except (bytecode.UnknownCommand, AssertionError):
+        return "invalid(%02x)"%op
+
+class Profiler(object):
+    """Counts how often every address of a VM's memory gets executed, and
+    which function calls which.
+
+    Installing the profiler wraps the handlers in ``vm.ops``, so it works
+    with everything that runs the VM through them (VM.run, EventLoop,
+    Simulation -- install it before the simulation starts running). The
+    bookkeeping per instruction is two increments; calls, returns and
+    interrupts additionally maintain a shadow call stack from which the
+    call graph and collapsed stacks are built.
+
+    Reports are in terms of functions if ``symbols`` (a
+    symbols.SymbolTable) is given, and in terms of source lines if
+    ``lines`` (anything with a ``lookup(address)`` method returning a line
+    number or None) is given."""
+
+    def __init__(self, vm, symbols=None, lines=None):
+        self.vm = vm
+        self.symbols = symbols
+        self.lines = lines
+
+        self.counts = array.array('L', [0]) * 0x10000 # executions per address
+        self.calls = collections.defaultdict(int) # (caller address, callee address) -> count
+        self.stacks = collections.defaultdict(int) # tuple of entry addresses -> instructions
+        self.stack = [] # (entry address, stack frame pointer) of the active functions
+        self._executed = [0]
+        self._stack_start = 0
+        self._original = None
+
+    ############ instrumentation ############
+
+    def install(self):
+        vm = self.vm
+        self._original = list(vm.ops), vm.interrupt
+        counts = self.counts
+        executed = self._executed
+
+        def counting(original):
+            def wrapped(op):
+                counts[vm.ip] += 1
+                executed[0] += 1
+                original(op)
+            return wrapped
+
+        def calling(original):
+            def wrapped(op):
+                counts[vm.ip] += 1
+                executed[0] += 1
+                caller = vm.ip
+                original(op)
+                self._enter(caller, vm.ip)
+            return wrapped
+
+        def returning(original):
+            def wrapped(op):
+                counts[vm.ip] += 1
+                executed[0] += 1
+                original(op)
+                self._leave()
+            return wrapped
+
+        for op in range(256):
+            if op in (0x9e, 0xa2, 0xa3):
+                vm.ops[op] = calling(vm.ops[op])
+            elif op in (0x9b, 0x9c):
+                vm.ops[op] = returning(vm.ops[op])
+            else:
+                vm.ops[op] = counting(vm.ops[op])
+
+        interrupt = vm.interrupt
+        def interrupting(address):
+            interrupt(address)
+            self._enter(None, address)
+        vm.interrupt = interrupting
+
+    def uninstall(self):
+        self._flush()
+        ops, interrupt = self._original
+        self.vm.ops[:] = ops
+        if interrupt == self.vm.interrupt:
+            # the interrupt method of the class, not a wrapper of someone else
+            del self.vm.interrupt
+        else:
+            self.vm.interrupt = interrupt
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+    def _flush(self):
+        """Attribute the instructions executed since the shadow stack last
+        changed to it"""
+        if self.stack:
+            self.stacks[tuple(entry for (entry, sfp) in self.stack)] += self._executed[0] - self._stack_start
+        self._stack_start = self._executed[0]
+
+    def _enter(self, caller, callee):
+        self._flush()
+        if caller is not None:
+            self.calls[caller, callee] += 1
+        self.stack.append((callee, self.vm.sfp))
+
+    def _leave(self):
+        self._flush()
+        vm = self.vm
+        if vm.ip == 0xffff:
+            del self.stack[:]
+        # frames below the restored frame pointer are gone
+        while self.stack and self.stack[-1][1] < vm.sfp:
+            self.stack.pop()
+
+    ############ evaluation ############
+
+    total = property(lambda self: self._executed[0])
+
+    def function(self, address):
+        name = self.symbols.function_at(address) if self.symbols is not None else None
+        return name if name is not None else "%04x"%address
+
+    def by_address(self):
+        return dict((address, count) for (address, count) in enumerate(self.counts) if count)
+
+    def by_command(self):
+        memory = self.vm.memory
+        result = collections.defaultdict(int)
+        for (address, count) in self.by_address().items():
+            result[command_name(memory[address])] += count
+        return dict(result)
+
+    def by_function(self):
+        result = collections.defaultdict(int)
+        for (address, count) in self.by_address().items():
+            result[self.function(address)] += count
+        return dict(result)
+
+    def by_line(self):
+        if self.lines is None:
+            raise Exception("No line table given to the profiler")
+        result = collections.defaultdict(int)
+        for (address, count) in self.by_address().items():
+            result[self.lines.lookup(address)] += count
+        return dict(result)
+
+    def inclusive(self):
+        """Instructions executed in every function including the functions
+        it called"""
+        self._flush()
+        result = collections.defaultdict(int)
+        for (stack, count) in self.stacks.items():
+            for name in set(self.function(entry) for entry in stack):
+                result[name] += count
+        return dict(result)
+
+    def call_graph(self):
+        """Return {(caller, callee): number of calls} by function name"""
+        result = collections.defaultdict(int)
+        for ((caller, callee), count) in self.calls.items():
+            result[self.function(caller), self.function(callee)] += count
+        return dict(result)
+
+    ############ reports ############
+
+    def _table(self, counts, header):
+        total = float(self.total or 1)
+        lines = ["%10s %6s  %s"%("count", "share", header)]
+        for (key, count) in sorted(counts.items(), key=lambda (k, v): (-v, k)):
+            lines.append("%10d %5.1f%%  %s"%(count, 100 * count / total, key))
+        return "\n".join(lines)
+
+    def flat_report(self):
+        inclusive = self.inclusive()
+        total = float(self.total or 1)
+        lines = ["%10s %6s %10s %6s  %s"%("self", "share", "inclusive", "share", "function")]
+        for (name, count) in sorted(self.by_function().items(), key=lambda (k, v): (-v, k)):
+            incl = inclusive.get(name, count)
+            lines.append("%10d %5.1f%% %10d %5.1f%%  %s"%(count, 100 * count / total, incl, 100 * incl / total, name))
+        return "\n".join(lines)
+
+    def command_report(self):
+        return self._table(self.by_command(), "command")
+
+    def line_report(self):
+        return self._table(self.by_line(), "line")
+
+    def call_graph_report(self):
+        """For every function, list its callers and callees with the number
+        of calls"""
+        graph = self.call_graph()
+        names = sorted(set(self.by_function()) | set(n for edge in graph for n in edge))
+        inclusive = self.inclusive()
+        lines = []
+        for name in names:
+            lines.append("%s (%d instructions inclusive)"%(name, inclusive.get(name, 0)))
+            for ((caller, callee), count) in sorted(graph.items()):
+                if callee == name:
+                    lines.append("    %8d  called from %s"%(count, caller))
+            for ((caller, callee), count) in sorted(graph.items()):
+                if caller == name:
+                    lines.append("    %8d  calls %s"%(count, callee))
+        return "\n".join(lines)
+
+    def collapsed(self):
+        """Stacks in the collapsed format used by flamegraph.pl, one
+        ``outer;inner count`` line per stack"""
+        self._flush()
+        result = collections.defaultdict(int)
+        for (stack, count) in self.stacks.items():
+            if count:
+                result[";".join(self.function(entry) for entry in stack)] += count
+        return "".join("%s %d\n"%item for item in sorted(result.items()))
@@ -1,8 +1,13 @@
 import ast
+import bisect
+import marshal
+import multiprocessing
 from collections import namedtuple
 from embedvm import asm
 from embedvm.util import joining
 from embedvm import bytecode
+from embedvm.lines import LineTable
+from embedvm import incremental
 
 deduplicate = lambda iterable: reduce(lambda a, b: a if b in a else a+[b], iterable, [])
 
@@ -75,8 +80,9 @@ class Argument(CodeObject):
         context.code.append(bytecode.PopLocal(-1-self.index))
 
 class Function(CodeObject):
-    def __init__(self, name, args, body):
+    def __init__(self, name, args, body, lineno=None):
         self.name = name
+        self.lineno = lineno
         if args.kwarg or args.vararg:
             raise Exception("star-args not supported in function definitions")
         try:
@@ -140,6 +146,9 @@ class Function(CodeObject):
                 return self.program.globals[e.id]
             elif e.id in self.program.funcs:
                 return self.program.funcs[e.id]
+            elif e.id in self.program.externs:
+                # only names that are called (see _declare_externs)
+                return self.program.externs[e.id]
             else:
                 raise Exception("Can not resolve name %s"%e.id)
         elif isinstance(e, ast.Attribute):
@@ -154,7 +163,20 @@ class Function(CodeObject):
         else:
             raise Exception("Can not resolve %r to a CodeObject"%e)
 
+    def _tag_lines(self, start, lineno):
+        """Attribute the commands appended since index start to a source
+        line, unless they already belong to a (more specific) inner node"""
+        if lineno is None:
+            return
+        for command in self.code.code[start:]:
+            self.code.lines.setdefault(command, lineno)
+
     def append_push(self, value):
+        start = len(self.code.code)
+        self._append_push(value)
+        self._tag_lines(start, getattr(value, 'lineno', None))
+
+    def _append_push(self, value):
         if isinstance(value, int):
             self.code.append(bytecode.PushConstantV(value=value))
         elif isinstance(value, ast.AST):
@@ -247,6 +269,11 @@ class Function(CodeObject):
         return start, stop, step
 
     def _parse(self, s, break_jump=None, continue_jump=None):
+        start = len(self.code.code)
+        self._parse_statement(s, break_jump, continue_jump)
+        self._tag_lines(start, s.lineno)
+
+    def _parse_statement(self, s, break_jump, continue_jump):
         if isinstance(s, ast.Assign):
             self._parse_assign(s)
         elif isinstance(s, ast.For):
@@ -387,12 +414,146 @@ class Function(CodeObject):
         if not isinstance(self.code.code[-1], bytecode.Return):
             self.code.append(bytecode.Return0())
 
+        # entry, local variable setup and implicit return
+        self._tag_lines(0, self.lineno)
+
+class ExternalFunction(CodeObject):
+    """A function defined in another module, which the linker resolves (see
+    objfile.py). As its default arguments are unknown, calls have to pass
+    all arguments."""
+    def __init__(self, name):
+        self.name = name
+        self.entry_label = bytecode.Label("external function", id="extern:%s"%name)
+
+    def call(self, context, args, keywords, starargs, kwargs):
+        return self.PushableFunctioncall(self, args, keywords, starargs, kwargs)
+    class PushableFunctioncall(CodeObject, namedtuple("PushableExternalData", "function args keywords starargs kwargs")):
+        def push_value(self, context):
+            if self.starargs or self.keywords or self.kwargs:
+                raise Exception("Only positional arguments are supported.")
+            for a in self.args[::-1]:
+                context.append_push(a)
+            context.code.append(bytecode.CallV(self.function.entry_label.get_ref()))
+            if len(self.args) > 0:
+                context.code.append(bytecode.PopMany(len(self.args)-1))
+
+def _place(commands, start, labels):
+    """Return the positions of commands placed from start, and set the
+    relative addresses of those that refer to labels among them or in
+    labels (label -> position)"""
+    labels = dict(labels)
+    positions = []
+    pos = start
+    for c in commands:
+        positions.append(pos)
+        if isinstance(c, bytecode.Label):
+            labels[c] = pos
+        pos += c.length
+    for (c, pos) in zip(commands, positions):
+        if isinstance(c, bytecode.VariableAddressCommand) and isinstance(c.address, bytecode.Label.LabelRef):
+            c.reladdr = labels[c.address.ref] - pos
+    return positions
+
+def _relax(commands, start, labels):
+    """Choose the lengths of the variable length commands of a function
+    placed at start, like asm.FreeCodeBlock.fixed_code does for a whole
+    block; return the resulting length"""
+    _place(commands, start, labels)
+    for i in range(2):
+        for c in commands:
+            if isinstance(c, bytecode.VariableLengthCommand):
+                c.prebake()
+        _place(commands, start, labels)
+    return sum(c.length for c in commands)
+
+def _allocate(names, lengths, fixed, start):
+    """Return {name: address} of functions, those in fixed (name ->
+    (address, length)) at their address and the others in the first gap
+    from start on that is large enough for them"""
+    gaps = []
+    pos = start
+    for (address, length) in sorted(fixed.values()):
+        if address > pos:
+            gaps.append([pos, address])
+        pos = max(pos, address + length)
+    gaps.append([pos, 0x10000])
+
+    addresses = dict((name, address) for (name, (address, length)) in fixed.items())
+    for name in names:
+        if name in addresses:
+            continue
+        for gap in gaps:
+            if gap[1] - gap[0] >= lengths[name]:
+                addresses[name] = gap[0]
+                gap[0] += lengths[name]
+                break
+        else:
+            raise Exception("Function %s does not fit into memory"%name)
+    return addresses
+
+def _previous_nargs(commands, address, image):
+    """Return {command: nargs} of the variable length commands of a
+    function that were in image at address, as far as the commands there
+    are of the same kinds as these"""
+    nargs = {}
+    pos = address
+    for c in commands:
+        if isinstance(c, bytecode.Label):
+            continue
+        try:
+            previous = bytecode.interpret(image, pos)
+        except (bytecode.UnknownCommand, AssertionError, IndexError):
+            break
+        if type(previous.generalize(pos)) is not type(c):
+            break
+        if isinstance(c, bytecode.VariableLengthCommand):
+            nargs[c] = previous.length - 1 # they are all nargs + 1 bytes long
+        pos += previous.length
+    return nargs
+
+_LOCAL_LABELS = 1 << 30 # first label number in parallel code generation
+_parsing = None # the PythonProgram whose functions a process pool parses
+
+def _parse_function(name):
+    """Parse a function of _parsing in a worker process. Return its code
+    stream (see PythonProgram._encode) and the number of labels created."""
+    bytecode.Label.reset_counter(_LOCAL_LABELS)
+    f = _parsing.funcs[name]
+    f.parse()
+    return _parsing._encode(f, _LOCAL_LABELS), bytecode.Label.counter() - _LOCAL_LABELS
+
 class PythonProgram(asm.ASM):
-    def __init__(self):
+    def __init__(self, allow_externs=False, layout=None, pad_budget=256, previous_image=None):
+        """With allow_externs, names that are not defined in the program are
+        taken as functions of other modules (see objfile.py).
+
+        Given the symbols.SymbolTable of a previous build as layout, global
+        variables and functions are kept at their previous addresses where
+        possible, so that an updated image differs from the previous one in
+        as few places as possible (see :meth:`fix_all`). With the image of
+        that build as previous_image, the commands of functions that stay
+        in place don't get shorter than they were there either."""
         super(PythonProgram, self).__init__()
 
         self.globals = {'True': ConstantValue(1), 'False': ConstantValue(0)}
         self.funcs = {}
+        self.allow_externs = allow_externs
+        self.externs = {} # name -> ExternalFunction
+        self._state = None # incremental.BuildState of an incremental build
+
+        self.layout = layout
+        self.pad_budget = pad_budget
+        self.previous_image = bytearray(previous_image) if previous_image is not None else None
+        if layout is not None:
+            # used by runtime.Globals
+            self.pinned_globals = dict((name, address) for (name, (address, type)) in layout.by_name.items() if type == 'data')
+            code = [address for (address, name) in layout.functions()]
+            self.pinned_data_end = min(code) if code else 0
+
+    def extern(self, name):
+        if name not in self.externs:
+            self.externs[name] = ExternalFunction(name)
+        return self.externs[name]
 
     def _resolve(self, e):
         if isinstance(e, ast.Name):
@@ -436,7 +597,7 @@ class PythonProgram(asm.ASM):
                 target_obj.global_assign(right)
 
         elif isinstance(statement, ast.FunctionDef):
-            f = Function(statement.name, statement.args, statement.body)
+            f = Function(statement.name, statement.args, statement.body, statement.lineno)
             f.program = self
             self.funcs[statement.name] = f
             self.blocks.append(f.code)
@@ -448,22 +609,311 @@ class PythonProgram(asm.ASM):
         else:
             raise Exception("Unknown top level statement %r"%statement)
 
-    def read_python(self, data):
+    def _declare_externs(self):
+        """Create the ExternalFunctions of all names called but not defined
+        up front, so that the labels are numbered the same no matter in
+        which order (or in which process) functions are parsed"""
+        names = set()
+        for f in self.funcs.values():
+            for statement in f.body:
+                nodes = list(ast.walk(statement))
+                ranges = set(id(node.iter) for node in nodes if isinstance(node, ast.For))
+                names.update(node.func.id for node in nodes if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and id(node) not in ranges)
+        for name in sorted(names - set(self.globals) - set(self.funcs)):
+            self.extern(name)
+
+    def _encode(self, f, start):
+        """Return the code of a parsed function as a marshalled list of
+        (class name, attributes, source line relative to the def statement,
+        label references). Labels and the references to them, given as
+        (attribute, key) pairs, are replaced by keys: ('function', name) or
+        ('extern', name) for entry labels, and ('local', n) for the n-th
+        label created after the label counter was at start."""
+        keys = self._label_keys
+        key = lambda label: keys.get(label.id) or ('local', int(label.id[len("label"):]) - start)
+        lines = f.code.lines
+        stream = []
+        for c in f.code.code:
+            attributes = vars(c)
+            refs = tuple((k, key(v.ref)) for (k, v) in attributes.items() if isinstance(v, bytecode.Label.LabelRef))
+            if refs:
+                attributes = dict((k, v) for (k, v) in attributes.items() if not isinstance(v, bytecode.Label.LabelRef))
+            elif isinstance(c, bytecode.Label):
+                attributes = dict(attributes, id=key(c))
+            line = lines.get(c)
+            stream.append((type(c).__name__, attributes, line - f.lineno if line is not None else None, refs))
+        return marshal.dumps(stream)
+
+    def _decode(self, f, stream, counter, classes):
+        """Set the code of f from an _encode stream, numbering its local
+        labels as if they were created when the label counter was at
+        counter"""
+        def shared(key):
+            (kind, name) = key
+            return self.funcs[name].entry_label if kind == 'function' else self.extern(name).entry_label
+
+        labels = {} # key -> label created in this function
+        code = []
+        lines = {}
+        refs = []
+        for (classname, attributes, line, command_refs) in marshal.loads(stream):
+            if classname == 'Label' and attributes['id'][0] != 'local':
+                c = shared(attributes['id'])
+            else:
+                cls = classes.get(classname) or classes.setdefault(classname, getattr(bytecode, classname))
+                c = cls.__new__(cls)
+                c.__dict__ = attributes
+                if classname == 'Label':
+                    labels[c.id] = c
+                    c.id = "label%d"%(counter + c.id[1])
+                elif command_refs:
+                    refs.append((c, command_refs))
+            code.append(c)
+            if line is not None:
+                lines[c] = line + f.lineno
+        for (c, command_refs) in refs:
+            for (k, key) in command_refs:
+                setattr(c, k, (labels[key] if key[0] == 'local' else shared(key)).get_ref())
+        f.code.code = code
+        f.code.lines = lines
+
+    def _parse_parallel(self, jobs, names):
+        """Parse the named functions in a pool of jobs processes (which
+        inherit the program when forked); return {name: (code stream,
+        labels created)}"""
+        global _parsing
+        _parsing = self
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_parse_function, names, max(1, len(names) // (4 * jobs)))
+        finally:
+            pool.close()
+            pool.join()
+            _parsing = None
+        return dict(zip(names, results))
+
+    def read_python(self, data, jobs=None, state=None):
+        """Compile a program; with jobs > 1, the functions are parsed in
+        that many processes, with the same result.
+
+        With the incremental.BuildState of an earlier build, the functions
+        that did not change are taken from there instead of being parsed,
+        and fix_all keeps the previous layout if the rebuilt functions did
+        not change in length. The state is updated to this build. The names
+        of the functions that were parsed are in self.rebuilt."""
         t = ast.parse(data)
 
         for statement in t.body:
             self._parse_global_statement(statement)
 
-        for fn, f in self.funcs.items():
-            f.parse()
+        if self.allow_externs:
+            self._declare_externs()
+
+        self._label_keys = dict((f.entry_label.id, ('function', name)) for (name, f) in self.funcs.items())
+        self._label_keys.update((e.entry_label.id, ('extern', name)) for (name, e) in self.externs.items())
+
+        reused = {}
+        if state is not None:
+            context = incremental.context_digest(t, [('allow_externs', self.allow_externs)])
+            fingerprints = incremental.function_fingerprints(t)
+            reused = state.reusable(context, fingerprints)
+        names = list(self.funcs)
+        self.rebuilt = [name for name in names if name not in reused]
+
+        if jobs is not None and jobs > 1 and len(self.rebuilt) > 1:
+            streams = self._parse_parallel(jobs, self.rebuilt)
+        else:
+            streams = {}
+        # in order, so that labels are numbered the same no matter how the
+        # code was obtained
+        classes = {}
+        for name in names:
+            f = self.funcs[name]
+            counter = bytecode.Label.counter()
+            if name in streams or name in reused:
+                (stream, created) = streams.get(name) or reused[name]
+                self._decode(f, stream, counter, classes)
+                bytecode.Label.reset_counter(counter + created)
+            else:
+                f.parse()
+                if state is not None:
+                    streams[name] = (self._encode(f, counter), bytecode.Label.counter() - counter)
+
+        if state is not None:
+            state.context = context
+            state.functions = dict((name, (fingerprints[name], ) + (streams.get(name) or reused[name])) for name in names)
+            self._state = state
 
         # merge function blocks so calls can be solved in a relative (short address) way
         bigblock = asm.FreeCodeBlock()
-        for f in self.funcs.values():
+        self._functions = [] # (name, index of the first command, index after the last) in bigblock
+        for (name, f) in self.funcs.items():
             self.blocks.remove(f.code)
+            self._functions.append((name, len(bigblock.code), len(bigblock.code) + len(f.code.code)))
             bigblock.code.extend(f.code.code)
+            bigblock.lines.update(f.code.lines)
 
         self.blocks.append(bigblock)
+        self._bigblock = bigblock
+
+    def fix_all(self):
+        self.relaxed_in_place = False
+        if self.layout is not None:
+            self._fix_pinned()
+            if self._state is not None:
+                self._state.layout = None # the functions are not contiguous
+            return
+        if self._state is None:
+            return super(PythonProgram, self).fix_all()
+
+        index = self.blocks.index(self._bigblock)
+        start = sum(b.length for b in self.blocks[:index])
+        self.relaxed_in_place = self._relax_in_place(start)
+        if not self.relaxed_in_place:
+            super(PythonProgram, self).fix_all()
+
+        functions = []
+        pos = start
+        for (name, first, last) in self._functions:
+            commands = self._bigblock.code[first:last]
+            length = sum(c.length for c in commands)
+            functions.append((name, pos, length, [c.nargs for c in commands if isinstance(c, bytecode.VariableLengthCommand)]))
+            pos += length
+        self._state.layout = (start, functions)
+
+    def _relax_in_place(self, start):
+        """Fix the code at the positions of the previous build, relaxing
+        only the rebuilt functions; return False (leaving the code unfixed)
+        if one of them does not keep its previous length"""
+        if self._state.layout is None or sum(isinstance(b, asm.FreeCodeBlock) for b in self.blocks) != 1:
+            return False
+        (previous_start, previous) = self._state.layout
+        if previous_start != start or [p[0] for p in previous] != [name for (name, first, last) in self._functions]:
+            return False
+
+        code = self._bigblock.code
+        entries = dict((self.funcs[name].entry_label, pos) for (name, pos, length, nargs) in previous)
+        rebuilt = set(self.rebuilt)
+        variable = [c for c in code if isinstance(c, bytecode.VariableLengthCommand)]
+        saved = [c.__dict__.get('nargs') for c in variable]
+        for ((name, first, last), (_, pos, length, nargs)) in zip(self._functions, previous):
+            commands = code[first:last]
+            if name in rebuilt:
+                relaxed = _relax(commands, pos, entries)
+            else:
+                for (c, n) in zip((c for c in commands if isinstance(c, bytecode.VariableLengthCommand)), nargs):
+                    c.nargs = n
+                relaxed = sum(c.length for c in commands)
+            if relaxed != length:
+                for (c, n) in zip(variable, saved):
+                    if n is None:
+                        c.__dict__.pop('nargs', None)
+                    else:
+                        c.nargs = n
+                return False
+
+        positions = _place(code, start, {})
+        self.blocks[self.blocks.index(self._bigblock)] = self._bigblock.fixed_block(positions)
+        return True
+
+    def _fix_pinned(self):
+        """Fix the code with every function at its address in self.layout if
+        it still fits there (before the next symbol); the others go into
+        the first gap they fit in, or after the end. The gaps are padded.
+        If that takes more than pad_budget bytes of padding, the code is
+        laid out compactly as usual instead.
+
+        Commands of functions that keep their address are at least as long
+        as in self.previous_image, so that the rest of a function does not
+        move when a jump or call in it could get shorter."""
+        index = self.blocks.index(self._bigblock)
+        start = sum(b.length for b in self.blocks[:index])
+        code = self._bigblock.code
+        functions = [(name, code[first:last]) for (name, first, last) in self._functions]
+        entries = dict((name, self.funcs[name].entry_label) for (name, commands) in functions)
+        variable = [c for c in code if isinstance(c, bytecode.VariableLengthCommand)]
+
+        boundaries = sorted(set(address for (address, type) in self.layout.by_name.values()))
+        slots = {} # name -> (address, end) of the space the function had
+        for (address, name) in self.layout.functions():
+            if name in entries and address >= start:
+                following = boundaries[bisect.bisect_right(boundaries, address):]
+                slots[name] = (address, following[0] if following else 0x10000)
+        previous = dict((name, address) for (name, (address, end)) in slots.items())
+        floors = {} # name -> {command: smallest nargs}
+        if self.previous_image is not None:
+            for (name, commands) in functions:
+                if name in slots:
+                    floors[name] = _previous_nargs(commands, slots[name][0], self.previous_image)
+
+        # from the worst case, shrink twice like FreeCodeBlock.fixed_code does
+        # (the second time for code placed after code that shrank), then
+        # only grow commands until nothing changes
+        shrinking = 2
+        while True:
+            lengths = dict((name, sum(c.length for c in commands)) for (name, commands) in functions)
+            if shrinking:
+                fixed = dict((name, (address, min(lengths[name], end - address))) for (name, (address, end)) in slots.items())
+            else:
+                slots = dict((name, (address, end)) for (name, (address, end)) in slots.items() if address + lengths[name] <= end)
+                fixed = dict((name, (address, lengths[name])) for (name, (address, end)) in slots.items())
+            addresses = _allocate([name for (name, commands) in functions], lengths, fixed, start)
+            labels = dict((entries[name], address) for (name, address) in addresses.items())
+            for (name, commands) in functions:
+                _place(commands, addresses[name], labels)
+            floor = {}
+            for name in slots:
+                floor.update(floors.get(name, {}))
+            grown = False
+            for c in variable:
+                before = c.nargs
+                c.prebake()
+                if not shrinking and c.nargs < before:
+                    c.nargs = before
+                if c.nargs < floor.get(c, 0):
+                    c.nargs = floor[c]
+                grown = grown or c.nargs != before
+            if not shrinking and not grown:
+                break
+            shrinking = max(shrinking - 1, 0)
+
+        end = max(addresses[name] + lengths[name] for (name, commands) in functions) if functions else start
+        self.padding = end - start - sum(lengths.values())
+        self.moved = sorted(name for (name, commands) in functions if addresses[name] != previous.get(name))
+        self.pinned_layout = self.padding <= self.pad_budget
+        if not self.pinned_layout:
+            for c in variable:
+                c.__dict__.pop('nargs', None)
+            return super(PythonProgram, self).fix_all()
+
+        positions = []
+        for (name, commands) in functions:
+            positions.extend(_place(commands, addresses[name], labels))
+        fixed = self._bigblock.fixed_block(positions)
+
+        # split into contiguous blocks, padding the gaps (with what was there
+        # in the previous image, so that they don't differ from it)
+        previous_image = self.previous_image or bytearray()
+        blocks = []
+        pos = start
+        run = None
+        for (address, command) in sorted(fixed.code.items()):
+            if address != pos:
+                padding = asm.DataBlock()
+                padding.data = list(previous_image[pos:address])
+                padding.data += [0] * (address - pos - len(padding.data))
+                blocks.append(padding)
+                run = None
+            if run is None:
+                run = asm.FixedPositionCodeBlock()
+                blocks.append(run)
+            run.code[address] = command
+            if address in fixed.lines:
+                run.lines[address] = fixed.lines[address]
+            pos = address + command.length
+        if blocks:
+            blocks[1 if isinstance(blocks[0], asm.DataBlock) else 0].sym = fixed.sym
+        self.blocks[index:index + 1] = blocks
 
     def get_symbols(self):
         sym = {}
@@ -471,3 +921,15 @@ class PythonProgram(asm.ASM):
             if hasattr(b, 'sym'):
                 sym.update(b.sym)
         return sym
+
+    def get_lines(self, filename=""):
+        """Return a LineTable for the code blocks (which have to be
+        fixed)"""
+        ranges = []
+        for b in self.blocks:
+            if isinstance(b, asm.FreeCodeBlock):
+                raise Exception("Line numbers are only known after fix_all")
+            if isinstance(b, asm.FixedPositionCodeBlock):
+                for (pos, line) in b.lines.items():
+                    ranges.append((pos, pos + b.code[pos].length, line))
+        return LineTable.from_ranges(ranges, filename)
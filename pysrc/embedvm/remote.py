@@ -0,0 +1,40 @@
+import json
+import os
+import socket
+
+# kept free of the compiler's imports, so that clients start quickly
+
+def send(connection, message):
+    connection.sendall(json.dumps(message))
+    connection.shutdown(socket.SHUT_WR)
+
+def receive(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads("".join(chunks))
+
+def request(path, message):
+    """Send a message (a dict) to the compile server listening on the Unix
+    socket at path, and return its reply"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        send(connection, message)
+        return receive(connection)
+    finally:
+        connection.close()
+
+def run(path, argv, cwd=None):
+    """Have the server run a tool command line (e.g. ['evm-pycomp',
+    'file.py']) in cwd (default: the current directory), and return
+    (status, stdout, stderr)"""
+    reply = request(path, {'argv': list(argv), 'cwd': os.path.abspath(cwd or os.curdir)})
+    return reply['status'], reply['stdout'], reply['stderr']
+
+def stop(path):
+    """Make the server finish the requests it has accepted and exit"""
+    request(path, {'shutdown': True})
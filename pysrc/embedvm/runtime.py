@@ -1,11 +1,23 @@
 from .bytecode import signext, assert_signexted
+from .util import pack16, unpack16, unpack8s
 from . import bytecode
 from .python import CodeObject, raising_int, UnboundSetter
 from .asm import DataBlock
 from collections import namedtuple
 import ast
+import contextlib
+import copy
+import ctypes
+import mmap
+import os
+import time
 from math import ceil
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Importable(CodeObject):
     """All objects that are supposed to be imported into a EVM Python program
     need to subclass this to indicate that they will react properly to code
@@ -33,6 +45,8 @@ class _UserfuncWrapper(Importable):
         self.__which = which
         self.__func = func
 
+    which = property(lambda self: self.__which)
+
     def __call__(self, *args, **kwargs):
         return self.__func(*args, **kwargs)
 
@@ -84,27 +98,10 @@ class _C_Division(Importable):
             context.code.append(bytecode.Div())
 c_division = _C_Division()
 
-class Globals(list):
-    """Enhanced list of uint8 values that supports the access modes needed for
-    the EVM. It also supports views on global arrays and variables.
-
-    While write access to views on arrays can be implemented easily (like
-    ``my_array = gv.array16(0); my_array[23] = 42``, a trick is employed to
-    implement write access single variables (assigning to which would overwrite
-    the binding): If something is assigned to a Globals, it is remembered in
-    _known_view. On later assignments, instead of re-assigning, the previously
-    assigned value's set function is called with the new value::
-
-        >>> gv = Globals([0]*16)
-        >>> gv.foo = gv.array8s(address=0)
-        >>> gv.bar = gv.int8s(address=8)
-        >>> gv.foo[7] = 10
-        >>> gv.bar = 9
-    """
-
-    def __init__(self, *args):
-        super(Globals, self).__init__(*args)
-        self.__dict__['_known_view'] = {}
+class _GlobalsBase(object):
+    """Access modes and views shared by the Globals implementations. Concrete
+    classes provide the uint8 storage through item access, len() and
+    extend()."""
 
     def __setattr__(self, key, value):
         if key in self._known_view:
@@ -131,7 +128,7 @@ class Globals(list):
         if len(self) < address+2:
             self.extend([0]*(address+2-len(self)))
         assert_signexted(value, 0xffff)
-        self[address:address+2] = divmod(value, 0x100)
+        self[address:address+2] = ((value >> 8) & 0xff, value & 0xff)
     def set8s(self, address, value):
         if len(self) < address+1:
             self.extend([0]*(address+1-len(self)))
@@ -142,6 +139,47 @@ class Globals(list):
             self.extend([0]*(address+1-len(self)))
         self[address] = value & 0xff
 
+    def _element_address(self, view, index):
+        """Address of element index of an array view; indices are checked
+        and negative ones count from the end, like for lists"""
+        if not -view.length <= index < view.length:
+            raise IndexError("Global array index out of range")
+        if index < 0:
+            index += view.length
+        return view.address + view.sizeofelement * index
+
+    def _reserve(self, end):
+        if len(self) < end:
+            self.extend([0]*(end-len(self)))
+
+    # bulk access to consecutive elements
+
+    def getarray16(self, address, count):
+        self._reserve(address+2*count)
+        return unpack16(self[address:address+2*count])
+    def getarray8s(self, address, count):
+        self._reserve(address+count)
+        return unpack8s(self[address:address+count])
+    def getarray8u(self, address, count):
+        self._reserve(address+count)
+        return list(self[address:address+count])
+    def setarray16(self, address, values):
+        values = list(values)
+        if values:
+            assert -0x8000 <= min(values) and max(values) <= 0x7fff
+        self._reserve(address+2*len(values))
+        self[address:address+2*len(values)] = pack16(values)
+    def setarray8s(self, address, values):
+        values = list(values)
+        if values:
+            assert -0x80 <= min(values) and max(values) <= 0x7f
+        self._reserve(address+len(values))
+        self[address:address+len(values)] = bytearray(v & 0xff for v in values)
+    def setarray8u(self, address, values):
+        values = list(values)
+        self._reserve(address+len(values))
+        self[address:address+len(values)] = bytearray(v & 0xff for v in values)
+
     array16 = lambda self, address=None, init=None, length=None: self.ArrayView16(self, address, init, length)
     array8u = lambda self, address=None, init=None, length=None: self.ArrayView8u(self, address, init, length)
     array8s = lambda self, address=None, init=None, length=None: self.ArrayView8s(self, address, init, length)
@@ -176,31 +214,86 @@ class Globals(list):
         def __init__(self, gv, address, init_value, length):
             super(gv.ArrayView, self).__init__(gv, address)
 
-            if init_value is not None:
-                for (i, x) in enumerate(init_value):
-                    self[i] = x
-            if length is not None:
-                for i in range(length):
-                    self[i] = self[i] # make sure gv is long enough
-                self.length = length
             if length is None and init_value is None:
                 raise Exception("Undespecified array")
+            if init_value is not None:
+                init_value = list(init_value)
+            self.length = length if length is not None else len(init_value)
+
+            gv._reserve(self.address + self.length * self.sizeofelement) # make sure gv is long enough
+            if init_value is not None:
+                self.load(init_value)
 
         def get(self):
             return self
 
+        def __len__(self):
+            return self.length
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(self.length)
+                indices = range(start, stop, step)
+                if not indices:
+                    return []
+                first, last = min(indices[0], indices[-1]), max(indices[0], indices[-1])
+                block = self._getarray(self.address + first * self.sizeofelement, last - first + 1)
+                return block[indices[0] - first::step]
+            return self._get(self.gv._element_address(self, index))
+
+        def __setitem__(self, index, value):
+            if isinstance(index, slice):
+                indices = range(*index.indices(self.length))
+                value = list(value)
+                if len(value) != len(indices):
+                    raise ValueError("Global arrays can not be resized")
+                if indices and (index.step is None or index.step == 1):
+                    self._setarray(self.address + indices[0] * self.sizeofelement, value)
+                else:
+                    for (i, v) in zip(indices, value):
+                        self._set(self.address + i * self.sizeofelement, v)
+            else:
+                self._set(self.gv._element_address(self, index), value)
+
+        def load(self, values, start=0):
+            """Write the elements of values into the array, beginning at index
+            start"""
+            values = list(values)
+            if start + len(values) > self.length:
+                raise ValueError("Too many values for global array")
+            self._setarray(self.address + start * self.sizeofelement, values)
+
+        def to_list(self):
+            return self._getarray(self.address, self.length)
+
+        def as_numpy(self):
+            """Return a NumPy array that shares memory with the global
+            variables"""
+            if numpy is None:
+                raise Exception("NumPy is required for as_numpy")
+            return numpy.frombuffer(self.gv.databuffer, dtype=self.numpy_dtype, count=self.length, offset=self.address)
+
     class ArrayView8s(ArrayView):
         sizeofelement = 1
-        __getitem__ = lambda self, index: self.gv.get8s(self.address + index)
-        __setitem__ = lambda self, index, value: self.gv.set8s(self.address + index, value)
+        numpy_dtype = 'i1'
+        _get = lambda self, address: self.gv.get8s(address)
+        _set = lambda self, address, value: self.gv.set8s(address, value)
+        _getarray = lambda self, address, count: self.gv.getarray8s(address, count)
+        _setarray = lambda self, address, values: self.gv.setarray8s(address, values)
     class ArrayView8u(ArrayView):
         sizeofelement = 1
-        __getitem__ = lambda self, index: self.gv.get8u(self.address + index)
-        __setitem__ = lambda self, index, value: self.gv.set8u(self.address + index, value)
+        numpy_dtype = 'u1'
+        _get = lambda self, address: self.gv.get8u(address)
+        _set = lambda self, address, value: self.gv.set8u(address, value)
+        _getarray = lambda self, address, count: self.gv.getarray8u(address, count)
+        _setarray = lambda self, address, values: self.gv.setarray8u(address, values)
     class ArrayView16(ArrayView):
         sizeofelement = 2
-        __getitem__ = lambda self, index: self.gv.get16(self.address + 2*index)
-        __setitem__ = lambda self, index, value: self.gv.set16(self.address + 2*index, value)
+        numpy_dtype = '>i2'
+        _get = lambda self, address: self.gv.get16(address)
+        _set = lambda self, address, value: self.gv.set16(address, value)
+        _getarray = lambda self, address, count: self.gv.getarray16(address, count)
+        _setarray = lambda self, address, values: self.gv.setarray16(address, values)
 
     @classmethod
     def import_to_codeobject(cls, self):
@@ -225,14 +318,26 @@ class Globals(list):
             self.assigned = []
             self.named = {} # name -> view object
             self.pos = 0
+            self.pinned = {} # name -> address in a previous build
+            self.reserved = 0 # end of the variables of the previous build
 
         length = property(lambda self: self.pos)
 
+        # exported like the data symbols of evmcomp
+        sym = property(lambda self: dict((name, (view.pos, "data")) for (name, view) in self.named.items()))
+
+        def variables(self):
+            """Return {name: (address, size in bytes)} of the named views"""
+            return dict((name, (view.pos, view.bytes)) for (name, view) in self.named.items())
+
         @classmethod
         def call(cls, context, args, keywords, starargs, kwargs):
             if args or keywords or starargs or kwargs:
                 raise Exception("Global object can't take any arguments")
             gco = cls()
+            # see PythonProgram's layout
+            gco.pinned = getattr(context, 'pinned_globals', {})
+            gco.reserved = getattr(context, 'pinned_data_end', 0)
             context.blocks.append(gco)
             return gco
 
@@ -243,20 +348,31 @@ class Globals(list):
                 return self.named[attr]
             else:
                 def assign_value(value):
+                    value.pos = self._position(attr, value)
                     self.named[attr] = value
-                    value.pos = self.pos
                     if value.specified_pos is not None and value.specified_pos != value.pos:
                         raise Exception("Following forced memory alignment is only supported if it fits.")
-                    self.pos += value.bytes
+                    self.pos = max(self.pos, value.pos + value.bytes)
                 return UnboundSetter(assign_value)
 
+        def _position(self, name, view):
+            """Address of a new variable: after the others, or when pinned
+            to a previous build, its address there if that is still free
+            (new variables go after all previous ones)"""
+            if not self.pinned:
+                return self.pos
+            address = view.specified_pos if view.specified_pos is not None else self.pinned.get(name)
+            if address is not None and all(address + view.bytes <= v.pos or v.pos + v.bytes <= address for v in self.named.values()):
+                return address
+            return max(self.pos, self.reserved)
+
         def to_binary(self, startpos):
-            data = [0] * self.pos
+            data = bytearray(self.pos)
 
             for view in self.named.values():
                 view.store_initial_value(data)
 
-            return data
+            return list(data)
 
         class View(CodeObject):
             def __init__(self, gv):
@@ -339,28 +455,23 @@ class Globals(list):
             bytes_per_item = 1
             store_code = bytecode.GlobalStoreS8
             load_code = bytecode.GlobalLoadS8
-            def store_initial_value(self, list):
+            def store_initial_value(self, data):
                 if self.init is not None:
-                    for (i, v) in enumerate(self.init):
-                        list[self.pos + i] = v % 256
+                    data[self.pos:self.pos + len(self.init)] = bytearray(v & 0xff for v in self.init)
         class ArrayView8u(ArrayView):
             bytes_per_item = 1
             store_code = bytecode.GlobalStoreU8
             load_code = bytecode.GlobalLoadU8
-            def store_initial_value(self, list):
+            def store_initial_value(self, data):
                 if self.init is not None:
-                    for (i, v) in enumerate(self.init):
-                        list[self.pos + i] = v % 256
+                    data[self.pos:self.pos + len(self.init)] = bytearray(v & 0xff for v in self.init)
         class ArrayView16(ArrayView):
             bytes_per_item = 2
             store_code = bytecode.GlobalStore16
             load_code = bytecode.GlobalLoad16
-            def store_initial_value(self, list):
+            def store_initial_value(self, data):
                 if self.init is not None:
-                    for (i, v) in enumerate(self.init):
-                        a, b = divmod(v, 0x100)
-                        a = a % 0x100
-                        list[self.pos + 2*i:self.pos + 2*i + 2] = a, b
+                    data[self.pos:self.pos + 2*len(self.init)] = pack16(self.init)
 
         accessor_types = {
                 'int8s': SingleView8s,
@@ -370,3 +481,152 @@ class Globals(list):
                 'array8u': ArrayView8u,
                 'array16': ArrayView16,
                 }
+
+class Globals(_GlobalsBase, bytearray):
+    """Enhanced bytearray that supports the access modes needed for the EVM.
+    It also supports views on global arrays and variables.
+
+    While write access to views on arrays can be implemented easily (like
+    ``my_array = gv.array16(0); my_array[23] = 42``, a trick is employed to
+    implement write access single variables (assigning to which would overwrite
+    the binding): If something is assigned to a Globals, it is remembered in
+    _known_view. On later assignments, instead of re-assigning, the previously
+    assigned value's set function is called with the new value::
+
+        >>> gv = Globals([0]*16)
+        >>> gv.foo = gv.array8s(address=0, length=8)
+        >>> gv.bar = gv.int8s(address=8)
+        >>> gv.foo[7] = 10
+        >>> gv.bar = 9
+
+    Array views can also be accessed in bulk, either with slices, with
+    ``load``/``to_list`` or (if NumPy is installed) as an array that shares
+    memory with the Globals object::
+
+        >>> gv.baz = gv.array16(length=4)
+        >>> gv.baz.load([1, -2, 3])
+        >>> gv.baz[1:]
+        [-2, 3, 0]
+        >>> gv.baz.as_numpy() # doctest: +SKIP
+        array([ 1, -2,  3,  0], dtype='>i2')
+
+    The NumPy array stays valid only as long as the Globals object is not
+    resized.
+    """
+
+    def __init__(self, *args):
+        super(Globals, self).__init__(*args)
+        self.__dict__['_known_view'] = {}
+
+    databuffer = property(lambda self: self)
+
+class MappedGlobals(_GlobalsBase):
+    """Globals whose memory is an mmap'ed file, so that several processes
+    (e.g. a natively running program, a simulator and monitoring tools) can
+    work on the same variables without copying.
+
+    The first ``size`` bytes of the file are laid out exactly like the global
+    data block in the VM (see GlobalCodeObject.to_binary); they are followed
+    by a small trailer holding a sequence counter. Every write to the memory
+    increments the counter to an odd value before and to an even value after
+    modifying the data, so readers can detect and retry torn reads
+    (:meth:`snapshot` does that). There may only be a single writing process
+    at a time.
+
+    In an EVM Python program, ``gv = MappedGlobals("/dev/shm/state")`` can be
+    used instead of ``gv = Globals()``; the compiler ignores the arguments.
+
+    (``multiprocessing.shared_memory`` is not used as it is not available on
+    Python 2; mapping a file from /dev/shm gives the same result.)
+    """
+
+    _trailer = 8
+
+    def __init__(self, filename, size=None):
+        if size is None:
+            size = os.path.getsize(filename) - self._trailer
+        f = open(filename, 'a+b')
+        try:
+            if os.fstat(f.fileno()).st_size < size + self._trailer:
+                f.truncate(size + self._trailer)
+            mapping = mmap.mmap(f.fileno(), size + self._trailer)
+        finally:
+            f.close()
+
+        self.__dict__['_known_view'] = {}
+        self.__dict__['size'] = size
+        self.__dict__['_map'] = mapping
+        self.__dict__['_bytes'] = (ctypes.c_uint8 * size).from_buffer(mapping)
+        self.__dict__['_seq'] = ctypes.c_uint32.from_buffer(mapping, size)
+        self.__dict__['_write_depth'] = 0
+        self.__dict__['_allocated'] = 0
+
+    databuffer = property(lambda self: self._map)
+
+    def __len__(self):
+        # the mapping always has its full size, but new views need to be
+        # placed behind the ones already allocated just as with Globals
+        return self._allocated
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return bytearray(self._map[index])
+        return self._bytes[index]
+
+    def __setitem__(self, index, value):
+        with self.writing():
+            if isinstance(index, slice):
+                self._map[index] = bytes(bytearray(value))
+            else:
+                self._bytes[index] = value
+
+    def extend(self, data):
+        # the memory is left alone, it might already be in use by another
+        # process
+        if self._allocated + len(data) > self.size:
+            raise Exception("Mapped globals can not be extended beyond %d bytes"%self.size)
+        self.__dict__['_allocated'] += len(data)
+
+    @contextlib.contextmanager
+    def writing(self):
+        """Context manager that makes all writes inside appear atomic to
+        snapshot readers"""
+        if not self._write_depth:
+            self._seq.value += 1
+        self.__dict__['_write_depth'] += 1
+        try:
+            yield
+        finally:
+            self.__dict__['_write_depth'] -= 1
+            if not self._write_depth:
+                self._seq.value += 1
+
+    def snapshot(self):
+        """Return a consistent copy of the memory as a Globals object which
+        has the same views as self"""
+        while True:
+            before = self._seq.value
+            if before & 1:
+                time.sleep(0)
+                continue
+            data = self._map[:self.size]
+            if self._seq.value == before:
+                break
+
+        copy_ = Globals(data)
+        for (name, view) in self._known_view.items():
+            view = copy.copy(view)
+            view.gv = copy_
+            copy_.__dict__['_known_view'][name] = view
+        return copy_
+
+    def close(self):
+        for k in ('_bytes', '_seq'):
+            del self.__dict__[k]
+        self._map.close()
+
+    class GlobalCodeObject(_GlobalsBase.GlobalCodeObject):
+        @classmethod
+        def call(cls, context, args, keywords, starargs, kwargs):
+            # the arguments only describe the mapping on the host side
+            return super(MappedGlobals.GlobalCodeObject, cls).call(context, [], [], None, None)
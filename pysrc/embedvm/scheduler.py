@@ -0,0 +1,110 @@
+import time
+
+from .eventloop import EventLoop
+from .vm import VM
+
+class Context(object):
+    """A VM managed by a Scheduler, together with its scheduling parameters
+    and the resources it used so far"""
+    def __init__(self, vm, name, priority, slice, time_slice):
+        self.vm = vm
+        self.name = name
+        self.priority = priority
+        self.slice = slice
+        self.time_slice = time_slice
+
+        self.instructions = 0
+        self.cpu_time = 0.
+        self.slices = 0
+        self.waits = 0
+
+    @property
+    def state(self):
+        if self.vm.finished:
+            return "finished"
+        elif self.vm.waiting is not None:
+            return "waiting"
+        else:
+            return "ready"
+
+    def __repr__(self):
+        return "<%s %s, priority %d, %s, %d instructions>"%(type(self).__name__, self.name, self.priority, self.state, self.instructions)
+
+class Scheduler(EventLoop):
+    """Event loop that runs many VMs fairly.
+
+    Each VM gets a context with a priority: as long as VMs of a higher
+    priority are ready to run, lower priority VMs only get to run while those
+    wait for user functions. VMs of the same priority take turns, each
+    running for its instruction budget (``slice``) or, if ``time_slice`` is
+    set, for that many seconds of host time.
+
+    The instructions executed and the host time spent in every VM are
+    accounted in its Context (see :meth:`report`)."""
+
+    # granularity in which time slices are checked against the clock
+    time_check_interval = 200
+
+    def __init__(self, slice=1000, time_slice=None, clock=time.time, timer=time.time):
+        super(Scheduler, self).__init__(slice, clock)
+        self.time_slice = time_slice
+        self.timer = timer
+        self.contexts = {} # vm -> Context
+
+    def add(self, vm, name=None, priority=0, slice=None, time_slice=None):
+        """Schedule a VM that has been prepared to run (e.g. by
+        VM.interrupt) and return its Context. slice and time_slice default to
+        the scheduler's values."""
+        context = Context(vm, name or "vm%d"%len(self.contexts), priority,
+                slice if slice is not None else self.slice,
+                time_slice if time_slice is not None else self.time_slice)
+        self.contexts[vm] = context
+        super(Scheduler, self).add(vm)
+        return context
+
+    def spawn(self, image, entry, userfuncs=(), **kwargs):
+        """Create a VM with image loaded at address 0, prepare it to run the
+        function at entry and schedule it. userfuncs are passed to
+        VM.set_userfunc. Further arguments are passed to add."""
+        vm = VM()
+        vm.load(image)
+        for f in userfuncs:
+            vm.set_userfunc(f)
+        vm.interrupt(entry)
+        return self.add(vm, **kwargs)
+
+    def run_once(self):
+        if self.ready:
+            top = max(self.contexts[vm].priority for vm in self.ready)
+            for i in range(len(self.ready)):
+                vm = self.ready.popleft()
+                if self.contexts[vm].priority == top:
+                    self._serve(vm)
+                else:
+                    self.ready.append(vm)
+
+        self._wait(0 if self.ready else None)
+
+    def _run_slice(self, vm):
+        context = self.contexts[vm]
+        start = self.timer()
+        if context.time_slice is None:
+            executed = vm.run(context.slice)
+        else:
+            executed = 0
+            deadline = start + context.time_slice
+            while not vm.finished and vm.waiting is None and self.timer() < deadline:
+                executed += vm.run(self.time_check_interval)
+        context.cpu_time += self.timer() - start
+        context.instructions += executed
+        context.slices += 1
+        if vm.waiting is not None:
+            context.waits += 1
+
+    def report(self):
+        """Return a table of the resources used by the VMs as a string"""
+        total = sum(c.cpu_time for c in self.contexts.values()) or 1
+        lines = ["%-16s %4s %-8s %12s %8s %6s %8s %6s"%("name", "prio", "state", "instructions", "slices", "waits", "seconds", "share")]
+        for c in sorted(self.contexts.values(), key=lambda c: (-c.priority, c.name)):
+            lines.append("%-16s %4d %-8s %12d %8d %6d %8.3f %5.1f%%"%(c.name, c.priority, c.state, c.instructions, c.slices, c.waits, c.cpu_time, 100 * c.cpu_time / total))
+        return "\n".join(lines)
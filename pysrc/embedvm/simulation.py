@@ -0,0 +1,202 @@
+import collections
+import heapq
+import itertools
+
+from .eventloop import Sleep, Return
+
+# An ATmega168 at 16MHz executes about 75 VM instructions per millisecond
+# (see README)
+DEFAULT_FREQUENCY = 16000000
+DEFAULT_CYCLES = 213
+
+class Simulation(object):
+    """Runs a VM against a simulated clock, delivering interrupts (like
+    ``embedvm_interrupt`` in vmsrc/embedvm.h) from timers and external events.
+
+    Every executed instruction advances the clock by its cost in ``costs``
+    (indexed by opcode). When the VM is idle -- it has returned from all
+    functions, or sleeps in a user function -- the clock skips directly to
+    the next event, so long periods of simulated time pass quickly.
+
+    Interrupt handlers are given by address or by a name from ``symbols``,
+    which can be the result of PythonProgram.get_symbols() (or any mapping of
+    names to addresses). Unless ``nested`` is set, an interrupt is only
+    delivered after the previous handler has returned; until then it stays
+    in ``pending``.
+
+    User functions can make the VM idle by returning a generator that yields
+    ``eventloop.Sleep`` (in simulated seconds) or None (to sleep until the
+    next event), see :meth:`sleep`."""
+
+    def __init__(self, vm, symbols=None, costs=None, frequency=DEFAULT_FREQUENCY, nested=False, interrupt_cost=0):
+        self.vm = vm
+        self.symbols = symbols or {}
+        self.costs = costs if costs is not None else [DEFAULT_CYCLES] * 256
+        self.frequency = frequency
+        self.nested = nested
+        self.interrupt_cost = interrupt_cost
+
+        self.cycles = 0
+        self.idle_cycles = 0
+        self.instructions = 0
+        self.delivered = 0
+
+        self.events = [] # heap of (cycle, sequence number, action)
+        self.pending = collections.deque() # interrupt addresses
+        self.active = [] # stack pointers before the running handlers were entered
+        self._sequence = itertools.count()
+        self._wakeup = None # cycle at which a sleeping user function returns
+
+    time = property(lambda self: float(self.cycles) / self.frequency, doc="Simulated time in seconds")
+
+    def _address(self, handler):
+        if isinstance(handler, (int, long)):
+            return handler
+        address = self.symbols[handler]
+        if isinstance(address, tuple): # from get_symbols: (address, type)
+            address = address[0]
+        return address
+
+    def _schedule(self, cycle, action):
+        heapq.heappush(self.events, (cycle, next(self._sequence), action))
+
+    def at(self, time, action):
+        """At the given simulated time, raise an interrupt for the handler
+        action (an address or symbol name), or call action with the
+        simulation as argument if it is callable."""
+        if not callable(action):
+            handler = self._address(action)
+            action = lambda sim: sim.interrupt(handler)
+        self._schedule(int(time * self.frequency), action)
+
+    def every(self, period, action, start=None, count=None):
+        """Like at, but repeat every period seconds, starting at start
+        (default: one period from now), count times (default: forever)"""
+        if not callable(action):
+            handler = self._address(action)
+            action = lambda sim: sim.interrupt(handler)
+        period_cycles = int(period * self.frequency)
+        first = int(start * self.frequency) if start is not None else self.cycles + period_cycles
+        remaining = [count]
+        def timer(sim):
+            action(sim)
+            if remaining[0] is not None:
+                remaining[0] -= 1
+                if remaining[0] <= 0:
+                    return
+            sim._schedule(sim.cycles + period_cycles, timer)
+        self._schedule(first, timer)
+
+    def interrupt(self, handler):
+        """Queue an interrupt for the handler (an address or symbol name)"""
+        self.pending.append(self._address(handler))
+
+    @staticmethod
+    def sleep(*args):
+        """User function that makes the VM idle until the next event"""
+        yield None
+        raise Return(0)
+
+    @property
+    def idle(self):
+        return self.vm.ip == 0xffff or self.vm.waiting is not None
+
+    def _deliver(self):
+        vm = self.vm
+        self.active.append(vm.sp)
+        vm.interrupt(self.pending.popleft())
+        self.cycles += self.interrupt_cost
+        self.delivered += 1
+
+    def _deliverable(self):
+        return self.pending and self.vm.waiting is None and (self.nested or not self.active)
+
+    def _advance_userfunc(self):
+        """Drive the generator of a user function the VM waits for until it
+        sleeps or returns"""
+        vm = self.vm
+        try:
+            waitfor = vm.waiting.next()
+        except Return as r:
+            vm.resume(r.value)
+        except StopIteration:
+            vm.resume(0)
+        else:
+            if isinstance(waitfor, Sleep):
+                self._wakeup = self.cycles + int(waitfor.seconds * self.frequency)
+            elif waitfor is None:
+                self._wakeup = None
+            else:
+                raise Exception("User function yielded %r, which the simulation can't wait for"%(waitfor,))
+            return
+        self._wakeup = None
+
+    def run(self, until=None):
+        """Run until the given simulated time (in seconds), or until there
+        is nothing left to do. Returns the simulated time."""
+        vm = self.vm
+        limit = int(until * self.frequency) if until is not None else None
+        costs = self.costs
+        memory = vm.memory
+
+        ops = list(vm.ops)
+        active = self.active
+        def returning(original):
+            def wrapped(op):
+                original(op)
+                while active and vm.sp >= active[-1]:
+                    active.pop()
+            return wrapped
+        ops[0x9b] = returning(ops[0x9b])
+        ops[0x9c] = returning(ops[0x9c])
+
+        while not vm.stopped:
+            woken = False
+            while self.events and self.events[0][0] <= self.cycles:
+                heapq.heappop(self.events)[2](self)
+                woken = True
+
+            if vm.waiting is not None and ((woken or self.pending) if self._wakeup is None else self._wakeup <= self.cycles):
+                self._advance_userfunc()
+                continue
+
+            # with nested interrupts, all pending ones are entered at once
+            while self._deliverable():
+                self._deliver()
+
+            stop_at = self.events[0][0] if self.events else None
+            if limit is not None and (stop_at is None or limit < stop_at):
+                stop_at = limit
+
+            if not self.idle:
+                # run until the next event, or until a handler returns if
+                # another interrupt is waiting for that
+                instructions = 0
+                pending = bool(self.pending)
+                depth = len(active)
+                while vm.ip != 0xffff and vm.waiting is None and not vm.stopped and (stop_at is None or self.cycles < stop_at):
+                    op = memory[vm.ip]
+                    # kept up to date in self so user functions can look at the time
+                    self.cycles += costs[op]
+                    ops[op](op)
+                    instructions += 1
+                    if pending and len(active) < depth:
+                        break
+                self.instructions += instructions
+                if vm.waiting is not None:
+                    self._advance_userfunc()
+            elif not self._deliverable():
+                # idle: skip to whatever happens next
+                next_cycle = stop_at
+                if vm.waiting is not None and self._wakeup is not None and (next_cycle is None or self._wakeup < next_cycle):
+                    next_cycle = self._wakeup
+                if next_cycle is None:
+                    break
+                if next_cycle > self.cycles:
+                    self.idle_cycles += next_cycle - self.cycles
+                    self.cycles = next_cycle
+
+            if limit is not None and self.cycles >= limit:
+                break
+
+        return self.time
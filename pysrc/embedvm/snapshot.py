@@ -0,0 +1,147 @@
+import ctypes
+import marshal
+import mmap
+import struct
+
+from .vm import VM
+
+MAGIC = "EVMS"
+VERSION = 1
+MEMORY_SIZE = 0x10000
+PREFIX = struct.Struct(">4sBI") # magic, version, header length
+
+def _align(n):
+    return -(-n // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+
+def vm_state(vm):
+    """Registers and flags of a VM (everything but the memory)"""
+    if vm.waiting is not None:
+        raise Exception("Can not take a snapshot while the VM waits for a user function")
+    return {'ip': vm.ip, 'sp': vm.sp, 'sfp': vm.sfp, 'stopped': vm.stopped}
+
+def set_vm_state(vm, state):
+    vm.ip, vm.sp, vm.sfp, vm.stopped = state['ip'], state['sp'], state['sfp'], state['stopped']
+    vm.waiting = None
+
+def simulation_state(simulation):
+    """State of a simulation.Simulation. The scheduled events (timers) are
+    Python callables and not part of it."""
+    return {'cycles': simulation.cycles, 'idle_cycles': simulation.idle_cycles,
+            'instructions': simulation.instructions, 'delivered': simulation.delivered,
+            'pending': list(simulation.pending), 'active': list(simulation.active),
+            'wakeup': simulation._wakeup}
+
+def set_simulation_state(simulation, state):
+    simulation.cycles = state['cycles']
+    simulation.idle_cycles = state['idle_cycles']
+    simulation.instructions = state['instructions']
+    simulation.delivered = state['delivered']
+    simulation.pending.clear()
+    simulation.pending.extend(state['pending'])
+    simulation.active[:] = state['active']
+    simulation._wakeup = state['wakeup']
+
+def dumps(entries):
+    """Serialize (state dict, memory) pairs: a marshalled list of the
+    states, followed by the memories at offsets aligned for mmap"""
+    states = [state for (state, memory) in entries]
+    header = marshal.dumps(states)
+    start = _align(PREFIX.size + len(header))
+    parts = [PREFIX.pack(MAGIC, VERSION, len(header)), header, "\0" * (start - PREFIX.size - len(header))]
+    for (state, memory) in entries:
+        parts.append(str(bytearray(memory[:MEMORY_SIZE])))
+    return "".join(parts)
+
+def _loads_header(data):
+    magic, version, length = PREFIX.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise Exception("Not a VM snapshot")
+    states = marshal.loads(data[PREFIX.size:PREFIX.size+length])
+    return states, _align(PREFIX.size + length)
+
+def snapshot(vm, simulation=None):
+    """Return the state of vm (registers and its 64k of memory) and
+    optionally of the simulation running it as a string"""
+    state = vm_state(vm)
+    if simulation is not None:
+        state['simulation'] = simulation_state(simulation)
+    return dumps([(state, vm.memory)])
+
+def restore(data, vm=None, simulation=None):
+    """Restore a snapshot into vm (by default a new VM), and the
+    simulation state into simulation if given. User functions are not part
+    of snapshots and have to be registered with the VM again. Returns the
+    VM."""
+    (state, ), start = _loads_header(data)
+    if vm is None:
+        vm = VM()
+    vm.memory[:MEMORY_SIZE] = bytearray(data[start:start+MEMORY_SIZE])
+    set_vm_state(vm, state)
+    if simulation is not None and 'simulation' in state:
+        set_simulation_state(simulation, state['simulation'])
+    return vm
+
+def save(filename, vm, simulation=None):
+    with open(filename, 'wb') as f:
+        f.write(snapshot(vm, simulation))
+    return Checkpoint(filename)
+
+def save_fleet(filename, scheduler):
+    """Save the VMs of a scheduler.Scheduler together with their scheduling
+    parameters (but not the resources used so far)"""
+    entries = []
+    for context in sorted(scheduler.contexts.values(), key=lambda c: c.name):
+        state = vm_state(context.vm)
+        state['context'] = {'name': context.name, 'priority': context.priority,
+                'slice': context.slice, 'time_slice': context.time_slice}
+        entries.append((state, context.vm.memory))
+    with open(filename, 'wb') as f:
+        f.write(dumps(entries))
+    return Checkpoint(filename)
+
+class Checkpoint(object):
+    """A snapshot file from which VMs can be forked cheaply: their memory is
+    a private copy-on-write mapping of the file, so only the pages a VM
+    writes to are ever copied."""
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.states, self._start = _loads_header(self.mapping)
+
+    def __len__(self):
+        return len(self.states)
+
+    def _memory(self, index):
+        mapping = mmap.mmap(self.file.fileno(), MEMORY_SIZE, access=mmap.ACCESS_COPY, offset=self._start + index * MEMORY_SIZE)
+        return (ctypes.c_uint8 * MEMORY_SIZE).from_buffer(mapping)
+
+    def fork(self, index=0, simulation=None, userfuncs=()):
+        """Return a new VM in the state of the index'th saved VM. If a
+        simulation.Simulation is given, it is switched to the new VM and
+        its state restored as well."""
+        state = self.states[index]
+        vm = VM(self._memory(index))
+        set_vm_state(vm, state)
+        for f in userfuncs:
+            vm.set_userfunc(f)
+        if simulation is not None:
+            simulation.vm = vm
+            if 'simulation' in state:
+                set_simulation_state(simulation, state['simulation'])
+        return vm
+
+    def fork_fleet(self, scheduler, userfuncs=()):
+        """Add a fork of every saved VM to scheduler, with the scheduling
+        parameters it was saved with, and return the new Contexts"""
+        contexts = []
+        for (index, state) in enumerate(self.states):
+            vm = self.fork(index, userfuncs=userfuncs)
+            params = state.get('context', {})
+            context = scheduler.add(vm, **params)
+            contexts.append(context)
+        return contexts
+
+    def close(self):
+        self.mapping.close()
+        self.file.close()
@@ -0,0 +1,142 @@
+import bisect
+import struct
+
+MAGIC = "EVMY" # (EVMS are snapshots)
+VERSION = 1
+
+# the types of symbols in .sym files (evmcomp also writes "address" for
+# labels that only set the address)
+TYPES = ('code', 'data', 'other', 'address')
+
+_HEADER = struct.Struct(">4sBHI") # magic, version, number of symbols, end + 1 (0: unknown)
+_ENTRY = struct.Struct(">HBB") # address, type, length of the name (followed by the name)
+
+class SymbolTable(object):
+    """Symbols of a program (like the .sym files written by evm-pycomp and
+    evmcomp) with lookups by address.
+
+    The symbols are kept sorted by address. Every symbol extends up to the
+    next higher symbol address, the last one up to end if that is known
+    (given, or the address of the _end symbol evmcomp writes), and
+    otherwise over one byte."""
+
+    def __init__(self, symbols=(), end=None):
+        self.by_name = {} # name -> (address, type)
+        for (address, name, type) in symbols:
+            self.by_name[name] = (address, type)
+        if end is None and '_end' in self.by_name:
+            end = self.by_name['_end'][0]
+        self.end = end
+
+        entries = sorted((address, name, type) for (name, (address, type)) in self.by_name.items())
+        self.addresses = [a for (a, n, t) in entries]
+        self.names = [n for (a, n, t) in entries]
+        self.types = [t for (a, n, t) in entries]
+        self.sizes = [1] * len(entries)
+        for i in reversed(range(len(entries))):
+            if i + 1 < len(entries):
+                following = self.addresses[i + 1]
+                # symbols at the same address share their bytes
+                self.sizes[i] = self.sizes[i + 1] if following == self.addresses[i] else following - self.addresses[i]
+            elif end is not None:
+                self.sizes[i] = end - self.addresses[i]
+
+        self._code = [(a, n) for (a, n, t) in entries if t in ('code', 'other') and n != '_end']
+
+    @classmethod
+    def from_symfile(cls, f, end=None):
+        """Read a symbol file (a file name or an open file), either in the
+        binary format of to_binary or a text file with lines of the form
+        ``0042 name (type)``. end (usually the length of the image) is used
+        if the file does not record it."""
+        if isinstance(f, basestring):
+            f = open(f, 'rb')
+        data = f.read()
+        if data.startswith(MAGIC):
+            table = cls.from_binary(data)
+            if table.end is None and end is not None:
+                table = cls(((a, n, t) for (n, (a, t)) in table.by_name.items()), end)
+            return table
+        symbols = []
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                address, name, type = line.split()
+                symbols.append((int(address, 16), name, type.strip('()')))
+            except ValueError:
+                raise Exception("Not a symbol file: %r"%line[:40])
+        return cls(symbols, end)
+
+    @classmethod
+    def from_dict(cls, symbols, end=None):
+        """Use the result of PythonProgram.get_symbols()"""
+        return cls(((address, name, type) for (name, (address, type)) in symbols.items()), end)
+
+    def to_binary(self):
+        """Return the symbols in a compact binary format: a header, and the
+        address, type and name of every symbol in the order of addresses"""
+        parts = [_HEADER.pack(MAGIC, VERSION, len(self.names), 0 if self.end is None else self.end + 1)]
+        for (address, name, type) in zip(self.addresses, self.names, self.types):
+            if type not in TYPES:
+                raise Exception("Symbol %s has the unknown type %s"%(name, type))
+            parts.append(_ENTRY.pack(address, TYPES.index(type), len(name)))
+            parts.append(name)
+        return "".join(parts)
+
+    @classmethod
+    def from_binary(cls, data):
+        magic, version, count, end = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise Exception("Not a binary symbol file")
+        symbols = []
+        pos = _HEADER.size
+        for i in range(count):
+            address, type, length = _ENTRY.unpack_from(data, pos)
+            pos += _ENTRY.size
+            symbols.append((address, data[pos:pos + length], TYPES[type]))
+            pos += length
+        return cls(symbols, end - 1 if end else None)
+
+    def __getitem__(self, name):
+        return self.by_name[name][0]
+
+    def size(self, name):
+        """Number of bytes from the symbol name to the next one (see above)"""
+        address = self[name]
+        return self.sizes[bisect.bisect_left(self.addresses, address)]
+
+    def functions(self):
+        """Return the (address, name) of all code symbols, sorted by
+        address"""
+        return list(self._code)
+
+    def variables(self):
+        """Return {name: (address, size)} of the data symbols"""
+        return dict((n, (a, s)) for (a, n, t, s) in zip(self.addresses, self.names, self.types, self.sizes) if t == 'data')
+
+    def containing(self, address, types=None):
+        """Name of the symbol (of one of types, if given) whose bytes
+        include address, or None"""
+        index = bisect.bisect_right(self.addresses, address) - 1
+        if index < 0 or address >= self.addresses[index] + self.sizes[index]:
+            return None
+        start = self.addresses[index]
+        while index >= 0 and self.addresses[index] == start:
+            if types is None or self.types[index] in types:
+                return self.names[index]
+            index -= 1
+        return None
+
+    def in_range(self, start, end, types=None):
+        """Return the (address, name) of the symbols (of one of types, if
+        given) with start <= address < end, sorted by address"""
+        first = bisect.bisect_left(self.addresses, start)
+        last = bisect.bisect_left(self.addresses, end)
+        return [(a, n) for (a, n, t) in zip(self.addresses[first:last], self.names[first:last], self.types[first:last])
+                if types is None or t in types]
+
+    def function_at(self, address):
+        """Name of the code symbol that address belongs to, or None (eg. in
+        data or behind the end)"""
+        return self.containing(address, ('code', 'other'))
@@ -0,0 +1,202 @@
+import os
+import optparse
+
+from . import asm
+from .python import PythonProgram
+from .objfile import ObjectFile
+from .cache import CompileCache, cache_key
+from .incremental import BuildState
+from .symbols import SymbolTable
+
+def compile(source, pyfile, opts, state=None, layout=None, previous_image=None):
+    """Return the requested outputs ({name: contents}) of compiling source,
+    incrementally if given the incremental.BuildState of an earlier build,
+    and keeping the layout of an earlier build if given its
+    symbols.SymbolTable (and its image)"""
+    outputs = {}
+    if opts.object:
+        pb = PythonProgram(allow_externs=True)
+        pb.read_python(source, opts.jobs, state)
+        outputs['object'] = ObjectFile.from_program(pb, os.path.splitext(os.path.basename(pyfile))[0]).to_text()
+        _report_rebuilt(pb, state)
+        return outputs
+
+    pb = PythonProgram(layout=layout, pad_budget=opts.pad_budget, previous_image=previous_image)
+    pb.read_python(source, opts.jobs, state)
+    if opts.asmfile:
+        outputs['asm'] = pb.to_asm()
+    pb.fix_all()
+    if opts.asmfixfile:
+        outputs['asmfix'] = pb.to_asm()
+    outputs['bin'] = "".join(chr(x) for x in pb.to_binary())
+    if opts.binary_symbols:
+        outputs['sym'] = SymbolTable.from_dict(pb.get_symbols(), len(outputs['bin'])).to_binary()
+    else:
+        outputs['sym'] = "".join("%04x %s (%s)\n"%(v, k, type) for (k, (v, type)) in pb.get_symbols().items())
+    if opts.linefile:
+        outputs['lines'] = pb.get_lines(os.path.basename(pyfile)).to_binary()
+    _report_rebuilt(pb, state)
+    if layout is not None:
+        if pb.pinned_layout:
+            print "moved %d of %d functions%s; %d bytes of padding"%(len(pb.moved), len(pb.funcs),
+                    " (%s)"%", ".join(pb.moved) if pb.moved else "", pb.padding)
+        else:
+            print "keeping the layout takes %d bytes of padding (more than %d), laid out compactly"%(pb.padding, pb.pad_budget)
+    return outputs
+
+def _report_rebuilt(pb, state):
+    if state is None:
+        return
+    print "rebuilt %d of %d functions%s; %s"%(len(pb.rebuilt), len(pb.funcs),
+            " (%s)"%", ".join(sorted(pb.rebuilt)) if pb.rebuilt else "",
+            "kept the layout" if pb.relaxed_in_place else "relaxed all code")
+
+def pycomp(argv=None):
+    p = optparse.OptionParser(prog="evm-pycomp", description="Compile a simple Python program to EmbedVM byte code", usage="%prog file.py [file.bin [file.sym]]")
+    p.add_option("--asmfile", help="Export the assembly code in F", metavar='F')
+    p.add_option("--asmfixfile", help="Export the assembly code with fixed command lengths in F", metavar='F')
+    p.add_option("--linefile", help="Export the table mapping code addresses to source lines in F", metavar='F')
+    p.add_option("--binary-symbols", action='store_true', help="Write the symbol file in the compact binary format (which the other tools read like the text one)")
+    p.add_option("--object", help="Instead of a binary, write an object file for evm-link to F; functions that are not defined in the file are imported", metavar='F')
+    p.add_option("-j", "--jobs", type='int', help="Generate the code of the functions in N processes", metavar='N')
+    p.add_option("--pin", help="Keep global variables and functions at their addresses in the symbol file F of a previous build where they still fit, so that the new image differs from the previous one in few places (see evm-delta)", metavar='F')
+    p.add_option("--pin-image", help="With --pin, the image of the previous build, whose command lengths are kept in functions that stay in place (default: the .bin file next to the symbol file, if any)", metavar='F')
+    p.add_option("--pad-budget", type='int', default=256, help="With --pin, lay the code out compactly after all if keeping the layout leaves more than N bytes of gaps (default: %default)", metavar='N')
+    p.add_option("--incremental", help="Only recompile the functions that changed since the last build with the same build state file F (which is created or updated), and keep their layout if they still fit (the cache is not used)", metavar='F')
+    p.add_option("--cache", default=os.environ.get('EVM_CACHE'), help="Reuse the outputs of earlier compilations of the same source with the same compiler, imported modules and options, cached in directory D (default: $EVM_CACHE)", metavar='D')
+    p.add_option("--cache-size", type='int', default=64, help="Remove the least recently used cache entries when the cache exceeds MB megabytes (default: %default)", metavar='MB')
+    p.add_option("--cache-stats", action='store_true', help="Print the cache statistics")
+    (opts, args) = p.parse_args(argv)
+
+    if opts.cache_stats and not args:
+        if not opts.cache:
+            p.error("No cache given")
+        print CompileCache(opts.cache, opts.cache_size * 1024 * 1024).report()
+        return
+
+    binfile = symfile = None
+    if opts.object:
+        if len(args) != 1:
+            p.error("Wrong number of arguments")
+        (pyfile, ) = args
+    elif len(args) == 1:
+        (pyfile, ) = args
+    elif len(args) == 2:
+        (pyfile, binfile) = args
+    elif len(args) == 3:
+        (pyfile, binfile, symfile) = args
+    else:
+        p.error("Wrong number of arguments")
+
+    if symfile is None and not opts.object:
+        basename, ext = os.path.splitext(pyfile)
+        if ext != ".py":
+            p.error("If the Python file does not end in '.py', the binary and symbol file names have to be explicitly given.")
+        symfile = basename + '.sym'
+        if binfile is None:
+            binfile = basename + '.bin'
+
+    source = open(pyfile).read()
+    if opts.pin and opts.object:
+        p.error("Object files have no layout to keep")
+    layout = SymbolTable.from_symfile(opts.pin) if opts.pin else None
+    previous_image = None
+    if opts.pin:
+        imagefile = opts.pin_image or os.path.splitext(opts.pin)[0] + '.bin'
+        if opts.pin_image or os.path.exists(imagefile):
+            previous_image = open(imagefile, 'rb').read()
+
+    paths = {'object': opts.object, 'asm': opts.asmfile, 'asmfix': opts.asmfixfile, 'bin': binfile, 'sym': symfile, 'lines': opts.linefile}
+
+    cache = outputs = None
+    if opts.incremental:
+        # builds depend on the state, not only on the source
+        state = BuildState.read(opts.incremental)
+        outputs = compile(source, pyfile, opts, state, layout, previous_image)
+        state.write(opts.incremental)
+    elif opts.cache:
+        cache = CompileCache(opts.cache, opts.cache_size * 1024 * 1024)
+        # the options that change the outputs, not where they are written
+        options = [(name, path is not None) for (name, path) in paths.items()] + [('filename', os.path.basename(pyfile))]
+        if opts.binary_symbols:
+            options.append(('binary_symbols', True))
+        if layout is not None:
+            options += [('pin', sorted(layout.by_name.items())), ('pad_budget', opts.pad_budget), ('pin_image', previous_image)]
+        key = cache_key(source, options)
+        outputs = cache.get(key)
+    if outputs is None:
+        outputs = compile(source, pyfile, opts, layout=layout, previous_image=previous_image)
+        if cache is not None:
+            cache.put(key, outputs)
+
+    for (name, contents) in outputs.items():
+        with open(paths[name], 'wb') as f:
+            f.write(contents)
+
+    if opts.cache_stats and cache is not None:
+        print cache.report()
+
+def assemble(argv=None):
+    p = optparse.OptionParser(prog="evm-asm", description="Assemble an EmbedVM program", usage="%prog file.asm [file.bin]")
+    (opts, args) = p.parse_args(argv)
+
+    binfile = None
+    if len(args) == 1:
+        (asmfile, ) = args
+    elif len(args) == 2:
+        (asmfile, binfile) = args
+    else:
+        p.error("Wrong number of arguments")
+
+    if binfile is None:
+        basename, ext = os.path.splitext(asmfile)
+        if ext != ".asm":
+            p.error("If the assembly file does not end in '.asm', the binary file name has to be explicitly given.")
+        binfile = basename + '.bin'
+
+    a = asm.ASM()
+    with open(asmfile) as f:
+        a.read_asm(f)
+    a.fix_all()
+    converted = "".join(map(chr, a.to_binary()))
+    with open(binfile, 'w') as f:
+        f.write(converted)
+
+def disassemble(argv=None):
+    p = optparse.OptionParser(prog="evm-disasm", description="Disassemble a binary EmbedVM program using the symbol table to determine entry points", usage="%prog file.bin [file.sym [file.asm]]")
+    p.add_option("--keep-fixed", action='store_true', help="Keep variable-length commands at their fixed length")
+    (opts, args) = p.parse_args(argv)
+
+    symfile = asmfile = None
+    if len(args) == 1:
+        (binfile, ) = args
+    elif len(args) == 2:
+        (binfile, symfile) = args
+    elif len(args) == 3:
+        (binfile, symfile, asmfile) = args
+    else:
+        p.error("Wrong number of arguments")
+
+    if asmfile is None:
+        basename, ext = os.path.splitext(binfile)
+        if ext != ".bin":
+            p.error("If the binary file does not end in '.bin', symbol and assembly file names have to be explicitly given.")
+        asmfile = basename + '.asm'
+        if symfile is None:
+            symfile = basename + '.sym'
+
+    a = asm.ASM()
+    data = map(ord, open(binfile).read())
+    entrypoints = [address for (address, name) in SymbolTable.from_symfile(symfile).functions()]
+    a.read_binary(data, entrypoints)
+    if not opts.keep_fixed:
+        a.unfix_all()
+    with open(asmfile, 'w') as f:
+        a.write_asm(f)
+
+# the command line tools that evm-batch and its server can run
+TOOLS = {
+        'evm-pycomp': pycomp,
+        'evm-asm': assemble,
+        'evm-disasm': disassemble,
+        }
@@ -0,0 +1,157 @@
+import array
+import struct
+import sys
+
+from . import bytecode
+
+MAGIC = "EVMT"
+VERSION = 1
+HEADER = struct.Struct(">4sBIQ") # magic, version, records, instructions executed
+
+def _bigendian(a):
+    if sys.byteorder == 'little' and a.itemsize > 1:
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a
+
+class Tracer(object):
+    """Records the last ``size`` executed instructions of a VM.
+
+    For every instruction, its address, opcode, the stack pointer and the
+    value on top of the stack (all before execution) are stored in arrays
+    that are allocated once, overwriting the oldest records when full.
+    Like profiler.Profiler, the tracer wraps the handlers in ``vm.ops``.
+
+    Used as a context manager, the trace is written to ``dumpfile`` (if
+    given) when the block is left, in particular when it is left by an
+    exception."""
+
+    def __init__(self, vm, size=0x10000, dumpfile=None):
+        self.vm = vm
+        self.size = size
+        self.dumpfile = dumpfile
+
+        self.ips = array.array('H', [0]) * size
+        self.ops = array.array('B', [0]) * size
+        self.sps = array.array('H', [0]) * size
+        self.tos = array.array('H', [0]) * size
+        self._executed = [0]
+        self._original = None
+
+    executed = property(lambda self: self._executed[0])
+
+    def install(self):
+        vm = self.vm
+        self._original = list(vm.ops)
+        memory = vm.memory
+        size = self.size
+        ips, ops, sps, tos = self.ips, self.ops, self.sps, self.tos
+        executed = self._executed
+
+        def tracing(original):
+            def wrapped(op):
+                n = executed[0]
+                i = n % size
+                ips[i] = vm.ip
+                ops[i] = op
+                sps[i] = sp = vm.sp
+                tos[i] = (memory[sp] << 8) | memory[(sp + 1) & 0xffff]
+                executed[0] = n + 1
+                original(op)
+            return wrapped
+
+        for op in range(256):
+            vm.ops[op] = tracing(vm.ops[op])
+
+    def uninstall(self):
+        self.vm.ops[:] = self._original
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+        if self.dumpfile is not None:
+            self.dump(self.dumpfile)
+
+    def _order(self):
+        """Indices of the recorded instructions, oldest first"""
+        n = self.executed
+        if n <= self.size:
+            return 0, n
+        return n % self.size, self.size
+
+    def records(self):
+        """Return the recorded (ip, opcode, sp, top of stack) tuples, oldest
+        first"""
+        start, count = self._order()
+        result = []
+        for k in xrange(count):
+            i = (start + k) % self.size
+            result.append((self.ips[i], self.ops[i], self.sps[i], self.tos[i]))
+        return result
+
+    def to_binary(self):
+        """Return the trace in the format read by :func:`read_trace`: a
+        header followed by the columns of addresses, opcodes, stack pointers
+        and top of stack values (16-bit values big-endian)"""
+        start, count = self._order()
+        parts = [HEADER.pack(MAGIC, VERSION, count, self.executed)]
+        for column in (self.ips, self.ops, self.sps, self.tos):
+            if count == self.size:
+                ordered = column[start:] + column[:start]
+            else:
+                ordered = column[:count]
+            parts.append(_bigendian(ordered).tostring())
+        return "".join(parts)
+
+    def dump(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_binary())
+
+class Trace(object):
+    """A trace as read from a file"""
+    def __init__(self, records, executed):
+        self.records = records # list of (ip, opcode, sp, top of stack)
+        self.executed = executed
+
+    def decode(self, memory, symbols=None):
+        """Yield a line of text for every record, showing the command at
+        the address in memory (the program image) and the symbol it belongs
+        to (from a symbols.SymbolTable)"""
+        first = self.executed - len(self.records)
+        commands = {} # ip -> text
+        for (n, (ip, op, sp, tos)) in enumerate(self.records):
+            if ip not in commands:
+                try:
+                    command = repr(bytecode.interpret(memory, ip))
+                except (bytecode.UnknownCommand, AssertionError, IndexError):
+                    command = "invalid"
+                if memory[ip] != op:
+                    command += " (but %02x was executed)"%op
+                location = ""
+                if symbols is not None:
+                    name = symbols.function_at(ip)
+                    if name is not None:
+                        location = "%s+%04x "%(name, ip - symbols[name])
+                commands[ip] = "%04x %s%s"%(ip, location, command)
+            yield "%10d SP %04x TOS %04x  %s"%(first + n, sp, tos, commands[ip])
+
+def read_trace(f):
+    """Read a trace written by Tracer.dump (a file name or an open file)"""
+    if isinstance(f, basestring):
+        f = open(f, 'rb')
+    data = f.read()
+    magic, version, count, executed = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise Exception("Not an execution trace")
+    pos = HEADER.size
+    columns = []
+    for typecode in 'HBHH':
+        column = array.array(typecode)
+        length = count * column.itemsize
+        column.fromstring(data[pos:pos+length])
+        pos += length
+        columns.append(_bigendian(column))
+    return Trace(zip(*columns), executed)
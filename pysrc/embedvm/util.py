@@ -1,3 +1,6 @@
+import array
+import sys
+
 def assert_signexted(val, mask):
     """Assert that val fits in the range you can get when signext'ing with the
     given mask"""
@@ -14,6 +17,31 @@ def signext(val, mask):
         val |= ~mask
     return val
 
+def wrap16(val):
+    """Truncate val to a signed 16 bit value, like storing an int in an
+    int16_t does in C"""
+    return ((val + 0x8000) & 0xffff) - 0x8000
+
+def pack16(values):
+    """Convert a sequence of 16 bit values to a big endian byte string, as the
+    VM stores them in memory. Values are truncated to 16 bit like in C, so both
+    signed and unsigned representations are accepted."""
+    packed = array.array('H', [v & 0xffff for v in values])
+    if sys.byteorder == 'little':
+        packed.byteswap()
+    return packed.tostring()
+
+def unpack16(data):
+    """Inverse of pack16; the values are returned sign extended."""
+    unpacked = array.array('h', bytes(data))
+    if sys.byteorder == 'little':
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+def unpack8s(data):
+    """Interpret a byte string as signed 8 bit values."""
+    return array.array('b', bytes(data)).tolist()
+
 flipped = lambda d: dict((v, k) for (k, v) in d.items())
 
 # decorators
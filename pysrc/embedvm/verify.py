@@ -0,0 +1,179 @@
+from . import asm
+from . import bytecode
+
+class VerificationError(Exception):
+    """An image could not be verified; the message lists the reasons"""
+
+class Function(object):
+    def __init__(self, entry):
+        self.entry = entry
+        self.args = None # number of arguments, None if only called from the host
+        self.max_depth = 0 # values on the stack above the frame pointer
+        self.call_sites = []
+
+class Verifier(object):
+    """Checks the code of an image statically, using the stack effect and
+    control flow metadata of the bytecode commands:
+
+    * every command reachable from the entry points decodes, and jumps and
+      calls land on the start of a command (no two reachable commands
+      overlap),
+    * no path falls off the end of a function or uses a computed jump or
+      call (which can't be followed),
+    * the number of values on the stack is the same on all paths into a
+      command, and commands never take more values than the function put on
+      the stack,
+    * local variables (PushLocal/PopLocal, Dig, Bury) only access values
+      inside the function's frame, and arguments only those passed by every
+      caller,
+    * the number of arguments of every CallUserFunction is a constant.
+
+    ``code`` maps positions to commands, like the union of the
+    FixedPositionCodeBlocks of an asm.ASM."""
+
+    def __init__(self, code, entry_points):
+        self.code = code
+        self.entry_points = sorted(set(entry_points))
+        self.functions = {} # entry -> Function
+        self.instructions = {} # position -> command, all reachable commands
+        self.errors = []
+
+    def error(self, pos, message):
+        self.errors.append("%04x: %s"%(pos, message))
+
+    def _command(self, pos):
+        if pos not in self.code:
+            return None
+        return self.code[pos]
+
+    def _walk(self, entry):
+        """Decode the commands of a function; return {pos: successors}"""
+        successors = {}
+        pending = [entry]
+        while pending:
+            pos = pending.pop()
+            if pos in successors:
+                continue
+            command = self._command(pos)
+            if command is None:
+                self.error(pos, "jump or fall through to a position that is not the start of a command")
+                successors[pos] = []
+                continue
+            self.instructions[pos] = command
+            succ = []
+            next = pos + command.length
+            if isinstance(command, (bytecode.JumpToAddress, bytecode.CallAddress)):
+                self.error(pos, "computed jumps and calls can not be verified")
+            if isinstance(command, (bytecode.RelativeAddressCommand, bytecode.VariableAddressCommand)):
+                target = command.target(pos)
+                if isinstance(command, bytecode.CallCommand):
+                    following = self._command(next)
+                    args = following.n + 1 if isinstance(following, bytecode.PopMany) else 0
+                    self.functions.setdefault(target, Function(target)).call_sites.append((pos, args))
+                else:
+                    succ.append(target)
+            if command.falls_through:
+                succ.append(next)
+            successors[pos] = succ
+            pending.extend(succ)
+        return successors
+
+    def run(self):
+        for entry in self.entry_points:
+            self.functions.setdefault(entry, Function(entry))
+
+        # discover all functions and their call sites first, as the number
+        # of arguments of a function is only known from its callers
+        graphs = {}
+        while len(graphs) < len(self.functions):
+            for entry in sorted(self.functions):
+                if entry not in graphs:
+                    graphs[entry] = self._walk(entry)
+
+        for (entry, function) in sorted(self.functions.items()):
+            if function.call_sites:
+                function.args = min(args for (pos, args) in function.call_sites)
+            self._check_stack(function, graphs[entry])
+
+        positions = sorted(self.instructions)
+        for (pos, next) in zip(positions, positions[1:]):
+            if pos + self.instructions[pos].length > next:
+                self.error(next, "command overlaps the command at %04x"%pos)
+
+        return not self.errors
+
+    def _check_stack(self, function, successors):
+        # depth: values above the frame pointer before the command;
+        # constant: value of the last command if it was a constant push
+        state = {function.entry: (0, None)}
+        pending = [function.entry]
+        while pending:
+            pos = pending.pop()
+            command = self.instructions.get(pos)
+            if command is None:
+                continue
+            depth, constant = state[pos]
+
+            pops = command.pops
+            if isinstance(command, bytecode.CallUserFunction):
+                if constant is None:
+                    self.error(pos, "number of user function arguments is not a constant")
+                else:
+                    pops += constant
+            if pops > depth:
+                self.error(pos, "takes %d values from a stack of %d"%(pops, depth))
+                continue
+            if isinstance(command, bytecode.SFACommand):
+                if command.sfa >= 0:
+                    # locals live in the frame, below the frame pointer
+                    available = depth - pops
+                    if command.sfa >= available:
+                        self.error(pos, "local %d accessed with only %d values in the frame"%(command.sfa, available))
+                elif function.args is None or -command.sfa > function.args:
+                    self.error(pos, "argument %d accessed, but only %s passed"%(-command.sfa, function.args or 0))
+
+            depth = depth - pops + command.pushes
+            function.max_depth = max(function.max_depth, depth)
+            constant = command.value if isinstance(command, (bytecode.PushConstant, bytecode.PushConstantV)) else None
+
+            for s in successors[pos]:
+                if s not in state:
+                    state[s] = (depth, constant)
+                    pending.append(s)
+                elif state[s][0] != depth:
+                    self.error(s, "reached with %d and %d values on the stack"%(state[s][0], depth))
+                elif state[s][1] != constant and state[s][1] is not None:
+                    state[s] = (depth, None)
+                    pending.append(s)
+
+def code_of(program):
+    """Return {position: command} of the fixed code blocks of an asm.ASM"""
+    code = {}
+    for b in program.blocks:
+        if isinstance(b, asm.FreeCodeBlock):
+            raise Exception("Only fixed code can be verified, call fix_all first")
+        if isinstance(b, asm.FixedPositionCodeBlock):
+            code.update(b.code)
+    return code
+
+def verify(program, entry_points=None):
+    """Verify the code of an asm.ASM (e.g. a compiled python.PythonProgram
+    or a binary read by ASM.read_binary). entry_points defaults to the
+    exported code symbols. Returns the Verifier, or raises a
+    VerificationError."""
+    if entry_points is None:
+        entry_points = []
+        for b in program.blocks:
+            for (position, type) in getattr(b, 'sym', {}).values():
+                if type == 'code':
+                    entry_points.append(position)
+    verifier = Verifier(code_of(program), entry_points)
+    if not verifier.run():
+        raise VerificationError("\n".join(verifier.errors))
+    return verifier
+
+def verify_binary(data, entry_points):
+    """Like verify, for a memory image"""
+    program = asm.ASM()
+    program.read_binary(list(bytearray(data)), list(entry_points))
+    return verify(program, entry_points)
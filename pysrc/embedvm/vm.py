@@ -0,0 +1,376 @@
+import types
+
+from .util import signext, wrap16
+from .bus import MemoryBus
+
+class InvalidInstruction(Exception):
+    """The VM tried to execute a reserved opcode"""
+
+class VM(object):
+    """In-process implementation of the virtual machine described in
+    README.VM, behaving like vmsrc/embedvm.c.
+
+    The memory is a 64k bytearray (or anything that behaves like one), or a
+    bus.MemoryBus for memory mapped devices and write protection. User
+    functions are looked up in ``userfuncs`` by function id, falling back to
+    ``default_userfunc`` which gets the function id as first argument (like
+    ``runtime.UserfuncWrapper()`` decorated functions do). A user function
+    can stop the VM by calling :meth:`stop`.
+
+    If a user function returns a generator, the VM suspends in the middle of
+    the CallUserFunction instruction and keeps the generator in ``waiting``;
+    someone else (e.g. ``eventloop.EventLoop``) has to drive it and then
+    :meth:`resume` the VM with the function's return value.
+
+    Instructions are executed by the handlers in ``ops``, which is indexed by
+    opcode and called with the opcode as argument. Instrumentation can
+    replace handlers with wrappers."""
+
+    def __init__(self, memory=None):
+        self.bus = None
+        if isinstance(memory, MemoryBus):
+            self.bus = memory
+            memory = memory.ram
+            self.bus.install(self)
+        self.memory = memory if memory is not None else bytearray(0x10000)
+        # initial state as in evmdemo, so returning from the function that
+        # is called first ends at 0xffff
+        self.ip = 0xffff
+        self.sp = 0
+        self.sfp = 0
+        self.userfuncs = {}
+        self.default_userfunc = None
+        self.waiting = None
+        self.stopped = False
+
+        self.ops = [self._op_invalid] * 256
+        for op in range(0x00, 0x40): self.ops[op] = self._op_push_local
+        for op in range(0x40, 0x80): self.ops[op] = self._op_pop_local
+        for op in range(0x80, 0x8c) + range(0xa8, 0xae): self.ops[op] = self._op_binary
+        for op in range(0x8c, 0x8f): self.ops[op] = self._op_unary
+        for op in range(0x90, 0x98): self.ops[op] = self._op_push_immediate
+        self.ops[0x98] = self._op_push_u8
+        self.ops[0x99] = self._op_push_s8
+        self.ops[0x9a] = self._op_push_16
+        self.ops[0x9b] = self._op_return
+        self.ops[0x9c] = self._op_return
+        self.ops[0x9d] = self._op_drop
+        self.ops[0x9e] = self._op_call_address
+        self.ops[0x9f] = self._op_jump_address
+        for op in range(0xa0, 0xa8): self.ops[op] = self._op_relative
+        self.ops[0xae] = self._op_stack_pointer
+        self.ops[0xaf] = self._op_stack_frame_pointer
+        for op in range(0xb0, 0xc0): self.ops[op] = self._op_call_user
+        for op in range(0xc0, 0xf0):
+            if op & 0x07 == 5:
+                self.ops[op] = self._op_bury
+            elif op & 0x07 == 6:
+                self.ops[op] = self._op_dig
+            elif op & 0x07 != 7:
+                self.ops[op] = self._op_global
+        for op in range(0xf0, 0xf8): self.ops[op] = self._op_push_zeros
+        for op in range(0xf8, 0x100): self.ops[op] = self._op_pop_many
+
+    ############ host interface ############
+
+    def load(self, data, address=0):
+        """Copy an image (e.g. the output of ASM.to_binary) into memory"""
+        self.memory[address:address+len(data)] = bytearray(data)
+
+    def set_userfunc(self, func, which=None):
+        """Register a user function. For runtime.UserfuncWrapper objects, the
+        function id is taken from the wrapper."""
+        if which is None:
+            which = getattr(func, 'which', None)
+        if which is None:
+            self.default_userfunc = func
+        else:
+            self.userfuncs[which] = func
+
+    def call_user(self, funcid, args):
+        if funcid in self.userfuncs:
+            return self.userfuncs[funcid](*args)
+        if self.default_userfunc is None:
+            raise Exception("No user function registered for function id %d"%funcid)
+        return self.default_userfunc(funcid, *args)
+
+    def stop(self):
+        self.stopped = True
+
+    finished = property(lambda self: self.ip == 0xffff or self.stopped)
+
+    def interrupt(self, address):
+        """Call the function at address, discarding its return value. This is
+        also how evmdemo starts the main function."""
+        self.push(self.sfp | 1)
+        self.push(self.ip)
+        self.sfp = self.sp
+        self.ip = address
+
+    def step(self):
+        op = self.memory[self.ip]
+        self.ops[op](op)
+
+    def run(self, steps=None):
+        """Execute instructions until the VM is finished or waits for a user
+        function, or until steps instructions have been executed. Returns the
+        number of executed instructions."""
+        ops = self.ops
+        memory = self.memory
+        count = 0
+        while self.ip != 0xffff and self.waiting is None and not self.stopped:
+            if steps is not None and count >= steps:
+                break
+            op = memory[self.ip]
+            ops[op](op)
+            count += 1
+        return count
+
+    def resume(self, value):
+        """Complete a CallUserFunction instruction whose user function
+        suspended the VM"""
+        if self.waiting is None:
+            raise Exception("VM is not waiting for a user function")
+        self.waiting = None
+        self.push(wrap16(value or 0))
+        self.ip = (self.ip + 1) & 0xffff
+
+    ############ memory and stack access ############
+
+    # the code (opcodes and their arguments) is always read from memory,
+    # even with a bus
+
+    def fetch8(self, address):
+        return self.memory[address & 0xffff]
+
+    def fetch16(self, address):
+        memory = self.memory
+        return signext((memory[address & 0xffff] << 8) | memory[(address + 1) & 0xffff], 0xffff)
+
+    def read8(self, address):
+        return self.memory[address & 0xffff]
+
+    def read16(self, address):
+        memory = self.memory
+        return signext((memory[address & 0xffff] << 8) | memory[(address + 1) & 0xffff], 0xffff)
+
+    def write8(self, address, value):
+        self.memory[address & 0xffff] = value & 0xff
+
+    def write16(self, address, value):
+        memory = self.memory
+        memory[address & 0xffff] = (value >> 8) & 0xff
+        memory[(address + 1) & 0xffff] = value & 0xff
+
+    def push(self, value):
+        self.sp = (self.sp - 2) & 0xffff
+        self.write16(self.sp, value)
+
+    def pop(self):
+        value = self.read16(self.sp)
+        self.sp = (self.sp + 2) & 0xffff
+        return value
+
+    def _local_address(self, sfa):
+        return (self.sfp - 2*sfa + (2 if sfa < 0 else -2)) & 0xffff
+
+    def local_read(self, sfa):
+        return self.read16(self._local_address(sfa))
+
+    def local_write(self, sfa, value):
+        self.write16(self._local_address(sfa), value)
+
+    ############ instructions ############
+
+    def _op_invalid(self, op):
+        raise InvalidInstruction("Reserved opcode %02x at %04x"%(op, self.ip))
+
+    def _op_push_local(self, op):
+        self.push(self.local_read(signext(op, 0x3f)))
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_pop_local(self, op):
+        self.local_write(signext(op, 0x3f), self.pop())
+        self.ip = (self.ip + 1) & 0xffff
+
+    _binary = {
+            0x80: lambda a, b: a + b,
+            0x81: lambda a, b: a - b,
+            0x82: lambda a, b: a * b,
+            0x83: lambda a, b: (abs(a) // abs(b)) * (-1 if (a < 0) != (b < 0) else 1),
+            0x84: lambda a, b: a - b * ((abs(a) // abs(b)) * (-1 if (a < 0) != (b < 0) else 1)),
+            # shift counts are masked as on the hosts running embedvm.c
+            0x85: lambda a, b: a << (b & 31),
+            0x86: lambda a, b: a >> (b & 31),
+            0x87: lambda a, b: a & b,
+            0x88: lambda a, b: a | b,
+            0x89: lambda a, b: a ^ b,
+            0x8a: lambda a, b: int(bool(a and b)),
+            0x8b: lambda a, b: int(bool(a or b)),
+            0xa8: lambda a, b: int(a < b),
+            0xa9: lambda a, b: int(a <= b),
+            0xaa: lambda a, b: int(a == b),
+            0xab: lambda a, b: int(a != b),
+            0xac: lambda a, b: int(a >= b),
+            0xad: lambda a, b: int(a > b),
+            }
+
+    def _op_binary(self, op):
+        b = self.pop()
+        a = self.pop()
+        self.push(self._binary[op](a, b))
+        self.ip = (self.ip + 1) & 0xffff
+
+    _unary = {
+            0x8c: lambda a: ~a,
+            0x8d: lambda a: -a,
+            0x8e: lambda a: int(not a),
+            }
+
+    def _op_unary(self, op):
+        self.push(self._unary[op](self.pop()))
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_push_immediate(self, op):
+        self.push(signext(op, 0x07))
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_push_u8(self, op):
+        self.push(self.fetch8(self.ip + 1))
+        self.ip = (self.ip + 2) & 0xffff
+
+    def _op_push_s8(self, op):
+        self.push(signext(self.fetch8(self.ip + 1), 0xff))
+        self.ip = (self.ip + 2) & 0xffff
+
+    def _op_push_16(self, op):
+        self.push(self.fetch16(self.ip + 1))
+        self.ip = (self.ip + 3) & 0xffff
+
+    def _op_return(self, op):
+        value = self.pop() if op == 0x9b else 0
+        self.sp = self.sfp
+        self.ip = self.pop() & 0xffff
+        self.sfp = self.pop() & 0xffff
+        if self.sfp & 1:
+            # returning from an interrupt (or a call whose result is dropped)
+            self.sfp &= ~1
+        else:
+            self.push(value)
+
+    def _op_drop(self, op):
+        self.pop()
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _call(self, address, return_address):
+        # a call directly followed by a DropValue does not push its result
+        if self.fetch8(return_address) == 0x9d:
+            self.push(self.sfp | 1)
+            self.push(return_address + 1)
+        else:
+            self.push(self.sfp)
+            self.push(return_address)
+        self.sfp = self.sp
+        self.ip = address & 0xffff
+
+    def _op_call_address(self, op):
+        self._call(self.pop(), self.ip + 1)
+
+    def _op_jump_address(self, op):
+        self.ip = self.pop() & 0xffff
+
+    def _op_relative(self, op):
+        if op & 1 == 0:
+            address = self.ip + signext(self.fetch8(self.ip + 1), 0xff)
+            next_ip = (self.ip + 2) & 0xffff
+        else:
+            address = self.ip + self.fetch16(self.ip + 1)
+            next_ip = (self.ip + 3) & 0xffff
+        address &= 0xffff
+
+        if op in (0xa0, 0xa1):
+            self.ip = address
+        elif op in (0xa2, 0xa3):
+            self._call(address, next_ip)
+        elif op in (0xa4, 0xa5):
+            self.ip = address if self.pop() else next_ip
+        else:
+            self.ip = next_ip if self.pop() else address
+
+    def _op_stack_pointer(self, op):
+        self.push(self.sp)
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_stack_frame_pointer(self, op):
+        self.push(self.sfp)
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_call_user(self, op):
+        argc = self.pop() & 0xff
+        args = [self.pop() for i in range(argc)]
+        result = self.call_user(op - 0xb0, args)
+        if isinstance(result, types.GeneratorType):
+            self.waiting = result
+            return
+        self.push(wrap16(result or 0))
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_bury(self, op):
+        depth = (op >> 3) & 0x07
+        stack = [self.pop() for i in range(depth + 1)]
+        self.push(stack[0])
+        for value in stack[:0:-1]:
+            self.push(value)
+        self.push(stack[0])
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_dig(self, op):
+        depth = (op >> 3) & 0x07
+        stack = [self.pop() for i in range(depth + 2)]
+        for value in stack[-2::-1]:
+            self.push(value)
+        self.push(stack[-1])
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_global(self, op):
+        kind = (op >> 3) & 0x07
+        shift = 1 if kind in (4, 5) else 0
+        mode = op & 0x07
+        if mode == 0:
+            address = self.fetch8(self.ip + 1)
+            self.ip = (self.ip + 2) & 0xffff
+        elif mode == 1:
+            address = self.fetch16(self.ip + 1)
+            self.ip = (self.ip + 3) & 0xffff
+        elif mode == 2:
+            address = self.pop()
+            self.ip = (self.ip + 1) & 0xffff
+        elif mode == 3:
+            address = (self.pop() << shift) + self.fetch8(self.ip + 1)
+            self.ip = (self.ip + 2) & 0xffff
+        else:
+            address = (self.pop() << shift) + self.fetch16(self.ip + 1)
+            self.ip = (self.ip + 3) & 0xffff
+        address &= 0xffff
+
+        if kind == 0:
+            self.push(self.read8(address))
+        elif kind == 2:
+            self.push(signext(self.read8(address), 0xff))
+        elif kind == 4:
+            self.push(self.read16(address))
+        elif kind == 5:
+            self.write16(address, self.pop())
+        else:
+            self.write8(address, self.pop())
+
+    def _op_push_zeros(self, op):
+        for i in range((op & 0x07) + 1):
+            self.push(0)
+        self.ip = (self.ip + 1) & 0xffff
+
+    def _op_pop_many(self, op):
+        value = self.pop()
+        self.sp = (self.sp + 2 + 2*(op & 0x07)) & 0xffff
+        self.push(value)
+        self.ip = (self.ip + 1) & 0xffff
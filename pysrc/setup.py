@@ -16,5 +16,14 @@ setup(
             'evm-disasm',
             'evm-asm',
             'evm-pycomp',
+            'evm-pyrun',
+            'evm-run',
+            'evm-estimate',
+            'evm-trace',
+            'evm-coverage',
+            'evm-link',
+            'evm-batch',
+            'evm-remote',
+            'evm-delta',
             ],
         )
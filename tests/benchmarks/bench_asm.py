@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Time reading the assembly of a generated program with the line parser
+of asm.ASM.read_asm (from a string and from a file) and with the ast based
+reader it replaced, and check that all give the same binary.
+
+Usage: bench_asm.py [functions]"""
+
+import ast
+import sys
+import time
+from StringIO import StringIO
+
+from embedvm import asm, bytecode
+from embedvm.python import PythonProgram
+
+from bench_codegen import generate
+
+def read_asm_ast(a, data):
+    """The reader before the line parser: one ast of the whole text, labels
+    looked up in a list"""
+    nodes = ast.parse(data).body
+    pos = 0
+    codebuffer = []
+    labels = []
+    unrefs = []
+
+    def finish_codebuffer():
+        if not codebuffer:
+            return
+        if pos is None:
+            codeblock = asm.FreeCodeBlock()
+            codeblock.code.extend(c for (i, c) in codebuffer)
+        else:
+            codeblock = asm.FixedPositionCodeBlock()
+            codeblock.code.update(codebuffer)
+        a.blocks.append(codeblock)
+        codebuffer[:] = []
+        while unrefs:
+            ref = unrefs.pop()
+            ref.resolve_to([l for l in labels if l.id == ref.id][0])
+        labels[:] = []
+
+    for node in nodes:
+        if not isinstance(node.value, ast.Call):
+            finish_codebuffer()
+            datablock = asm.DataBlock()
+            datablock.read_ast(node.value)
+            a.blocks.append(datablock)
+            pos += datablock.length
+        else:
+            command = asm.read_command(node.value, unrefs)
+            if isinstance(command, bytecode.Label):
+                labels.append(command)
+            codebuffer.append((pos, command))
+            if pos is None or isinstance(command, bytecode.VariableLengthCommand):
+                pos = None
+            else:
+                pos += command.length
+    finish_codebuffer()
+
+def assemble(reader, text):
+    started = time.time()
+    a = asm.ASM()
+    reader(a, text)
+    elapsed = time.time() - started
+    a.fix_all()
+    return elapsed, a.to_binary()
+
+def main():
+    functions = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    program = PythonProgram()
+    program.read_python(generate(functions))
+    text = program.to_asm()
+
+    old, expected = assemble(read_asm_ast, text)
+    new, binary = assemble(lambda a, text: a.read_asm(text), text)
+    streamed, streamed_binary = assemble(lambda a, text: a.read_asm(StringIO(text)), text)
+    print "%d functions, %d lines: ast %.2fs, lines %.2fs (%.1fx), from a file %.2fs%s"%(functions, text.count("\n"), old, new, old / new, streamed,
+            "" if binary == expected == streamed_binary else " OUTPUT DIFFERS")
+    if not binary == expected == streamed_binary:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
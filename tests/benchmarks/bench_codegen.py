@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Time the code generation of a generated program with many functions,
+serially and in process pools of increasing size, and check that all of
+them produce the same assembly (including the label numbers; the program
+is too large to be fixed into an image).
+
+Usage: bench_codegen.py [functions [max jobs]]"""
+
+import multiprocessing
+import sys
+import time
+
+from embedvm import bytecode
+from embedvm.python import PythonProgram
+
+FUNCTION = """
+def f%(i)d(a, b):
+    total = 0
+    for i in range(a):
+        if i & 1:
+            total = total + f%(callee)d(i, b) * 3
+        else:
+            total = total - i / (b + 1)
+    while total > 100:
+        total = total - 7
+    gv.values[%(slot)d] = total
+    return total
+"""
+
+def generate(functions):
+    parts = ["from embedvm.runtime import Globals\n\ngv = Globals()\ngv.values = gv.array16(length=64)\n"]
+    for i in range(functions):
+        parts.append(FUNCTION%{'i': i, 'callee': (i * 7 + 3) % functions, 'slot': i % 64})
+    return "".join(parts)
+
+def compile(source, jobs):
+    # number the labels from the start every time, to compare the outputs
+    bytecode.Label.reset_counter()
+    started = time.time()
+    program = PythonProgram()
+    program.read_python(source, jobs)
+    elapsed = time.time() - started
+    return elapsed, program.to_asm()
+
+def main():
+    functions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    source = generate(functions)
+
+    serial, asm = compile(source, None)
+    print "%d functions, %d cores"%(functions, multiprocessing.cpu_count())
+    print "serial: %.2fs"%serial
+    jobs = 2
+    while jobs <= max(max_jobs, 2):
+        elapsed, parallel_asm = compile(source, jobs)
+        same = parallel_asm == asm
+        print "%d jobs: %.2fs (%.2fx)%s"%(jobs, elapsed, serial / elapsed, "" if same else " OUTPUT DIFFERS")
+        if not same:
+            raise SystemExit(1)
+        jobs *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Time full and incremental builds of a generated program after editing
+one constant in it (which keeps the layout), after growing one function
+(which needs all code relaxed) and after adding a blank line at the top
+(which only moves line numbers), and check that the incremental builds
+produce the same outputs as the full ones.
+
+Usage: bench_incremental.py [functions]"""
+
+import sys
+import time
+
+from embedvm import bytecode
+from embedvm.incremental import BuildState
+from embedvm.python import PythonProgram
+
+from bench_codegen import generate
+
+def build(source, state=None):
+    bytecode.Label.reset_counter()
+    started = time.time()
+    program = PythonProgram()
+    program.read_python(source, None, state)
+    unfixed = program.to_asm()
+    program.fix_all()
+    elapsed = time.time() - started
+    return elapsed, program, (unfixed, program.to_binary(), program.get_symbols(), program.get_lines().to_binary())
+
+def main():
+    functions = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    source = generate(functions)
+    state = BuildState()
+    build(source, state)
+
+    # each edit applies to the result of the previous one
+    edits = [
+            ("constant", lambda s: s.replace("total = total - 7\n    gv.values[0]", "total = total - 6\n    gv.values[0]")),
+            ("grown function", lambda s: s.replace("def f1(a, b):\n", "def f1(a, b):\n    a = a + 1000\n")),
+            ("blank line", lambda s: "\n" + s),
+            ]
+    print "%d functions"%functions
+    for (name, edit) in edits:
+        source = edit(source)
+        full, program, expected = build(source)
+        incremental, program, outputs = build(source, state)
+        print "%s: full %.2fs, incremental %.2fs (%.1fx), rebuilt %d, %s%s"%(name, full, incremental, full / incremental,
+                len(program.rebuilt), "kept the layout" if program.relaxed_in_place else "relaxed all code",
+                "" if outputs == expected else " OUTPUT DIFFERS")
+        if outputs != expected:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@ for x in test_*.evm; do
 	rm -f $x.bin $x.sym $x.ihx $x.dbg $x.ast $x.hdr $x.out $x.asm
 done
 for x in test_*.py; do
-	rm -f $x.bin $x.sym $x.out $x.out-native $x.asm $x.asm-fix
+	rm -f $x.bin $x.sym $x.out $x.out-native $x.out-csemantics $x.out-pyvm $x.out-fastvm $x.asm $x.asm-fix $x.lines $x.coverage
 done
 rm -f evmdemo.core
-rm -f testsuite.pyc testsuite_extended.pyc
+rm -f testsuite.pyc testsuite_extended.pyc unit/*.pyc
@@ -1,6 +1,7 @@
 #!/bin/bash
 
 verbose=false
+coverage=false
 evmopt=""
 export PYTHONPATH=../pysrc/:.
 
@@ -21,9 +22,15 @@ while [[ "$1" == -* ]]; do
 		evmopt="-v"
 		shift
 	fi
+	if [ "$1" = -c ]; then
+		coverage=true
+		shift
+	fi
 done
 
+unit=false
 if [ $# -eq 0 ]; then
+	unit=true
 	set -- test_*.py
 fi
 
@@ -36,13 +43,23 @@ for fn; do
 		echo; echo "=== $fn ==="
 	fi
         v python $fn > $fn.out-native
+        v ../pysrc/evm-pyrun $fn > $fn.out-csemantics
+
+	pycompopt=""
+	runopt=""
+	if $coverage; then
+		pycompopt="--linefile ${fn}.lines"
+		runopt="--coverage ${fn}.coverage"
+	fi
 
-	v ../pysrc/evm-pycomp $fn ${fn}.bin ${fn}.sym --asmfile ${fn}.asm --asmfixfile ${fn}.asm-fix || exit 1
+	v ../pysrc/evm-pycomp $fn ${fn}.bin ${fn}.sym --asmfile ${fn}.asm --asmfixfile ${fn}.asm-fix $pycompopt || exit 1
 	start=$( grep ' main ' ${fn}.sym | cut -f1 -d' ' ) 
 	if $verbose; then
 		v ../vmsrc/evmdemo $evmopt ${fn}.bin $start
 	else
 		v ../vmsrc/evmdemo $evmopt ${fn}.bin $start > ${fn}.out
+		v ../pysrc/evm-run $runopt ${fn}.bin $start > ${fn}.out-pyvm
+		v ../pysrc/evm-run --fast ${fn}.bin $start > ${fn}.out-fastvm
 		if [ -f ${fn%.py}.expect ]; then
 			if cmp ${fn%.evm}.out-native ${fn%.py}.expect; then
 				echo "OK: Native passed $fn."
@@ -52,6 +69,14 @@ for fn; do
 				(( count_error++ ))
 			fi
 
+			if cmp ${fn}.out-csemantics ${fn%.py}.expect; then
+				echo "OK: C semantics native passed $fn."
+				(( count_ok++ ))
+			else
+				echo "ERROR: C semantics native output of $fn was not as expected!"
+				(( count_error++ ))
+			fi
+
 			if cmp ${fn%.evm}.out ${fn%.py}.expect; then
 				echo "OK: Passed $fn."
 				(( count_ok++ ))
@@ -59,6 +84,26 @@ for fn; do
 				echo "ERROR: Output of $fn was not as expected!"
 				(( count_error++ ))
 			fi
+
+			if cmp ${fn}.out-pyvm ${fn%.py}.expect; then
+				echo "OK: Python VM passed $fn."
+				(( count_ok++ ))
+			else
+				echo "ERROR: Python VM output of $fn was not as expected!"
+				(( count_error++ ))
+			fi
+
+			if cmp ${fn}.out-fastvm ${fn%.py}.expect; then
+				echo "OK: Fast VM passed $fn."
+				(( count_ok++ ))
+			else
+				echo "ERROR: Fast VM output of $fn was not as expected!"
+				(( count_error++ ))
+			fi
+
+			if $coverage; then
+				v ../pysrc/evm-coverage ${fn}.bin ${fn}.coverage --linefile ${fn}.lines
+			fi
 		else
 			echo "WARNING: Can't find ${fn%.evm}.expect."
 			(( count_warn++ ))
@@ -67,6 +112,17 @@ for fn; do
 	fi
 done
 
+if $unit; then
+	echo; echo "=== unit tests ==="
+	if v python -m unittest discover -s unit; then
+		echo "OK: Passed the unit tests."
+		(( count_ok++ ))
+	else
+		echo "ERROR: The unit tests failed!"
+		(( count_error++ ))
+	fi
+fi
+
 if [ $# -gt 1 ]; then
 	echo
 fi
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+from embedvm import bytecode
+from embedvm.python import PythonProgram
+from embedvm.symbols import SymbolTable
+from embedvm.vm import VM
+
+TESTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def read_test(name):
+    """Source of a test program in the tests directory"""
+    with open(os.path.join(TESTS, name)) as f:
+        return f.read()
+
+def compile_program(source, jobs=None, state=None, **kwargs):
+    """Compile like a fresh evm-pycomp (with jobs and state passed to
+    read_python); return the image (a string) and the
+    symbols.SymbolTable"""
+    bytecode.Label.reset_counter()
+    program = PythonProgram(**kwargs)
+    program.read_python(source, jobs, state)
+    program.fix_all()
+    image = "".join(chr(x) for x in program.to_binary())
+    return image, SymbolTable.from_dict(program.get_symbols(), len(image))
+
+def start(image, start, vm_class=VM):
+    """Return a VM that is about to call the function at start in image,
+    and the list of (function id, args) its user function calls are
+    appended to (like the one of evmdemo, they return sum(args) ^ id)"""
+    vm = vm_class()
+    vm.load(bytearray(image))
+    calls = []
+    def userfunc(which, *args):
+        calls.append((which, args))
+        return sum(args) ^ which
+    vm.set_userfunc(userfunc)
+    vm.interrupt(start)
+    return vm, calls
+
+def run(image, address, vm_class=VM):
+    """Run the function at address to its end; return the user function
+    calls"""
+    vm, calls = start(image, address, vm_class)
+    while not vm.finished:
+        vm.run()
+    return calls
+
+class TemporaryDirectory(object):
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return self.path
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.path)
@@ -0,0 +1,36 @@
+import unittest
+
+from embedvm import asm, bytecode
+
+def parse(text):
+    unrefs = []
+    return list(asm.parse_asm(text.splitlines(True), unrefs)), unrefs
+
+class ParseAsmTest(unittest.TestCase):
+    def test_brackets_in_comments(self):
+        items, unrefs = parse("PushImmediate(value=1) # push one (the answer\n"
+                              "PushImmediate(value=2)\n"
+                              "# a comment [with a bracket\n"
+                              "Add()\n")
+        self.assertEqual([type(i) for i in items], [bytecode.PushImmediate, bytecode.PushImmediate, bytecode.Add])
+        self.assertEqual([i.value for i in items[:2]], [1, 2])
+
+    def test_brackets_in_strings(self):
+        items, unrefs = parse("JumpV(address=LabelRef('label_(1'))\n"
+                              "Label(id=\"label_(1\")\n")
+        self.assertEqual([type(i) for i in items], [bytecode.JumpV, bytecode.Label])
+        self.assertEqual([r.id for r in unrefs], ['label_(1'])
+
+    def test_statements_across_lines(self):
+        items, unrefs = parse("[1, 2, # the start )\n"
+                              " 3]\n"
+                              "PushImmediate(\n"
+                              "    value=3) # ]\n")
+        self.assertEqual(items[0], [1, 2, 3])
+        self.assertEqual(items[1].value, 3)
+
+    def test_unexpected_end(self):
+        self.assertRaises(Exception, parse, "PushImmediate(value=1\n# )\n")
+
+if __name__ == "__main__":
+    unittest.main()
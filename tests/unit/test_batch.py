@@ -0,0 +1,64 @@
+import os
+import subprocess
+import socket
+import sys
+import time
+import unittest
+
+from embedvm import remote
+
+import support
+
+PYSRC = os.path.join(os.path.dirname(support.TESTS), "pysrc")
+
+PROGRAM = """
+from helper import userfunc
+
+def main():
+    userfunc(1, 2)
+"""
+
+HELPER = """
+from embedvm.runtime import UserfuncWrapper
+
+@UserfuncWrapper()
+def %s(which, *args):
+    return 0
+"""
+
+def write(filename, contents, age=0):
+    with open(filename, 'w') as f:
+        f.write(contents)
+    # .pyc files only notice changes of the modification time in seconds
+    t = time.time() - age
+    os.utime(filename, (t, t))
+
+class ServerTest(unittest.TestCase):
+    def test_imported_modules_are_reloaded(self):
+        with support.TemporaryDirectory() as directory:
+            write(os.path.join(directory, "prog.py"), PROGRAM)
+            write(os.path.join(directory, "helper.py"), HELPER%"userfunc", 10)
+            path = os.path.join(directory, "server")
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join([PYSRC, directory]))
+            server = subprocess.Popen([sys.executable, os.path.join(PYSRC, "evm-batch"), "--serve", path, "-j", "1"], env=env)
+            try:
+                for i in range(100):
+                    try:
+                        remote.request(path, {})
+                        break
+                    except socket.error:
+                        time.sleep(0.1)
+
+                status, out, err = remote.run(path, ["evm-pycomp", "prog.py"], directory)
+                self.assertEqual(status, 0, err)
+
+                write(os.path.join(directory, "helper.py"), HELPER%"renamed")
+                status, out, err = remote.run(path, ["evm-pycomp", "prog.py"], directory)
+                self.assertNotEqual(status, 0)
+                self.assertIn("userfunc", err)
+            finally:
+                remote.stop(path)
+                server.wait()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from embedvm.incremental import BuildState
+
+import support
+
+PROGRAMS = ["test_arrays.py", "test_loops.py", "test_math.py"]
+
+def edits(source):
+    """Earlier versions of source: with a changed constant, with a grown
+    main function, and with a blank line in front"""
+    userfunc = "uf" if "userfunc as uf" in source else "userfunc"
+    yield source.replace("%s(1, "%userfunc, "%s(9, "%userfunc, 1)
+    yield source.replace("def main():\n", "def main():\n    %s(7)\n"%userfunc)
+    yield "\n" + source
+
+class BuildTest(unittest.TestCase):
+    def test_parallel(self):
+        for name in PROGRAMS:
+            source = support.read_test(name)
+            expected = support.compile_program(source)
+            image, symbols = support.compile_program(source, jobs=3)
+            self.assertEqual(image, expected[0], name)
+            self.assertEqual(symbols.by_name, expected[1].by_name, name)
+
+    def test_incremental(self):
+        for name in PROGRAMS:
+            source = support.read_test(name)
+            expected = support.compile_program(source)
+            for (i, earlier) in enumerate(edits(source)):
+                self.assertNotEqual(earlier, source)
+                for jobs in (None, 2):
+                    state = BuildState()
+                    support.compile_program(earlier, jobs, state)
+                    image, symbols = support.compile_program(source, jobs, state)
+                    self.assertEqual(image, expected[0], (name, i, jobs))
+                    self.assertEqual(symbols.by_name, expected[1].by_name, (name, i, jobs))
+
+                    # the state was updated: nothing is left to rebuild
+                    again = BuildState.from_binary(state.to_binary())
+                    self.assertEqual(support.compile_program(source, jobs, again)[0], expected[0])
+
+if __name__ == "__main__":
+    unittest.main()
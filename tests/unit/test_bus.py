@@ -0,0 +1,97 @@
+import unittest
+
+from embedvm.bus import Device, MemoryBus, MemoryFault, Register
+from embedvm.fastvm import FastVM
+from embedvm.vm import VM
+
+import support
+
+SOURCE = """
+from embedvm.runtime import Globals
+from testsuite import userfunc
+
+gv = Globals()
+gv.out = gv.int8u()
+gv.value = gv.int16()
+
+def main():
+    gv.out = 42
+    gv.value = 0x1234
+    userfunc(1, gv.out, gv.value)
+"""
+
+class Recorder(Device):
+    def __init__(self):
+        self.log = []
+        self.data = {}
+
+    def read8(self, address):
+        self.log.append(('r', address))
+        return self.data.get(address, 0x80 | address)
+
+    def write8(self, address, value):
+        self.log.append(('w', address, value))
+        self.data[address] = value
+
+class MemoryBusTest(unittest.TestCase):
+    def setUp(self):
+        self.image, self.symbols = support.compile_program(SOURCE)
+
+    def start(self, vm_class, bus):
+        vm, calls = support.start(self.image, self.symbols['main'], lambda: vm_class(bus))
+        return vm, calls
+
+    def run_vm(self, vm):
+        while not vm.finished:
+            vm.run()
+
+    def test_mmio(self):
+        for vm_class in (VM, FastVM):
+            bus = MemoryBus()
+            device = Recorder()
+            # the globals are in the first page; code is fetched from RAM
+            bus.map(0, 0x100, device)
+            vm, calls = self.start(vm_class, bus)
+            self.run_vm(vm)
+            self.assertEqual(calls, [(1, (42, 0x1234))])
+            self.assertEqual(device.log, [('w', 0, 42), ('w', 1, 0x12), ('w', 2, 0x34), ('r', 1), ('r', 2), ('r', 0)])
+            # the RAM behind the device still has the initial values
+            self.assertEqual(bus.ram[:3], bytearray(3))
+
+            bus.unmap(0, 0x100)
+            self.assertEqual(bus.read8(2), 0)
+
+    def test_page_boundaries(self):
+        bus = MemoryBus()
+        values = []
+        bus.map(0x200, 0x300, Register(0x200, read=lambda offset: 0x40 + offset, write=lambda offset, value: values.append((offset, value))))
+        vm = VM(bus)
+        vm.memory[0x1ff] = 0x12
+        self.assertEqual(vm.read16(0x1ff), 0x1240)
+        vm.write16(0x1ff, 0x3456)
+        self.assertEqual((vm.memory[0x1ff], values), (0x34, [(0, 0x56)]))
+        self.assertRaises(Exception, bus.map, 0x280, 0x300, Device())
+
+    def test_protection(self):
+        for vm_class in (VM, FastVM):
+            bus = MemoryBus()
+            bus.protect(0, 1)
+            vm, calls = self.start(vm_class, bus)
+            # loading is not affected, but the program can't write its data
+            self.assertEqual(bus.ram[:len(self.image)], bytearray(self.image))
+            self.assertRaises(MemoryFault, self.run_vm, vm)
+            self.assertEqual(calls, [])
+
+            # whole pages are protected
+            bus = MemoryBus()
+            bus.protect(0x100, 0x180)
+            vm, calls = self.start(vm_class, bus)
+            self.run_vm(vm)
+            self.assertEqual(calls, [(1, (42, 0x1234))])
+            self.assertRaises(MemoryFault, vm.write8, 0x1ff, 0)
+            self.assertRaises(MemoryFault, vm.write16, 0xff, 0)
+            vm.write16(0x200, 0x1234)
+            self.assertEqual(bus.ram[0x200:0x202], bytearray([0x12, 0x34]))
+
+if __name__ == "__main__":
+    unittest.main()
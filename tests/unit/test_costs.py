@@ -0,0 +1,66 @@
+import unittest
+
+from embedvm.costs import ATMEGA168, Estimator, dynamic_costs
+from embedvm.profiler import Profiler
+
+import support
+
+CALLER = """
+from testsuite import userfunc
+
+def count(n):
+    for i in range(n):
+        userfunc(1, i)
+
+def straight(a):
+    userfunc(2, a)
+    return a + 1
+
+def main():
+    straight(3)
+    count(4)
+"""
+
+class EstimatorTest(unittest.TestCase):
+    def estimator(self, source, **kwargs):
+        image, symbols = support.compile_program(source)
+        memory = bytearray(0x10000)
+        memory[:len(image)] = image
+        return Estimator(memory, ATMEGA168, symbols, **kwargs), image, symbols
+
+    def test_loops_are_unbounded(self):
+        estimator, image, symbols = self.estimator(CALLER)
+        straight = estimator.estimate(symbols['straight'])
+        self.assertEqual(straight.loops, [])
+        self.assertNotEqual(straight.worst, None)
+        for name in ('count', 'main'):
+            estimate = estimator.estimate(symbols[name])
+            self.assertEqual(estimate.worst, None)
+            self.assertTrue(any("without a bound" in reason for reason in estimate.unknown), name)
+
+    def test_loop_bounds(self):
+        estimator, image, symbols = self.estimator(CALLER)
+        (loop, ) = estimator.estimate(symbols['count']).loops
+        bounded, image, symbols = self.estimator(CALLER, loop_bounds={loop.header: 4})
+        count = bounded.estimate(symbols['count'])
+        self.assertEqual(count.worst, count.best + 4 * loop.worst)
+        main = bounded.estimate(symbols['main'])
+        self.assertTrue(main.worst >= count.worst + bounded.estimate(symbols['straight']).worst)
+
+    def test_worst_case_covers_measurement(self):
+        source = support.read_test("test_loops.py")
+        estimator, image, symbols = self.estimator(source, max_iterations=20)
+        vm, calls = support.start(image, symbols['main'])
+        profiler = Profiler(vm, symbols)
+        profiler.install()
+        while not vm.finished:
+            vm.run()
+        measured = dynamic_costs(profiler, ATMEGA168)['main']
+        estimate = estimator.estimate(symbols['main'])
+        self.assertTrue(estimate.best <= measured <= estimate.worst, (estimate.best, measured, estimate.worst))
+
+        estimator, image, symbols = self.estimator(source)
+        self.assertEqual(estimator.estimate(symbols['main']).worst, None)
+
+if __name__ == "__main__":
+    unittest.main()
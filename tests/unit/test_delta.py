@@ -0,0 +1,54 @@
+import unittest
+
+from embedvm.delta import make_delta, apply_delta
+from embedvm.symbols import SymbolTable
+
+import support
+
+def edit(source):
+    """Add a global variable (which takes the place of the first function)
+    and make pr longer"""
+    source = source.replace("gv.a16 = gv.array16(init=[1000, 2000, 3000, 4000, 5000])\n",
+            "gv.a16 = gv.array16(init=[1000, 2000, 3000, 4000, 5000])\ngv.extra = gv.int16(init=7)\n")
+    return source.replace("    userfunc(2)\n", "    userfunc(2)\n    userfunc(3, gv.extra)\n")
+
+class DeltaTest(unittest.TestCase):
+    def test_round_trip(self):
+        old = "".join(chr(i % 251) for i in range(3000))
+        new = old[:100] + "changed" + old[107:2000] + "x" * 60000
+        delta = make_delta(old, new)
+        self.assertEqual(apply_delta(old, delta), new)
+        self.assertEqual(apply_delta(old, make_delta(old, old[:10])), old[:10])
+        self.assertLess(len(make_delta(old, old)), 30)
+
+    def test_wrong_image(self):
+        delta = make_delta("abcdef", "abXdef")
+        with self.assertRaises(Exception):
+            apply_delta("abcdeg", delta)
+        with self.assertRaises(Exception):
+            apply_delta("abcdef", delta[:-1] + "Y")
+
+    def test_pinned_build(self):
+        source = support.read_test("test_arrays.py")
+        old, symbols = support.compile_program(source)
+
+        same, same_symbols = support.compile_program(source, layout=symbols, previous_image=old)
+        self.assertEqual(same, old)
+
+        new, new_symbols = support.compile_program(edit(source), layout=symbols, previous_image=old)
+        compact, compact_symbols = support.compile_program(edit(source))
+        self.assertEqual(support.run(new, new_symbols['main']), support.run(compact, compact_symbols['main']))
+
+        # main keeps its address, and its code does not shift
+        main = symbols['main']
+        self.assertEqual(new_symbols['main'], main)
+        end = main + symbols.size('main')
+        self.assertLessEqual(sum(a != b for (a, b) in zip(old[main:end], new[main:end])), 8)
+
+        delta = make_delta(old, new)
+        self.assertEqual(apply_delta(old, delta), new)
+        self.assertLess(len(delta), len(make_delta(old, compact)))
+        self.assertLess(len(delta), len(new) / 2)
+
+if __name__ == "__main__":
+    unittest.main()
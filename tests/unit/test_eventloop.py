@@ -0,0 +1,65 @@
+import os
+import unittest
+
+from embedvm.eventloop import EventLoop, Readable, Return, Sleep
+
+import support
+
+SOURCE = """
+from testsuite import userfunc
+
+def main():
+    userfunc(1, userfunc(3))
+"""
+
+class EventLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.image, self.symbols = support.compile_program(SOURCE)
+
+    def start(self, userfunc):
+        vm, calls = support.start(self.image, self.symbols['main'])
+        vm.set_userfunc(userfunc, 3)
+        return vm, calls
+
+    def test_sleeping(self):
+        def wait(seconds):
+            def userfunc():
+                yield Sleep(seconds)
+                raise Return(int(seconds * 1000))
+            return userfunc
+        loop = EventLoop()
+        order = []
+        for seconds in (0.02, 0.01):
+            vm, calls = self.start(wait(seconds))
+            vm.set_userfunc(lambda *args: order.append(args), 1)
+            loop.add(vm)
+        loop.run()
+        self.assertEqual(order, [(10,), (20,)])
+
+    def test_readers_of_one_file(self):
+        r, w = os.pipe()
+        try:
+            def read():
+                yield Readable(r)
+                raise Return(ord(os.read(r, 1)))
+            waiting = []
+            def write():
+                yield Sleep(0.01)
+                waiting.append(len(loop.readers[r]))
+                os.write(w, "abc")
+            loop = EventLoop()
+            vms = [self.start(read) for i in range(3)]
+            for (vm, calls) in vms + [self.start(write)]:
+                loop.add(vm)
+            loop.run()
+        finally:
+            os.close(r)
+            os.close(w)
+        # all of them waited for the pipe before anything was written
+        self.assertEqual(waiting, [3])
+        for (vm, calls) in vms:
+            self.assertTrue(vm.finished)
+        self.assertEqual(sorted(calls[0][1] for (vm, calls) in vms), [(97,), (98,), (99,)])
+
+if __name__ == "__main__":
+    unittest.main()
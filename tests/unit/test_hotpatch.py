@@ -0,0 +1,78 @@
+import unittest
+
+from embedvm.fastvm import FastVM
+from embedvm.hotpatch import HotPatcher
+from embedvm.verify import verify_binary
+from embedvm.vm import VM
+
+import support
+
+SOURCE = support.read_test("test_arrays.py")
+# the same length as before, and longer than pr's place in the image
+SAME_LENGTH = SOURCE.replace("    userfunc(2)\n", "    userfunc(4)\n")
+LONGER = SOURCE.replace("    userfunc(2)\n", "    userfunc(4)\n    userfunc(5, 6)\n")
+
+class HotPatchTest(unittest.TestCase):
+    def setUp(self):
+        self.image, self.symbols = support.compile_program(SOURCE)
+        original = support.run(self.image, self.symbols['main'])
+        # pr prints the arrays three times, ending with userfunc(2)
+        self.assertEqual(original.count((2, ())), 3)
+        self.blocks = [original[:6], original[6:12], original[12:]]
+
+    def start(self, vm_class):
+        vm, calls = support.start(self.image, self.symbols['main'], vm_class)
+        if vm_class is FastVM:
+            vm.predecode(verify_binary(bytearray(self.image), [self.symbols['main']]))
+        return vm, calls, HotPatcher(vm, self.symbols, len(self.image))
+
+    def finish(self, vm):
+        while not vm.finished:
+            vm.run()
+
+    def check_patched(self, calls, patched_blocks, end):
+        expected = []
+        for (i, block) in enumerate(self.blocks):
+            if i in patched_blocks:
+                block = block[:-1] + end
+            expected.extend(block)
+        self.assertEqual(calls, expected)
+
+    def test_in_place(self):
+        for vm_class in (VM, FastVM):
+            vm, calls, patcher = self.start(vm_class)
+            address = patcher.patch(SAME_LENGTH, 'pr')
+            self.assertEqual(address, self.symbols['pr'])
+            self.assertTrue(patcher.patches[-1][3])
+            self.finish(vm)
+            self.check_patched(calls, [0, 1, 2], [(4, ())])
+
+    def test_relocated_while_running(self):
+        for vm_class in (VM, FastVM):
+            vm, calls, patcher = self.start(vm_class)
+            while (2, ()) not in calls:
+                vm.run(1)
+            # pr is running: its frame finishes in the old code, the next
+            # calls jump from the old entry to the new code
+            address = patcher.patch(SAME_LENGTH, 'pr')
+            self.assertEqual(address, len(self.image))
+            self.assertFalse(patcher.patches[-1][3])
+            self.assertEqual(patcher.symbols['pr'], address)
+            self.finish(vm)
+            self.check_patched(calls, [1, 2], [(4, ())])
+
+    def test_longer_and_repeated(self):
+        for vm_class in (VM, FastVM):
+            vm, calls, patcher = self.start(vm_class)
+            first = patcher.patch(LONGER, 'pr')
+            self.assertEqual(first, len(self.image))
+            while len(calls) < 7:
+                vm.run(1)
+            second = patcher.patch(SAME_LENGTH, 'pr')
+            self.assertGreater(second, first)
+            self.finish(vm)
+            self.assertEqual(calls[:7], self.blocks[0][:-1] + [(4, ()), (5, (6,))])
+            self.assertEqual(calls[7:], self.blocks[1][:-1] + [(4, ())] + self.blocks[2][:-1] + [(4, ())])
+
+if __name__ == "__main__":
+    unittest.main()
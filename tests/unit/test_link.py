@@ -0,0 +1,64 @@
+import unittest
+
+from embedvm.objfile import ObjectFile, link
+from embedvm.python import PythonProgram
+
+import support
+
+MAIN = """
+from embedvm.runtime import Globals
+from testsuite import userfunc
+
+gv = Globals()
+gv.count = gv.int16(init=3)
+
+def main():
+    for i in range(gv.count):
+        userfunc(1, scale(i, 10), offset(i))
+"""
+
+LIBRARY = """
+from embedvm.runtime import Globals
+
+gv = Globals()
+gv.offsets = gv.array16(init=[100, 200, 300])
+
+def scale(a, b):
+    return a * b
+
+def offset(i):
+    return gv.offsets[i] + scale(i, 2)
+"""
+
+def compile_object(source, module):
+    program = PythonProgram(allow_externs=True)
+    program.read_python(source)
+    # written and read back like evm-pycomp --object and evm-link do
+    return ObjectFile.from_text(ObjectFile.from_program(program, module).to_text())
+
+class LinkTest(unittest.TestCase):
+    def test_linked_program_runs_like_a_single_one(self):
+        program = link([compile_object(MAIN, "main"), compile_object(LIBRARY, "library")])
+        linked = "".join(chr(x) for x in program.to_binary())
+        symbols = program.get_symbols()
+        self.assertEqual(sorted(name for (name, (address, type)) in symbols.items() if type == 'data'), ['count', 'offsets'])
+
+        image, single = support.compile_program(MAIN + LIBRARY.replace("gv = Globals()\n", ""))
+        expected = support.run(image, single['main'])
+        self.assertEqual(expected, [(1, (0, 100)), (1, (10, 202)), (1, (20, 304))])
+        self.assertEqual(support.run(linked, symbols['main'][0]), expected)
+
+    def test_undefined_function(self):
+        with self.assertRaises(Exception) as raised:
+            link([compile_object(MAIN, "main")])
+        self.assertIn("Undefined function", str(raised.exception))
+
+    def test_only_called_names_are_imported(self):
+        self.assertEqual(sorted(compile_object(MAIN, "main").imports), ['offset', 'scale'])
+        misspelled = MAIN.replace("range(gv.count)", "range(count)")
+        with self.assertRaises(Exception) as raised:
+            compile_object(misspelled, "main")
+        self.assertIn("Can not resolve name count", str(raised.exception))
+
+if __name__ == "__main__":
+    unittest.main()
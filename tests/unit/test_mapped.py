@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+import unittest
+
+from embedvm.runtime import Globals, MappedGlobals
+
+import support
+
+def layout(gv):
+    gv.ticks = gv.int16()
+    gv.pair = gv.array16(length=2)
+
+class MappedGlobalsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = support.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.__enter__(), "state")
+        self.writer = MappedGlobals(self.filename, 6)
+        layout(self.writer)
+        self.reader = MappedGlobals(self.filename)
+        layout(self.reader)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+        self.tmp.__exit__(None, None, None)
+
+    def test_shared(self):
+        self.writer.ticks = 7
+        self.writer.pair[1] = -2
+        self.assertEqual((self.reader.ticks, self.reader.pair.to_list()), (7, [0, -2]))
+        self.assertRaises(Exception, self.writer.array8u, length=1)
+
+    def test_snapshot_waits_for_writes(self):
+        copies = []
+        reader = threading.Thread(target=lambda: copies.append(self.reader.snapshot()))
+        with self.writer.writing():
+            self.writer.pair[0] = 1
+            reader.start()
+            time.sleep(0.05)
+            # the write is not complete, so the reader has to wait for it
+            self.assertTrue(reader.is_alive())
+            self.writer.pair[1] = 1
+            self.writer.ticks = 1
+        reader.join(5)
+        (copy, ) = copies
+        self.assertTrue(isinstance(copy, Globals))
+        self.assertEqual((copy.ticks, copy.pair.to_list()), (1, [1, 1]))
+
+    def test_snapshots_of_another_process(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(1, 3000):
+                    with self.writer.writing():
+                        self.writer.pair[0] = i
+                        self.writer.pair[1] = -i
+                        self.writer.ticks = i
+            finally:
+                os._exit(0)
+        try:
+            while True:
+                copy = self.reader.snapshot()
+                self.assertEqual(copy.pair.to_list(), [copy.ticks, -copy.ticks])
+                if copy.ticks == 2999:
+                    break
+        finally:
+            os.waitpid(pid, 0)
+
+if __name__ == "__main__":
+    unittest.main()
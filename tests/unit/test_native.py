@@ -0,0 +1,62 @@
+import sys
+import types
+import unittest
+
+from embedvm.native import compile_native, helpers
+from embedvm.runtime import Globals
+
+import support
+
+SOURCE = """
+from embedvm.runtime import Globals
+from testsuite import userfunc
+
+gv = Globals()
+gv.before = gv.array16(init=[7, 8])
+gv.a = gv.array16(length=4)
+
+def main():
+    gv.a[-1] = 5
+    userfunc(1, gv.a[3], gv.before[1])
+    i = 0 - 2
+    userfunc(2, gv.a[i])
+"""
+
+class NativeTest(unittest.TestCase):
+    def run_native(self, source):
+        calls = []
+        testsuite = types.ModuleType('testsuite')
+        testsuite.userfunc = lambda which, *args: calls.append((which, args))
+        saved = sys.modules.get('testsuite')
+        sys.modules['testsuite'] = testsuite
+        try:
+            namespace = {'__name__': 'native'}
+            namespace.update(helpers)
+            exec compile_native(source) in namespace
+            namespace['main']()
+        finally:
+            if saved is None:
+                del sys.modules['testsuite']
+            else:
+                sys.modules['testsuite'] = saved
+        return calls
+
+    def test_indices_like_the_vm(self):
+        image, symbols = support.compile_program(SOURCE)
+        calls = support.run(image, symbols['main'])
+        self.assertEqual(calls, [(1, (0, 5)), (2, (7,))])
+        self.assertEqual(self.run_native(SOURCE), calls)
+
+    def test_host_indices(self):
+        gv = Globals()
+        gv.before = gv.array16(init=[7, 8])
+        gv.a = gv.array16(length=4)
+        gv.a[-1] = 5
+        self.assertEqual((gv.a[3], gv.a[-4], gv.before[1]), (5, 0, 8))
+        for index in (4, -5):
+            self.assertRaises(IndexError, gv.a.__getitem__, index)
+            self.assertRaises(IndexError, gv.a.__setitem__, index, 1)
+        self.assertEqual(gv.before.to_list() + gv.a.to_list(), [7, 8, 0, 0, 0, 5])
+
+if __name__ == "__main__":
+    unittest.main()
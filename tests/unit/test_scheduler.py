@@ -0,0 +1,86 @@
+import unittest
+
+from embedvm.eventloop import Sleep
+from embedvm.scheduler import Scheduler
+
+import support
+
+SOURCE = """
+from testsuite import userfunc
+
+def main():
+    for i in range(20):
+        userfunc(1, i)
+"""
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.image, self.symbols = support.compile_program(SOURCE)
+        self.log = []
+        # the number of instructions main takes
+        vm, calls = support.start(self.image, self.symbols['main'])
+        self.length = vm.run()
+        self.assertTrue(vm.finished)
+
+    def spawn(self, scheduler, name, sleep=None, **kwargs):
+        def userfunc(which, *args):
+            self.log.append((name, args[0]))
+            if sleep is not None and args[0] == 0:
+                return self.sleeping(sleep)
+        return scheduler.spawn(bytearray(self.image), self.symbols['main'], [userfunc], name=name, **kwargs)
+
+    @staticmethod
+    def sleeping(seconds):
+        yield Sleep(seconds)
+
+    def names(self):
+        return [name for (name, i) in self.log]
+
+    def test_priorities(self):
+        scheduler = Scheduler(slice=10)
+        self.spawn(scheduler, "low")
+        self.spawn(scheduler, "high", priority=1)
+        self.spawn(scheduler, "higher", priority=2)
+        scheduler.run()
+        self.assertEqual(self.names(), ["higher"] * 20 + ["high"] * 20 + ["low"] * 20)
+
+    def test_turns_and_accounting(self):
+        scheduler = Scheduler(slice=50)
+        a = self.spawn(scheduler, "a")
+        b = self.spawn(scheduler, "b", slice=100)
+        scheduler.run()
+        # both take turns, b getting twice as many instructions per turn
+        self.assertEqual(sorted(self.log), sorted([(n, i) for n in "ab" for i in range(20)]))
+        self.assertNotEqual(self.names(), sorted(self.names()))
+        for (context, slice) in ((a, 50), (b, 100)):
+            self.assertEqual(context.state, "finished")
+            self.assertEqual(context.instructions, self.length)
+            self.assertEqual(context.slices, -(-self.length // slice))
+            self.assertEqual(context.waits, 0)
+        self.assertTrue("finished" in scheduler.report())
+
+    def test_waiting_lets_others_run(self):
+        scheduler = Scheduler(slice=1000)
+        high = self.spawn(scheduler, "high", priority=1, sleep=0.01)
+        self.spawn(scheduler, "low")
+        scheduler.run()
+        self.assertEqual(high.waits, 1)
+        self.assertEqual(self.names(), ["high"] + ["low"] * 20 + ["high"] * 19)
+
+    def test_time_slices(self):
+        ticks = [0]
+        def timer():
+            ticks[0] += 1
+            return ticks[0]
+        scheduler = Scheduler(time_slice=2, timer=timer)
+        scheduler.time_check_interval = 5
+        a = self.spawn(scheduler, "a")
+        self.spawn(scheduler, "b")
+        scheduler.run()
+        # a slice ends after the first check against the clock
+        self.assertEqual(a.slices, -(-self.length // 5))
+        self.assertEqual(a.instructions, self.length)
+        self.assertTrue(a.cpu_time > 0)
+
+if __name__ == "__main__":
+    unittest.main()
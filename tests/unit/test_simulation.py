@@ -0,0 +1,102 @@
+import unittest
+
+from embedvm.eventloop import Return, Sleep
+from embedvm.simulation import Simulation
+from embedvm.vm import VM
+
+import support
+
+SOURCE = """
+from embedvm.runtime import Globals
+from testsuite import userfunc
+
+gv = Globals()
+gv.ticks = gv.int16()
+
+def tick():
+    gv.ticks = gv.ticks + 1
+    userfunc(1, gv.ticks)
+
+def button():
+    userfunc(2)
+
+def slow():
+    for i in range(100):
+        gv.ticks = gv.ticks + 0
+    userfunc(5)
+
+def main():
+    userfunc(3)
+    userfunc(4)
+"""
+
+class SimulationTest(unittest.TestCase):
+    def setUp(self):
+        self.image, self.symbols = support.compile_program(SOURCE)
+        self.vm = VM()
+        self.vm.load(bytearray(self.image))
+        self.calls = []
+        def userfunc(which, *args):
+            self.calls.append((which, args, self.simulation.time))
+            return 0
+        self.vm.set_userfunc(userfunc)
+        self.simulation = Simulation(self.vm, self.symbols)
+
+    def test_timer(self):
+        sim = self.simulation
+        sim.every(0.01, 'tick', count=5)
+        self.assertEqual(sim.run(), sim.time)
+        self.assertEqual([(w, a) for (w, a, t) in self.calls], [(1, (i,)) for i in range(1, 6)])
+        for (i, (which, args, time)) in enumerate(self.calls):
+            self.assertTrue(0.01 * (i + 1) <= time < 0.01 * (i + 1) + 0.001, time)
+        self.assertEqual(sim.delivered, 5)
+        # the VM only ran the handlers, the rest of the time was skipped
+        self.assertEqual(sim.cycles, sim.idle_cycles + sim.instructions * 213)
+        self.assertTrue(sim.idle_cycles > 0.049 * sim.frequency)
+
+    def test_interrupts_wait_for_handlers(self):
+        sim = self.simulation
+        sim.at(0.01, 'slow')
+        sim.at(0.01, lambda sim: sim.interrupt('button'))
+        sim.at(0.02, self.symbols['button'])
+        sim.run()
+        self.assertEqual([w for (w, a, t) in self.calls], [5, 2, 2])
+        self.assertTrue(self.calls[1][2] - 0.01 > 100 * 213. / sim.frequency)
+
+        nested = Simulation(self.vm, self.symbols, nested=True)
+        self.calls[:] = []
+        self.simulation = nested
+        nested.at(0.01, 'slow')
+        nested.at(0.01, 'button')
+        nested.run()
+        self.assertEqual([w for (w, a, t) in self.calls], [2, 5])
+
+    def test_sleeping_userfunc(self):
+        def sleep():
+            yield Sleep(0.02)
+            raise Return(1)
+        self.vm.set_userfunc(sleep, 3)
+        self.vm.interrupt(self.symbols['main'])
+        sim = self.simulation
+        sim.every(0.005, 'tick', count=2)
+        sim.run(until=1)
+        # the ticks are delivered once the user function has returned, and
+        # interrupt main
+        self.assertEqual([w for (w, a, t) in self.calls], [1, 1, 4])
+        for (which, args, time) in self.calls:
+            self.assertTrue(0.02 <= time < 0.021, time)
+        self.assertTrue(sim.idle_cycles >= 0.02 * sim.frequency)
+
+    def test_run_until(self):
+        sim = self.simulation
+        sim.every(0.01, 'tick')
+        self.assertEqual(sim.run(until=0.035), 0.035)
+        self.assertEqual(len(self.calls), 3)
+        # events at the end of the run are left for the next one
+        self.assertEqual(sim.run(until=0.1), 0.1)
+        self.assertEqual(len(self.calls), 9)
+        sim.run(until=0.105)
+        self.assertEqual([a for (w, a, t) in self.calls], [(i,) for i in range(1, 11)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import unittest
+
+from embedvm import snapshot
+from embedvm.scheduler import Scheduler
+from embedvm.simulation import Simulation
+from embedvm.vm import VM
+
+import support
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.image, self.symbols = support.compile_program(support.read_test("test_arrays.py"))
+        self.expected = support.run(self.image, self.symbols['main'])
+        # stop in the middle, after the first pr() and inside the loop
+        self.vm, self.calls = support.start(self.image, self.symbols['main'])
+        while len(self.calls) < 7:
+            self.vm.run(1)
+        self.vm.run(25)
+
+    def finish(self, vm):
+        vm.calls = []
+        def userfunc(which, *args):
+            vm.calls.append((which, args))
+            return sum(args) ^ which
+        vm.set_userfunc(userfunc)
+        while not vm.finished:
+            vm.run()
+        return vm.calls
+
+    def assertSameState(self, a, b):
+        self.assertEqual((a.ip, a.sp, a.sfp, a.stopped), (b.ip, b.sp, b.sfp, b.stopped))
+        self.assertEqual(bytearray(a.memory[:0x10000]), bytearray(b.memory[:0x10000]))
+
+    def test_restore(self):
+        data = snapshot.snapshot(self.vm)
+        vm = snapshot.restore(data)
+        self.assertSameState(vm, self.vm)
+        self.assertEqual(self.calls + self.finish(vm), self.expected)
+
+        # restoring into a used VM resets it
+        snapshot.restore(data, self.vm)
+        self.assertSameState(self.vm, snapshot.restore(data))
+        self.assertEqual(self.calls + self.finish(self.vm), self.expected)
+
+    def test_waiting(self):
+        def wait(*args):
+            yield None
+        self.vm.set_userfunc(wait)
+        while self.vm.waiting is None:
+            self.vm.run(1)
+        self.assertRaises(Exception, snapshot.snapshot, self.vm)
+
+    def test_fork(self):
+        with support.TemporaryDirectory() as tmp:
+            checkpoint = snapshot.save(os.path.join(tmp, "vm.snap"), self.vm)
+            try:
+                self.assertEqual(len(checkpoint), 1)
+                first = checkpoint.fork()
+                second = checkpoint.fork()
+                self.assertSameState(first, self.vm)
+                self.assertEqual(self.calls + self.finish(first), self.expected)
+                # the writes of the first fork are its own
+                self.assertSameState(second, self.vm)
+                self.assertEqual(self.calls + self.finish(second), self.expected)
+                self.assertSameState(checkpoint.fork(), self.vm)
+            finally:
+                checkpoint.close()
+
+    def test_simulation(self):
+        vm = VM()
+        vm.load(bytearray(self.image))
+        vm.set_userfunc(lambda which, *args: 0)
+        simulation = Simulation(vm, self.symbols)
+        simulation.at(0.01, 'pr')
+        simulation.at(0.02, 'pr')
+        simulation.run(until=0.015)
+        data = snapshot.snapshot(vm, simulation)
+        state = snapshot.simulation_state(simulation)
+        simulation.run()
+
+        other = Simulation(None, self.symbols)
+        snapshot.restore(data, simulation=other)
+        self.assertEqual(snapshot.simulation_state(other), state)
+        self.assertEqual(other.cycles, int(0.015 * other.frequency))
+
+    def test_fleet(self):
+        scheduler = Scheduler()
+        scheduler.add(self.vm, name="middle", priority=2, slice=7)
+        start = scheduler.spawn(bytearray(self.image), self.symbols['main'], name="start")
+        with support.TemporaryDirectory() as tmp:
+            checkpoint = snapshot.save_fleet(os.path.join(tmp, "fleet.snap"), scheduler)
+            try:
+                forked = Scheduler()
+                contexts = checkpoint.fork_fleet(forked)
+                self.assertEqual([(c.name, c.priority, c.slice) for c in contexts], [("middle", 2, 7), ("start", 0, 1000)])
+                self.assertSameState(contexts[0].vm, self.vm)
+                self.assertSameState(contexts[1].vm, start.vm)
+                self.assertEqual(self.calls + self.finish(contexts[0].vm), self.expected)
+                self.assertEqual(self.finish(contexts[1].vm), self.expected)
+            finally:
+                checkpoint.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from StringIO import StringIO
+
+from embedvm import coverage, delta, lines, snapshot, symbols, trace
+from embedvm.symbols import SymbolTable
+from embedvm.vm import VM
+
+import support
+
+TEXT = """0000 counter (data)
+0002 table (data)
+0010 helper (code)
+0020 main (code)
+0030 message (data)
+"""
+
+class SymbolTableTest(unittest.TestCase):
+    def assertSameTable(self, a, b):
+        self.assertEqual(a.by_name, b.by_name)
+        self.assertEqual(a.end, b.end)
+        self.assertEqual(a.sizes, b.sizes)
+
+    def test_text_and_binary(self):
+        text = SymbolTable.from_symfile(StringIO(TEXT), 0x38)
+        self.assertEqual(text.end, 0x38)
+        binary = text.to_binary()
+        self.assertSameTable(SymbolTable.from_symfile(StringIO(binary)), text)
+        # the end in the file wins over the one given
+        self.assertSameTable(SymbolTable.from_symfile(StringIO(binary), 0x40), text)
+
+        unknown = SymbolTable.from_symfile(StringIO(TEXT))
+        self.assertEqual(unknown.end, None)
+        self.assertSameTable(SymbolTable.from_binary(unknown.to_binary()), unknown)
+        self.assertSameTable(SymbolTable.from_symfile(StringIO(unknown.to_binary()), 0x38), text)
+
+    def test_evmcomp_end(self):
+        table = SymbolTable.from_symfile(StringIO(TEXT + "0038 _end (other)\n"))
+        self.assertEqual(table.end, 0x38)
+        self.assertEqual(table.size('message'), 8)
+        self.assertEqual(table.size('_end'), 0)
+        self.assertEqual(table.functions(), [(0x10, 'helper'), (0x20, 'main')])
+        self.assertEqual(table.function_at(0x37), None)
+        self.assertEqual(table.function_at(0x38), None)
+
+    def test_lookups(self):
+        table = SymbolTable.from_symfile(StringIO(TEXT), 0x38)
+        self.assertEqual([table.size(n) for n in ('counter', 'table', 'helper', 'main', 'message')], [2, 14, 16, 16, 8])
+        self.assertEqual(table.variables(), {'counter': (0, 2), 'table': (2, 14), 'message': (0x30, 8)})
+
+        self.assertEqual(table.containing(0x01), 'counter')
+        self.assertEqual(table.containing(0x1f), 'helper')
+        self.assertEqual(table.containing(0x37), 'message')
+        self.assertEqual(table.containing(0x38), None)
+        self.assertEqual(table.containing(0x05, ('code', 'other')), None)
+
+        self.assertEqual(table.function_at(0x0f), None)
+        self.assertEqual(table.function_at(0x10), 'helper')
+        self.assertEqual(table.function_at(0x2f), 'main')
+        self.assertEqual(table.function_at(0x30), None)
+
+        self.assertEqual(table.in_range(0x02, 0x30), [(0x02, 'table'), (0x10, 'helper'), (0x20, 'main')])
+        self.assertEqual(table.in_range(0x03, 0x38, ('code',)), [(0x10, 'helper'), (0x20, 'main')])
+        self.assertEqual(table.in_range(0x21, 0x30), [])
+
+    def test_compiled_program(self):
+        image, symbols = support.compile_program(support.read_test("test_arrays.py"))
+        self.assertEqual(symbols.end, len(image))
+        self.assertSameTable(SymbolTable.from_binary(symbols.to_binary()), symbols)
+        main = symbols['main']
+        self.assertEqual(symbols.function_at(main), 'main')
+        self.assertEqual(symbols.function_at(len(image) - 1), symbols.containing(len(image) - 1))
+        self.assertEqual(symbols.function_at(len(image)), None)
+
+    def test_other_files(self):
+        magics = [m.MAGIC for m in (coverage, delta, lines, snapshot, symbols, trace)]
+        self.assertEqual(len(set(magics)), len(magics))
+
+        vm = VM()
+        vm.load(bytearray(16))
+        for data in (snapshot.snapshot(vm), "EVMS" + TEXT):
+            try:
+                SymbolTable.from_symfile(StringIO(data))
+            except Exception, e:
+                self.assertTrue("symbol file" in str(e), e)
+            else:
+                self.fail("Read %r as symbols"%data[:10])
+
+if __name__ == "__main__":
+    unittest.main()